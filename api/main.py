@@ -1,26 +1,34 @@
 # main.py - FastAPI entrypoint 
 # api/main.py
-import os, hashlib, time, json
-from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, Request
-from fastapi.responses import JSONResponse
+import os, hashlib, time, json, asyncio, logging
+import httpx
+from fastapi import FastAPI, UploadFile, File, Form, Depends, HTTPException, Request, BackgroundTasks
+from fastapi.responses import Response, JSONResponse, StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
+from typing import Optional, List
+from limits import parse as parse_rate_limit
 from services.auth import require_api_key
-from services.pdf_ingest import extract_text_from_pdf
-from services.chunker import chunk_text
+from services.ingest import JobRegistry, spool_upload, ingest_pdf_file, shutdown_pool
 from storage.vectorstore import VectorStore
-from services.retriever import Retriever
+from services.retriever import Retriever, similarity_scores
 from services.prompt_template import build_prompt
 from services.sanitizer import sanitize_input, detect_prompt_injection
-from services.llm_client import OpenAIClient
-from services.output_filter import filter_output_and_redact
-from services.explainability import explain_response_perturbation
+from services.llm_client import OpenAIClient, AsyncOpenAIClient
+from services.embedding_cache import EmbeddingCache
+from services.response_cache import ResponseCache
+from services.output_filter import filter_output_and_redact, StreamingOutputFilter
+from services.explainability import explain_response_perturbation_async
 from services.confidence import compute_confidence
+from services.query_pipeline import audit_record, BatchQueryRunner, QUERY_BATCH_MAX_ITEMS
+from services.telemetry import REGISTRY, start_trace, span
 from storage.audit_store import AuditStore
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 from fastapi.middleware.cors import CORSMiddleware
 
+logger = logging.getLogger(__name__)
+
 app = FastAPI(title="ContractMiner API")
 app.add_middleware(
     CORSMiddleware,
@@ -30,85 +38,280 @@ app.add_middleware(
 )
 
 # Rate limiter
+RATE_LIMIT_PER_MINUTE = int(os.getenv("RATE_LIMIT_PER_MINUTE", "60"))
+# /query_batch counts every question against this per-client budget
+BATCH_ITEM_RATE_LIMIT = parse_rate_limit(f"{int(os.getenv('QUERY_BATCH_RATE_LIMIT_PER_MINUTE', str(RATE_LIMIT_PER_MINUTE)))}/minute")
 limiter = Limiter(key_func=get_remote_address)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+# Prometheus scrapers do not send x-api-key by default; "1" makes /metrics require it like every other route
+METRICS_REQUIRE_API_KEY = os.getenv("METRICS_REQUIRE_API_KEY", "0") == "1"
 
 # Init components
 VECTOR_PATH = os.getenv("VECTORSTORE_PATH", "./storage/faiss_index")
-vectorstore = VectorStore(VECTOR_PATH)
+# Base URL of the API instance that owns the vector store (VECTORSTORE_ROLE=writer). Workers that
+# serve the store read-only forward ingest and delete requests there.
+VECTORSTORE_WRITER_URL = os.getenv("VECTORSTORE_WRITER_URL", "").rstrip("/")
+# shared by ingest (add_documents) and /query embeddings
+embed_cache = EmbeddingCache()
+# async client serves the API (pooled connection, bounded concurrency); sync twin for thread-bound work
+llm = AsyncOpenAIClient(cache=embed_cache)
+sync_llm = OpenAIClient(cache=embed_cache)
+vectorstore = VectorStore(VECTOR_PATH, embedder=sync_llm)
 retriever = Retriever(vectorstore)
-llm = OpenAIClient()
+response_cache = ResponseCache()
+ingest_jobs = JobRegistry()
+_background = set()  # strong refs so running ingest tasks are not garbage collected
 audit = AuditStore(os.getenv("AUDIT_DB", "sqlite:///./storage/audit.db"))
+batch_runner = BatchQueryRunner(llm, retriever, vectorstore, response_cache, audit)
+writer_client = httpx.AsyncClient(base_url=VECTORSTORE_WRITER_URL, timeout=None) if VECTORSTORE_WRITER_URL else None
+
+def _collect_metrics():
+    # values kept by the components themselves, read at scrape time
+    caches = {"embedding": embed_cache, "response": response_cache}
+    return [
+        ("rag_cache_events_total", "counter", "Cache lookups by outcome",
+         [({"cache": name, "event": event}, n) for name, c in caches.items() for event, n in c.stats.items()]),
+        ("rag_cache_hit_ratio", "gauge", "Share of cache lookups answered from the cache",
+         [({"cache": name}, c.hit_rate()) for name, c in caches.items()]),
+        ("audit_queue_depth", "gauge", "Audit records waiting for the write-behind thread", [({}, audit.queue_depth())]),
+        ("audit_spill_pending", "gauge", "Audit operations spilled to the local file, waiting to be replayed",
+         [({}, audit.stats["spill_pending"])]),
+        ("audit_failed_batches_total", "counter", "Audit batch writes that failed (each attempt counts)",
+         [({}, audit.stats["failed_batches"])]),
+        ("vectorstore_generation", "gauge", "Manifest generation of the vector store", [({}, vectorstore.generation)]),
+    ]
+
+REGISTRY.add_collector(_collect_metrics)
+
+@app.on_event("shutdown")
+async def shutdown():
+    await llm.aclose()
+    if writer_client is not None:
+        await writer_client.aclose()
+    shutdown_pool()
+    vectorstore.close()
+    # drains queued audit records (AUDIT_FLUSH_ON_SHUTDOWN)
+    await asyncio.to_thread(audit.close)
 
 class QueryRequest(BaseModel):
     text: str
     top_k: int = 5
     include_explain: bool = True
+    # "inline" waits for the explanation; "background" returns first and attaches it to the audit record
+    explain_mode: str = "inline"
+
+class BatchQueryRequest(BaseModel):
+    questions: List[str]
+    top_k: int = 5
+    include_explain: bool = False
+
+async def _forward_to_writer(request: Request, **kwargs) -> Response:
+    """
+    Replay a write request against the writer instance; this worker only reads the vector store.
+    The writer's response is passed through as is, including non-JSON error bodies (e.g. from a proxy).
+    """
+    if writer_client is None:
+        raise HTTPException(status_code=503, detail="Vector store is read-only in this worker and "
+                                                    "VECTORSTORE_WRITER_URL is not set")
+    headers = {k: v for k, v in request.headers.items() if k.lower() == "x-api-key"}
+    try:
+        resp = await writer_client.request(request.method, request.url.path, headers=headers, **kwargs)
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=502, detail=f"Vector store writer unreachable: {e}")
+    return Response(content=resp.content, status_code=resp.status_code,
+                    media_type=resp.headers.get("content-type", "application/json"))
+
+def _upload_form(file: UploadFile, doc_id: Optional[str]):
+    return {"files": {"file": (file.filename, file.file, file.content_type or "application/pdf")},
+            "data": {"doc_id": doc_id} if doc_id else {}}
 
 @app.post("/ingest_pdf", dependencies=[Depends(require_api_key)])
-async def ingest_pdf(file: UploadFile = File(...)):
+async def ingest_pdf(request: Request, file: UploadFile = File(...), doc_id: str = Form(None)):
     if not file.filename.lower().endswith(".pdf"):
         raise HTTPException(status_code=400, detail="Only PDF supported")
-    content = await file.read()
-    text = extract_text_from_pdf(content)
-    chunks = chunk_text(text)
-    ids = vectorstore.add_documents(chunks)
-    return {"status":"ok", "chunks_indexed": len(ids)}
+    if vectorstore.read_only:
+        return await _forward_to_writer(request, **_upload_form(file, doc_id))
+    trace = start_trace("ingest")
+    # re-uploading under the same doc_id (default: file name) replaces the earlier version
+    doc_id = doc_id or file.filename
+    with span("spool"):
+        path = await spool_upload(file)
+    try:
+        result = await ingest_pdf_file(path, doc_id, llm, vectorstore)
+    finally:
+        os.remove(path)
+    return {"status":"ok", **result, "timings": trace.finish() if trace else None}
 
-@app.post("/query")
-@limiter.limit(f"{int(os.getenv('RATE_LIMIT_PER_MINUTE', '60'))}/minute")
-async def query_endpoint(req: QueryRequest, request: Request, api_key: str = Depends(require_api_key)):
-    user_text = req.text
+@app.post("/ingest_jobs", status_code=202, dependencies=[Depends(require_api_key)])
+async def create_ingest_job(request: Request, file: UploadFile = File(...), doc_id: str = Form(None)):
+    """
+    Same as /ingest_pdf but returns immediately; poll /ingest_jobs/{job_id} for progress.
+    """
+    if not file.filename.lower().endswith(".pdf"):
+        raise HTTPException(status_code=400, detail="Only PDF supported")
+    if vectorstore.read_only:
+        # jobs live on the writer, so their status is polled through it as well
+        return await _forward_to_writer(request, **_upload_form(file, doc_id))
+    doc_id = doc_id or file.filename
+    path = await spool_upload(file)
+    job = ingest_jobs.create(doc_id, file.filename)
+
+    async def run():
+        trace = start_trace("ingest")
+        try:
+            await ingest_pdf_file(path, doc_id, llm, vectorstore, job=job)
+        except Exception:
+            pass  # recorded on the job
+        finally:
+            os.remove(path)
+            job.timings = trace.finish() if trace else None
+
+    task = asyncio.create_task(run())
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return job.to_dict()
+
+@app.get("/ingest_jobs/{job_id}", dependencies=[Depends(require_api_key)])
+async def get_ingest_job(job_id: str, request: Request):
+    if vectorstore.read_only:
+        return await _forward_to_writer(request)
+    job = ingest_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return job.to_dict()
+
+@app.delete("/documents/{doc_id}", dependencies=[Depends(require_api_key)])
+async def delete_document(doc_id: str, request: Request):
+    if vectorstore.read_only:
+        return await _forward_to_writer(request)
+    removed = await asyncio.to_thread(vectorstore.delete_document, doc_id)
+    if not removed:
+        raise HTTPException(status_code=404, detail="Unknown document")
+    return {"status":"ok", "doc_id": doc_id, "chunks_removed": removed}
+
+@app.get("/metrics", dependencies=[Depends(require_api_key)] if METRICS_REQUIRE_API_KEY else [])
+async def metrics():
+    # Prometheus text exposition format
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/audit/stats", dependencies=[Depends(require_api_key)])
+async def audit_stats():
+    return {**audit.stats, "queue_depth": audit.queue_depth(), "write_behind": audit.write_behind}
+
+def _audit_filters(since, until, model_version, min_confidence, max_confidence, input_hash):
+    return {"since": since, "until": until, "model_version": model_version, "min_confidence": min_confidence,
+            "max_confidence": max_confidence, "input_hash": input_hash}
+
+@app.get("/audit/search", dependencies=[Depends(require_api_key)])
+async def audit_search(since: Optional[float] = None, until: Optional[float] = None, model_version: Optional[str] = None,
+                       min_confidence: Optional[float] = None, max_confidence: Optional[float] = None,
+                       input_hash: Optional[str] = None, cursor: Optional[str] = None, limit: int = 100,
+                       expand: bool = False):
+    filters = _audit_filters(since, until, model_version, min_confidence, max_confidence, input_hash)
+    return await asyncio.to_thread(audit.search, cursor=cursor, limit=limit, expand=expand, **filters)
+
+@app.get("/audit/export", dependencies=[Depends(require_api_key)])
+async def audit_export(since: Optional[float] = None, until: Optional[float] = None, model_version: Optional[str] = None,
+                       min_confidence: Optional[float] = None, max_confidence: Optional[float] = None,
+                       input_hash: Optional[str] = None):
+    # NDJSON, one record per line; rows are read page by page while the response streams
+    filters = _audit_filters(since, until, model_version, min_confidence, max_confidence, input_hash)
+    lines = (json.dumps(r) + "\n" for r in audit.iter_records(**filters))
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
+@app.get("/audit/records/{audit_id}", dependencies=[Depends(require_api_key)])
+async def get_audit_record(audit_id: str):
+    record = await asyncio.to_thread(audit.get, int(audit_id) if audit_id.isdigit() else audit_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Unknown audit record")
+    return record
+
+async def _explain_in_background(audit_id, explain_kwargs):
+    explanation = await explain_response_perturbation_async(**explain_kwargs)
+    await asyncio.to_thread(audit.attach_explanation, audit_id, explanation)
+
+def _check_input(user_text: str) -> str:
     sanitized = sanitize_input(user_text)
     if detect_prompt_injection(user_text):
         raise HTTPException(status_code=400, detail="Prompt injection detected")
+    return sanitized
 
-    # Retrieve context
-    query_embedding = llm.embed_text(sanitized)
-    retrieved = retriever.retrieve_by_embedding(query_embedding, top_k=req.top_k)
+@app.post("/query")
+@limiter.limit(f"{RATE_LIMIT_PER_MINUTE}/minute")
+async def query_endpoint(req: QueryRequest, request: Request, background_tasks: BackgroundTasks, api_key: str = Depends(require_api_key)):
+    trace = start_trace("query")
+    with span("sanitize"):
+        sanitized = _check_input(req.text)
+
+    async def _embed():
+        with span("embed"):
+            return await llm.embed_text(sanitized)
+
+    generation = vectorstore.generation
+
+    def _similar(embedding):
+        with span("cache_lookup"):
+            return response_cache.find_similar(embedding, generation)
+
+    # Retrieve context (BM25 + dense, fused; BM25 alone if the embedding service is slow or down).
+    # An answer cached for a near-identical question is looked up first and skips the dense search.
+    with span("retrieve"):
+        retrieval = await retriever.retrieve(sanitized, _embed, top_k=req.top_k, reuse=_similar)
+    query_embedding = retrieval["embedding"]
+    cached = retrieval.get("reused")
+    if cached is not None:
+        cache_hit = "similar"
+    else:
+        retrieved = retrieval["results"]
+
+        # Build prompt with strict separation
+        with span("build_prompt"):
+            prompt = build_prompt(system_instructions=llm.system_prompt(), user_text=sanitized, context_chunks=retrieved)
 
-    # Build prompt with strict separation
-    prompt = build_prompt(system_instructions=llm.system_prompt(), user_text=sanitized, context_chunks=retrieved)
+        # Call LLM (cached; identical in-flight questions share one call)
+        async def _generate():
+            resp = await llm.generate(prompt, return_logprobs=True)
+            return {"retrieved": retrieved, "prompt": prompt, "llm_resp": resp}
 
-    # Call LLM
-    llm_resp = llm.generate(prompt, return_logprobs=True)
+        cache_key = response_cache.make_key(prompt["template_id"], [r["id"] for r in retrieved], sanitized)
+        with span("generate"):
+            cached, cache_hit = await response_cache.get_or_compute(cache_key, generation, _generate, embedding=query_embedding)
+    retrieved, prompt, llm_resp = cached["retrieved"], cached["prompt"], cached["llm_resp"]
 
     # Output filtering and redaction
-    filtered_text, redaction_meta = filter_output_and_redact(llm_resp["text"])
+    with span("filter"):
+        filtered_text, redaction_meta = filter_output_and_redact(llm_resp["text"])
 
     # Explainability (perturbation-based token importance + provenance)
     explanation = None
-    if req.include_explain:
-        explanation = explain_response_perturbation(
-            llm_client=llm,
-            prompt=prompt,
-            response=llm_resp["text"],
-            retrieved_chunks=retrieved
-        )
+    explain_kwargs = dict(llm_client=llm, prompt=prompt, response=llm_resp["text"],
+                          retrieved_chunks=retrieved, base=llm_resp)
+    explain_later = req.include_explain and req.explain_mode == "background"
+    if req.include_explain and not explain_later:
+        with span("explain"):
+            explanation = await explain_response_perturbation_async(**explain_kwargs)
 
     # Confidence scoring
-    confidence = compute_confidence(
-        logprobs=llm_resp.get("logprobs"),
-        retrieval_scores=[r["score"] for r in retrieved],
-        calibration_model=None  # placeholder for production calibration
-    )
+    with span("confidence"):
+        confidence = compute_confidence(
+            logprobs=llm_resp.get("logprobs"),
+            retrieval_scores=similarity_scores(retrieved),
+            calibration_model=None  # placeholder for production calibration
+        )
 
-    # Audit log
+    # Audit log (the stage breakdown so far goes with the record)
     input_hash = hashlib.sha256(sanitized.encode()).hexdigest()
-    audit_id = audit.log({
-        "ts": time.time(),
-        "input_hash": input_hash,
-        "prompt_template": prompt["template_id"],
-        "prompt_text": prompt["text"],
-        "retrieved_ids": [r["id"] for r in retrieved],
-        "model_version": llm_resp.get("model"),
-        "raw_response": llm_resp["text"],
-        "filtered_response": filtered_text,
-        "confidence": confidence,
-        "explanation": explanation,
-        "redaction": redaction_meta
-    })
+    with span("audit"):
+        audit_id = await audit.alog(audit_record(input_hash, prompt, retrieved, llm_resp, filtered_text, redaction_meta,
+                                                 confidence, explanation, explain_later, cache_hit,
+                                                 retrieval_mode=retrieval["mode"],
+                                                 timings=trace.breakdown() if trace else None))
+    if trace:
+        trace.finish()
+    if explain_later:
+        background_tasks.add_task(_explain_in_background, audit_id, explain_kwargs)
+        explanation = {"status": "pending", "audit_id": audit_id}
 
     return JSONResponse({
         "response": filtered_text,
@@ -117,4 +320,124 @@ async def query_endpoint(req: QueryRequest, request: Request, api_key: str = Dep
         "model_version": llm_resp.get("model"),
         "input_hash": input_hash,
         "audit_id": audit_id
-    })
\ No newline at end of file
+    })
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/query_stream")
+@limiter.limit(f"{RATE_LIMIT_PER_MINUTE}/minute")
+async def query_stream_endpoint(req: QueryRequest, request: Request, background_tasks: BackgroundTasks, api_key: str = Depends(require_api_key)):
+    """
+    Server-Sent Events version of /query: "token" events carry redacted response text as the
+    model produces it, then one "trailer" event carries confidence, provenance and the audit id
+    (or an "error" event). The audit record is written when the stream ends; explanations,
+    if requested, are always computed in the background and attached to that record.
+    If the output policy blocks the response part-way, a "policy" event {"blocked": true,
+    "retract": true, "discard_chars", "response"} is sent at once and no further tokens
+    follow: clients must drop every token received so far and show "response" instead, the
+    same result /query returns for that answer.
+    """
+    sanitized = _check_input(req.text)
+    generation = vectorstore.generation
+    retrieval = await retriever.retrieve(sanitized, lambda: llm.embed_text(sanitized), top_k=req.top_k,
+                                         reuse=lambda e: response_cache.find_similar(e, generation))
+    query_embedding = retrieval["embedding"]
+    cache_key = None
+    cached, cache_hit = retrieval.get("reused"), "similar"
+    if cached is None:
+        retrieved = retrieval["results"]
+        prompt = build_prompt(system_instructions=llm.system_prompt(), user_text=sanitized, context_chunks=retrieved)
+        cache_key = response_cache.make_key(prompt["template_id"], [r["id"] for r in retrieved], sanitized)
+        cached, cache_hit = response_cache.get(cache_key, generation), "exact"
+    if cached is not None:
+        retrieved, prompt = cached["retrieved"], cached["prompt"]
+    else:
+        cache_hit = None
+    input_hash = hashlib.sha256(sanitized.encode()).hexdigest()
+
+    async def events():
+        out_filter = StreamingOutputFilter()
+        sent, llm_resp, status = [], None, "aborted"
+        try:
+            if cached is not None:
+                stream = _replay(cached["llm_resp"])
+            else:
+                stream = llm.generate_stream(prompt, return_logprobs=True)
+            retracted = False
+            async for ev in stream:
+                if ev["type"] == "final":
+                    llm_resp = ev["response"]
+                    continue
+                piece = out_filter.feed(ev["text"])
+                if piece:
+                    sent.append(piece)
+                    yield _sse("token", {"text": piece})
+                if out_filter.blocked and not retracted:
+                    # the rest of the stream is still consumed so the response can be cached and audited
+                    retracted = True
+                    yield _policy_retraction(out_filter)
+            piece = out_filter.finish()
+            if piece:
+                sent.append(piece)
+                yield _sse("token", {"text": piece})
+            if out_filter.blocked and not retracted:
+                yield _policy_retraction(out_filter)
+            if cached is None:
+                response_cache.put(cache_key, {"retrieved": retrieved, "prompt": prompt, "llm_resp": llm_resp},
+                                   generation, embedding=query_embedding)
+            status = "complete"
+        except Exception as e:
+            status = "error"
+            logger.exception("Streaming query failed")
+            yield _sse("error", {"detail": str(e)})
+        finally:
+            # runs on completion, failure and client disconnect alike
+            llm_resp = llm_resp or {"text": "", "model": llm.model, "logprobs": None}
+            filtered_text = "[REDACTED_FOR_POLICY]" if out_filter.blocked else "".join(sent)
+            confidence = compute_confidence(logprobs=llm_resp.get("logprobs"),
+                                            retrieval_scores=similarity_scores(retrieved), calibration_model=None)
+            explain_later = req.include_explain and status == "complete"
+            audit_id = await audit.alog(audit_record(input_hash, prompt, retrieved, llm_resp, filtered_text, out_filter.meta(),
+                                                     confidence, None, explain_later, cache_hit, stream_status=status,
+                                                     retrieval_mode=retrieval["mode"]))
+            if explain_later:
+                background_tasks.add_task(_explain_in_background, audit_id, dict(
+                    llm_client=llm, prompt=prompt, response=llm_resp["text"], retrieved_chunks=retrieved, base=llm_resp))
+        if status == "complete":
+            yield _sse("trailer", {
+                "confidence_score": confidence,
+                "provenance": {"retrieved_ids": [r["id"] for r in retrieved], "context_ids": prompt.get("context_ids")},
+                "explanation": {"status": "pending", "audit_id": audit_id} if explain_later else None,
+                "model_version": llm_resp.get("model"),
+                "input_hash": input_hash,
+                "audit_id": audit_id,
+                "cache_hit": cache_hit
+            })
+
+    return StreamingResponse(events(), media_type="text/event-stream", background=background_tasks)
+
+def _policy_retraction(out_filter: StreamingOutputFilter) -> str:
+    return _sse("policy", {"blocked": True, "retract": True, "discard_chars": out_filter.sent_chars,
+                           "response": "[REDACTED_FOR_POLICY]"})
+
+async def _replay(llm_resp):
+    # cached answers go through the same event path as a live stream
+    yield {"type": "delta", "text": llm_resp["text"]}
+    yield {"type": "final", "response": llm_resp}
+
+@app.post("/query_batch")
+async def query_batch_endpoint(req: BatchQueryRequest, request: Request, api_key: str = Depends(require_api_key)):
+    """
+    Answer many questions in one request. Results stream back as NDJSON, one line per
+    question in completion order, each carrying its 'index' and an HTTP-style 'status'.
+    """
+    if len(req.questions) > QUERY_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {QUERY_BATCH_MAX_ITEMS} questions per batch")
+    client = get_remote_address(request)
+
+    def admit(_index):
+        return not limiter.enabled or limiter.limiter.hit(BATCH_ITEM_RATE_LIMIT, "query_batch", client)
+
+    items = batch_runner.run(req.questions, top_k=req.top_k, include_explain=req.include_explain, admit=admit)
+    return StreamingResponse((json.dumps(item) + "\n" async for item in items), media_type="application/x-ndjson")
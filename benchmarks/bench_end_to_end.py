@@ -0,0 +1,243 @@
+# bench_end_to_end.py - Offline end-to-end benchmark: ingest throughput and /query latency under load
+# benchmarks/bench_end_to_end.py
+# usage: python benchmarks/bench_end_to_end.py [--docs 20] [--pages 8] [--queries 200] [--concurrency 16]
+#            [--replay log.jsonl] [--out results.json] [--compare previous.json] [--url http://host:8000]
+# Runs the API in-process against the deterministic fake provider (LLM_PROVIDER=fake) and a
+# temporary store unless --url points at a running server. Results are written as JSON;
+# --compare flags metrics that got worse than a previous run by more than --tolerance.
+import os, sys, json, time, random, asyncio, logging, argparse, platform, tempfile, subprocess
+import numpy as np
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from benchmarks.synthetic_contracts import contract_pdf, contract_terms
+
+API_KEY = "bench-key"
+QUESTIONS = [
+    "How many days prior written notice is required to terminate {vendor}'s agreement for convenience?",
+    "Which law governs the agreement between {vendor} and {customer}?",
+    "Within how many days must {customer} pay undisputed invoices?",
+    "What availability percentage must {vendor} maintain each month?",
+    "How long must confidential information be kept confidential?",
+    "What is the cap on aggregate liability?",
+    "Can {customer} assign the agreement without consent?",
+    "Which events count as force majeure?",
+]
+# metric -> True if higher is better; compared by --compare
+HIGHER_IS_BETTER = {"pages_per_sec": True, "chunks_per_sec": True, "rps": True,
+                    "p50_ms": False, "p95_ms": False, "p99_ms": False, "error_rate": False}
+
+def configure_offline(root: str, args):
+    # must run before api.main is imported: components are built from the environment at import time
+    env = {"LLM_PROVIDER": "fake", "API_MASTER_KEY": API_KEY, "RATE_LIMIT_PER_MINUTE": "100000000",
+           "QUERY_BATCH_RATE_LIMIT_PER_MINUTE": "100000000",
+           "VECTORSTORE_PATH": os.path.join(root, "index"), "AUDIT_DB": f"sqlite:///{root}/audit.db",
+           "EMBED_CACHE_PATH": os.path.join(root, "embed_cache.db"),
+           "FAKE_EMBED_LATENCY_MS": str(args.embed_latency_ms), "FAKE_LLM_LATENCY_MS": str(args.llm_latency_ms),
+           "FAKE_LLM_TOKEN_LATENCY_MS": str(args.token_latency_ms)}
+    if not args.response_cache:
+        env["RESPONSE_CACHE_TTL"] = "0"  # every question runs the full pipeline
+    os.environ.update(env)
+
+def percentiles(latencies_ms):
+    if not latencies_ms:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None, "mean_ms": None}
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99])
+    return {"p50_ms": round(float(p50), 3), "p95_ms": round(float(p95), 3), "p99_ms": round(float(p99), 3),
+            "mean_ms": round(float(np.mean(latencies_ms)), 3)}
+
+async def run_ingest(client, docs: int, pages: int, seed: int):
+    stages, total_pages, total_chunks = {}, 0, 0
+    saved = {"deduplicated": 0, "embed_tokens_saved": 0, "index_bytes_saved": 0}
+    t0 = time.perf_counter()
+    for i in range(docs):
+        pdf = contract_pdf(seed + i, pages)
+        resp = await client.post("/ingest_pdf", data={"doc_id": f"msa-{seed + i}"},
+                                 files={"file": (f"msa-{seed + i}.pdf", pdf, "application/pdf")})
+        resp.raise_for_status()
+        body = resp.json()
+        total_pages += body["pages"]
+        total_chunks += body["chunks_indexed"]
+        for k in saved:
+            saved[k] += body.get(k, 0)
+        for stage, ms in ((body.get("timings") or {}).get("stages") or {}).items():
+            stages[stage] = stages.get(stage, 0.0) + ms
+    wall = time.perf_counter() - t0
+    return {"docs": docs, "pages": total_pages, "chunks": total_chunks, "seconds": round(wall, 3),
+            "pages_per_sec": round(total_pages / wall, 3), "chunks_per_sec": round(total_chunks / wall, 3),
+            "stage_ms": {k: round(v, 3) for k, v in sorted(stages.items(), key=lambda kv: -kv[1])}, "dedup": saved}
+
+async def run_load(client, requests, concurrency: int):
+    """
+    POST each request body to /query with at most `concurrency` in flight.
+    """
+    sem = asyncio.Semaphore(max(1, concurrency))
+    latencies, statuses = [], {}
+
+    async def one(body):
+        async with sem:
+            t0 = time.perf_counter()
+            try:
+                status = (await client.post("/query", json=body)).status_code
+            except httpx.HTTPError:
+                status = "error"
+            ms = (time.perf_counter() - t0) * 1000
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+        if status == 200:
+            latencies.append(ms)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*[one(b) for b in requests])
+    wall = time.perf_counter() - t0
+    ok = statuses.get("200", 0)
+    return {"requests": len(requests), "concurrency": concurrency, "seconds": round(wall, 3),
+            "rps": round(ok / wall, 3) if wall else None, "error_rate": round(1 - ok / max(len(requests), 1), 4),
+            "status": statuses, **percentiles(latencies)}
+
+def synthetic_questions(n: int, docs: int, seed: int):
+    rnd = random.Random(seed)
+    return [rnd.choice(QUESTIONS).format(**contract_terms(seed + rnd.randrange(max(docs, 1)))) for _ in range(n)]
+
+def load_replay(path: str, include_explain: bool):
+    """
+    Request bodies from a JSON-lines log: the question is 'text' (or 'question', or 'title'
+    for backlog-style files); 'top_k', 'include_explain' and 'explain_mode' are kept if present.
+    """
+    bodies = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            rec = json.loads(line)
+            text = rec.get("text") or rec.get("question") or rec.get("title")
+            if not text:
+                continue
+            body = {"text": text, "include_explain": rec.get("include_explain", include_explain)}
+            body.update({k: rec[k] for k in ("top_k", "explain_mode") if k in rec})
+            bodies.append(body)
+    return bodies
+
+def compare(current: dict, previous: dict, tolerance: float):
+    """
+    [(section, metric, previous, current, relative change, regressed)] for metrics present in both runs.
+    """
+    rows = []
+    for section, metrics in _sections(current):
+        before = dict(_sections(previous)).get(section)
+        if not before:
+            continue
+        for metric, higher in HIGHER_IS_BETTER.items():
+            old, new = before.get(metric), metrics.get(metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old if old else (0.0 if new == old else float("inf"))
+            worse = -change if higher else change
+            rows.append((section, metric, old, new, change, worse > tolerance))
+    return rows
+
+def _sections(results: dict):
+    out = []
+    if "ingest" in results:
+        out.append(("ingest", results["ingest"]))
+    for name, metrics in (results.get("query") or {}).items():
+        out.append((f"query.{name}", metrics))
+    if "replay" in results:
+        out.append(("replay", results["replay"]))
+    return out
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+async def bench(args):
+    shutdown = None
+    if args.url:
+        transport, base_url = None, args.url
+    else:
+        import api.main as main
+        transport, base_url, shutdown = httpx.ASGITransport(app=main.app), "http://bench", main.shutdown
+    headers = {"x-api-key": args.api_key or API_KEY}
+    results = {}
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url=base_url, headers=headers, timeout=None) as client:
+            if args.docs:
+                results["ingest"] = await run_ingest(client, args.docs, args.pages, args.seed)
+            if args.queries:
+                questions = synthetic_questions(args.queries, args.docs, args.seed)
+                results["query"] = {}
+                for name, explain in (("no_explain", False), ("explain", True)):
+                    bodies = [{"text": q, "top_k": args.top_k, "include_explain": explain} for q in questions]
+                    results["query"][name] = await run_load(client, bodies, args.concurrency)
+            if args.replay:
+                results["replay"] = {"file": args.replay,
+                                     **await run_load(client, load_replay(args.replay, args.explain_replay),
+                                                      args.concurrency)}
+            if args.url is None:
+                metrics = await client.get("/metrics")
+                results["metrics_sample"] = [l for l in metrics.text.splitlines()
+                                             if l.startswith(("llm_tokens_total", "rag_cache_hit_ratio"))]
+    finally:
+        if shutdown is not None:
+            await shutdown()
+    return results
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--docs", type=int, default=20, help="synthetic contracts to ingest")
+    ap.add_argument("--pages", type=int, default=8, help="pages per contract")
+    ap.add_argument("--queries", type=int, default=200, help="/query calls per explainability setting")
+    ap.add_argument("--concurrency", type=int, default=16)
+    ap.add_argument("--top-k", type=int, default=5)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--replay", help="JSON-lines request log to replay against /query")
+    ap.add_argument("--explain-replay", action="store_true", help="default include_explain for replayed requests")
+    ap.add_argument("--response-cache", action="store_true", help="keep the response cache on (default: off)")
+    ap.add_argument("--embed-latency-ms", type=float, default=20.0, help="simulated latency per embedding request")
+    ap.add_argument("--llm-latency-ms", type=float, default=150.0, help="simulated latency per completion")
+    ap.add_argument("--token-latency-ms", type=float, default=2.0, help="simulated latency per generated token")
+    ap.add_argument("--url", help="benchmark a running server instead of an in-process offline app")
+    ap.add_argument("--api-key", help="x-api-key for --url")
+    ap.add_argument("--out", default=f"bench_e2e_{time.strftime('%Y%m%d-%H%M%S')}.json")
+    ap.add_argument("--compare", help="previous results file to check for regressions")
+    ap.add_argument("--tolerance", type=float, default=0.2, help="allowed relative change before flagging")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as root:
+        if not args.url:
+            configure_offline(root, args)
+        started = time.time()
+        results = asyncio.run(bench(args))
+    results["meta"] = {"started": started, "commit": _git_commit(), "python": platform.python_version(),
+                       "platform": platform.platform(), "mode": "url" if args.url else "offline", "args": vars(args)}
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+
+    if "ingest" in results:
+        r = results["ingest"]
+        print(f"ingest: {r['docs']} docs, {r['pages']} pages, {r['chunks']} chunks in {r['seconds']:.2f}s "
+              f"-> {r['pages_per_sec']:.1f} pages/s, {r['chunks_per_sec']:.1f} chunks/s; "
+              f"{r['dedup']['deduplicated']} near-duplicate chunks shared a vector")
+    print(f"{'workload':18} {'reqs':>6} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for section, r in _sections(results):
+        if section != "ingest":
+            print(f"{section:18} {r['requests']:6d} {r['rps'] or 0:8.1f} {r['p50_ms'] or 0:8.1f} "
+                  f"{r['p95_ms'] or 0:8.1f} {r['p99_ms'] or 0:8.1f} {r['error_rate']:7.2%}")
+    print(f"results written to {args.out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            rows = compare(results, json.load(f), args.tolerance)
+        regressions = [r for r in rows if r[5]]
+        print(f"\ncompared with {args.compare} (tolerance {args.tolerance:.0%})")
+        for section, metric, old, new, change, worse in rows:
+            print(f"{section:18} {metric:15} {old:10.3f} -> {new:10.3f} {change:+8.1%}{'  REGRESSION' if worse else ''}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
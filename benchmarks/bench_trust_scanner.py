@@ -0,0 +1,78 @@
+# bench_trust_scanner.py - Micro-benchmark: current sanitizer/scanner vs. the previous per-pattern regex passes
+# benchmarks/bench_trust_scanner.py
+# usage: python benchmarks/bench_trust_scanner.py [--size 20000] [--repeat 200]
+import os, re, sys, random, argparse, timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from services.sanitizer import sanitize_input, detect_prompt_injection
+from services.output_filter import filter_output_and_redact
+from services.trust_scanner import default_scanner
+
+# --- previous implementations, kept here for comparison only ---
+LEGACY_PII = {
+    "email": r'\b[\w\.-]+@[\w\.-]+\.\w+\b',
+    "ssn": r'\b\d{3}-\d{2}-\d{4}\b',
+    "phone": r'\b(?:\+?\d{1,3})?[-.\s]?(?:\d{2,4}[-.\s]?){2,4}\d{2,4}\b'
+}
+
+def legacy_sanitize(text):
+    text = re.sub(r'[\x00-\x1f\x7f-\x9f]', ' ', text)
+    text = re.sub(r'https?://\S+', '[REDACTED_URL]', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+def legacy_detect(text):
+    for p in [r'ignore (previous|all) instructions', r'do not follow system',
+              r'follow these new instructions', r'execute the following']:
+        if re.search(p, text, flags=re.I):
+            return True
+    return False
+
+def legacy_redact(text):
+    redactions = []
+    for label, pat in LEGACY_PII.items():
+        matches = re.findall(pat, text)
+        if matches:
+            redactions.append({"type": label, "matches": matches})
+            text = re.sub(pat, f"[REDACTED_{label.upper()}]", text)
+    return text, {"redactions": redactions}
+
+def make_text(size, seed=7):
+    rnd = random.Random(seed)
+    words = ("the supplier shall indemnify purchaser against all claims arising under this agreement "
+             "termination requires ninety days written notice governing law delaware").split()
+    extras = ["jane.doe@acme.com", "555-123-4567", "123-45-6789", "https://acme.com/terms?id=7", "\t", "\n"]
+    out, n = [], 0
+    while n < size:
+        w = rnd.choice(extras) if rnd.random() < 0.03 else rnd.choice(words)
+        out.append(w)
+        n += len(w) + 1
+    return " ".join(out)[:size]
+
+def stream_redact(text, chunk=16):
+    red = default_scanner().stream_redactor(kinds=("pii",))
+    out = [red.feed(text[i:i + chunk]) for i in range(0, len(text), chunk)]
+    out.append(red.finish())
+    return "".join(out)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--size", type=int, default=20000, help="characters of synthetic contract text")
+    ap.add_argument("--repeat", type=int, default=200)
+    args = ap.parse_args()
+    text = make_text(args.size)
+
+    cases = [
+        ("sanitize_input", lambda: legacy_sanitize(text), lambda: sanitize_input(text)),
+        ("detect_prompt_injection", lambda: legacy_detect(text), lambda: detect_prompt_injection(text)),
+        ("filter_output_and_redact", lambda: legacy_redact(text), lambda: filter_output_and_redact(text)),
+        ("stream redaction (16-char chunks)", lambda: legacy_redact(text), lambda: stream_redact(text)),
+    ]
+    print(f"text: {len(text)} chars, {args.repeat} runs each")
+    print(f"{'case':36} {'legacy ms':>10} {'current ms':>11} {'speedup':>8}")
+    for name, old, new in cases:
+        t_old = min(timeit.repeat(old, number=args.repeat, repeat=3)) / args.repeat * 1000
+        t_new = min(timeit.repeat(new, number=args.repeat, repeat=3)) / args.repeat * 1000
+        print(f"{name:36} {t_old:10.3f} {t_new:11.3f} {t_old / t_new:7.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# bench_vector_index.py - Recall/latency/size benchmark of the vector store index types
+# benchmarks/bench_vector_index.py
+# usage: python benchmarks/bench_vector_index.py [--n 50000] [--dim 256] [--queries 200] [--kinds flat,ivf_pq,...]
+import os, sys, time, logging, argparse, tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from storage.vectorstore import VectorStore
+from storage.vector_index import INDEX_KINDS, HAS_FAISS
+
+def make_corpus(n, dim, queries, seed=7):
+    # clustered vectors (like embeddings of related clauses) and queries near corpus points
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(n // 500, 8), dim)).astype("float32")
+    vecs = centers[rng.integers(len(centers), size=n)] + 0.6 * rng.normal(size=(n, dim)).astype("float32")
+    vecs /= np.linalg.norm(vecs, axis=1, keepdims=True)
+    qs = vecs[rng.integers(n, size=queries)] + 0.3 * rng.normal(size=(queries, dim)).astype("float32") / np.sqrt(dim) * 4
+    qs /= np.linalg.norm(qs, axis=1, keepdims=True)
+    return vecs.astype("float32"), qs.astype("float32")
+
+def build(kind, vecs, root):
+    vs = VectorStore(os.path.join(root, kind), embedder=object(), index_kind=kind, train_threshold=1)
+    chunks = [{"id": str(i), "text": ""} for i in range(len(vecs))]
+    t0 = time.perf_counter()
+    for start in range(0, len(vecs), 10000):
+        vs.add_embeddings(chunks[start:start + 10000], vecs[start:start + 10000])
+    vs.compact()  # trains the configured index type
+    build_s = time.perf_counter() - t0
+    snap = vs.segments.path_of(vs.segments.manifest["snapshot"]["file"])
+    return vs, build_s, os.path.getsize(snap)
+
+def measure(vs, qs, truth, k, **knobs):
+    lat, recall = [], []
+    for q, t in zip(qs, truth):
+        t0 = time.perf_counter()
+        hits = vs.query(q, top_k=k, **knobs)
+        lat.append((time.perf_counter() - t0) * 1000)
+        recall.append(len({int(h["id"]) for h in hits} & set(t.tolist())) / k)
+    return np.mean(recall), np.percentile(lat, 50), np.percentile(lat, 95)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n", type=int, default=50000, help="corpus vectors")
+    ap.add_argument("--dim", type=int, default=256)
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--k", type=int, default=10)
+    ap.add_argument("--kinds", default=",".join(INDEX_KINDS))
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    vecs, qs = make_corpus(args.n, args.dim, args.queries)
+    truth = np.argsort(-(qs @ vecs.T), axis=1)[:, :args.k]
+    kinds = args.kinds.split(",") if HAS_FAISS else ["hnsw"]
+
+    print(f"corpus: {args.n} x {args.dim}, {args.queries} queries, recall@{args.k} vs exact search")
+    print(f"{'index':10} {'knobs':22} {'build s':>8} {'size MB':>8} {'recall':>7} {'p50 ms':>7} {'p95 ms':>7}")
+    with tempfile.TemporaryDirectory() as root:
+        for kind in kinds:
+            vs, build_s, size = build(kind, vecs, root)
+            settings = [{}]
+            if kind in ("ivf_flat", "ivf_pq"):
+                settings = [{"nprobe": p} for p in (1, 8, 32)]
+            elif kind == "hnsw":
+                settings = [{"ef": e} for e in (16, 64, 256)]
+            if kind in ("ivf_pq", "sq8", "sq_fp16"):
+                settings += [{**s, "rerank": False} for s in settings]
+            for knobs in settings:
+                recall, p50, p95 = measure(vs, qs, truth, args.k, **knobs)
+                label = " ".join(f"{k}={v}" for k, v in knobs.items()) or "-"
+                print(f"{kind:10} {label:22} {build_s:8.2f} {size / 2**20:8.1f} {recall:7.3f} {p50:7.2f} {p95:7.2f}")
+
+if __name__ == "__main__":
+    main()
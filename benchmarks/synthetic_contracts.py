@@ -0,0 +1,99 @@
+# synthetic_contracts.py - Deterministic synthetic contract text and PDFs for tests and benchmarks
+# benchmarks/synthetic_contracts.py
+import random, textwrap
+from typing import List
+
+PARTIES = ["Acme Corporation", "Globex Ltd", "Initech LLC", "Umbrella Holdings", "Stark Industries",
+           "Wayne Enterprises", "Hooli Inc", "Soylent Partners", "Vandelay Imports", "Wonka Industries"]
+STATES = ["Delaware", "New York", "California", "Texas", "England and Wales", "Ontario"]
+
+# boilerplate shared by most contracts, and clauses whose terms vary per contract
+CLAUSES = [
+    "Governing Law. This Agreement shall be governed by and construed in accordance with the laws of {state}, "
+    "without regard to its conflict of laws principles.",
+    "Indemnification. Each party shall indemnify, defend and hold harmless the other party from and against any "
+    "and all claims, losses, damages, liabilities and expenses arising out of its breach of this Agreement.",
+    "Confidentiality. The receiving party shall hold the disclosing party's Confidential Information in strict "
+    "confidence for a period of {years} years following disclosure and use it only to perform this Agreement.",
+    "Termination. Either party may terminate this Agreement for convenience upon {notice} days prior written "
+    "notice to the other party.",
+    "Payment Terms. {customer} shall pay all undisputed invoices within {net} days of receipt; late payments "
+    "accrue interest at {interest} percent per month.",
+    "Limitation of Liability. Except for breaches of confidentiality, neither party's aggregate liability shall "
+    "exceed the fees paid in the {cap} months preceding the claim.",
+    "Service Levels. {vendor} shall maintain availability of at least {uptime} percent measured monthly, and "
+    "service credits are the customer's sole remedy for any shortfall.",
+    "Assignment. Neither party may assign this Agreement without the prior written consent of the other party, "
+    "except to a successor in a merger or sale of substantially all of its assets.",
+    "Force Majeure. Neither party is liable for delays caused by events beyond its reasonable control, including "
+    "fire, flood, pandemic, war or failure of public utilities.",
+    "Notices. All notices shall be in writing and delivered to {vendor} at its registered office, attention "
+    "General Counsel.",
+]
+SIGNATURE = ("IN WITNESS WHEREOF, the parties have executed this Agreement as of the Effective Date. "
+             "{vendor}: By: ____________ Name: ____________ Title: ____________. "
+             "{customer}: By: ____________ Name: ____________ Title: ____________.")
+
+def contract_terms(seed: int) -> dict:
+    rnd = random.Random(seed)
+    vendor, customer = rnd.sample(PARTIES, 2)
+    return {"vendor": vendor, "customer": customer, "state": rnd.choice(STATES), "years": rnd.choice((2, 3, 5)),
+            "notice": rnd.choice((15, 30, 45, 60, 90)), "net": rnd.choice((30, 45, 60)),
+            "interest": rnd.choice(("1", "1.5", "2")), "cap": rnd.choice((6, 12, 24)),
+            "uptime": rnd.choice(("99.5", "99.9", "99.95"))}
+
+def contract_pages(seed: int, pages: int = 4) -> List[str]:
+    """
+    Text of a synthetic services agreement, `pages` pages long: a preamble, numbered
+    clauses (cycled to fill the pages) and a signature block on the last page.
+    """
+    terms = contract_terms(seed)
+    rnd = random.Random(seed)
+    order = list(CLAUSES)
+    rnd.shuffle(order)
+    out, n = [], 0
+    for p in range(pages):
+        parts = []
+        if p == 0:
+            parts.append(f"MASTER SERVICES AGREEMENT between {terms['vendor']} (\"Vendor\") and "
+                         f"{terms['customer']} (\"Customer\"), contract reference MSA-{seed:05d}.")
+        for _ in range(3):
+            parts.append(f"{n + 1}. " + order[n % len(order)].format(**terms))
+            n += 1
+        if p == pages - 1:
+            parts.append(SIGNATURE.format(**terms))
+        out.append("\n\n".join(parts))
+    return out
+
+def _escape(line: str) -> str:
+    return line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def make_pdf(pages: List[str]) -> bytes:
+    """
+    Minimal PDF (one Helvetica text stream per page) that pypdf extracts text from.
+    """
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None,
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in pages:
+        lines = [l for para in text.split("\n") for l in (textwrap.wrap(para, 95) or [""])]
+        body = "BT /F1 10 Tf 12 TL 50 760 Td " + " ".join(f"({_escape(l)}) Tj T*" for l in lines) + " ET"
+        stream = body.encode("latin-1", "replace")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> "
+                       b"/Contents %d 0 R >>" % len(objects))
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (" ".join(f"{k} 0 R" for k in kids).encode(), len(kids))
+
+    out, offsets = bytearray(b"%PDF-1.4\n"), []
+    for i, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (i, obj)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % o for o in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+def contract_pdf(seed: int, pages: int = 4) -> bytes:
+    return make_pdf(contract_pages(seed, pages))
@@ -1,22 +1,69 @@
-# chunker.py - Text chunking utilities 
+# chunker.py - Text chunking utilities
 # services/chunker.py
-from typing import List, Dict
+from typing import List, Dict, Iterable, Iterator
 import re
+import hashlib
 
-def chunk_text(text: str, chunk_size: int = 1000, overlap: int = 200) -> List[Dict]:
+def chunk_text(text: str, chunk_size: int = 1000, overlap: int = 200, doc_id: str = None) -> List[Dict]:
     """
-    Simple sliding window chunker returning list of dicts: {'id':..., 'text':...}
+    Simple sliding window chunker returning list of dicts:
+    {'id': '<doc_id>:chunk-<n>', 'text', 'doc_id', 'content_hash', 'start', 'end'}
+    Ids are scoped to the document; doc_id defaults to a hash of the text.
+    content_hash lets re-ingests of a revised document skip unchanged chunks.
     """
-    text = re.sub(r'\s+', ' ', text).strip()
-    chunks = []
-    start = 0
+    if doc_id is None:
+        normalized = re.sub(r'\s+', ' ', text).strip()
+        doc_id = "doc-" + hashlib.sha256(normalized.encode()).hexdigest()[:16]
+    return list(iter_chunks([text], chunk_size=chunk_size, overlap=overlap, doc_id=doc_id))
+
+def iter_chunks(pieces: Iterable[str], chunk_size: int = 1000, overlap: int = 200, doc_id: str = "doc") -> Iterator[Dict]:
+    """
+    Streaming version of chunk_text over text pieces (e.g. PDF pages) joined by newlines.
+    Yields the same chunks chunk_text would for the joined text, while only buffering
+    about one window of text.
+    """
+    buf = ""       # normalized text not yet fully consumed
+    base = 0       # global offset of buf[0]
+    start = 0      # global start of the next window
     idx = 0
-    while start < len(text):
-        end = min(len(text), start + chunk_size)
-        chunk_text = text[start:end]
-        chunks.append({"id": f"chunk-{idx}", "text": chunk_text})
+    first = True
+    for piece in pieces:
+        norm = re.sub(r'\s+', ' ', piece if first else "\n" + piece)
+        if first:
+            norm = norm.lstrip()
+            first = not norm
+        if buf.endswith(" ") and norm.startswith(" "):
+            norm = norm[1:]
+        buf += norm
+        # a window is final only if it reaches the end of the text, so only emit windows that
+        # end strictly before the last non-space char seen so far (trailing space may get stripped)
+        while start + chunk_size < base + len(buf) - buf.endswith(" "):
+            end = start + chunk_size
+            yield _make_chunk(doc_id, idx, buf[start - base:end - base], start, end)
+            idx += 1
+            start = max(end - overlap, 0)
+            buf = buf[start - base:]
+            base = start
+
+    buf = buf.rstrip()
+    total = base + len(buf)
+    while start < total:
+        end = min(total, start + chunk_size)
+        yield _make_chunk(doc_id, idx, buf[start - base:end - base], start, end)
         idx += 1
-        start = end - overlap
-        if start < 0:
-            start = 0
-    return chunks
\ No newline at end of file
+        if end == total:
+            break
+        start = max(end - overlap, 0)
+
+def _make_chunk(doc_id: str, idx: int, text: str, start: int, end: int) -> Dict:
+    return {
+        "id": f"{doc_id}:chunk-{idx}",
+        "text": text,
+        "doc_id": doc_id,
+        "content_hash": content_hash(text),
+        "start": start,
+        "end": end,
+    }
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
@@ -0,0 +1,103 @@
+# embedding_cache.py - Content-addressed embedding cache (memory LRU + SQLite)
+# services/embedding_cache.py
+import os, re, hashlib, sqlite3, threading
+from collections import OrderedDict
+from typing import List, Optional, Dict
+import numpy as np
+
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "./storage/embed_cache.db")
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "10000"))
+
+def normalize_text(text: str) -> str:
+    return re.sub(r'\s+', ' ', text).strip()
+
+def cache_key(model: str, text: str) -> str:
+    digest = hashlib.sha256(normalize_text(text).encode()).hexdigest()
+    return f"{model}:{digest}"
+
+class EmbeddingCache:
+    """
+    Two-tier cache keyed on (embedding model, sha256 of normalized text).
+    - memory tier: bounded LRU of float32 vectors
+    - disk tier: SQLite table of float32 blobs, survives restarts (path=None disables it)
+    Thread-safe; embed_batch calls into it from worker threads.
+    """
+    def __init__(self, path: Optional[str] = EMBED_CACHE_PATH, max_items: int = EMBED_CACHE_SIZE):
+        self.path = path
+        self.max_items = max_items
+        self._mem: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+        self._db = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vec BLOB NOT NULL)")
+            self._db.commit()
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        keys = [cache_key(model, t) for t in texts]
+        found: Dict[str, np.ndarray] = {}
+        missing: Dict[str, None] = {}  # ordered set: keeps the batch order for the disk lookup
+        with self._lock:
+            for k in keys:
+                if k in found:
+                    continue
+                vec = self._mem.get(k)
+                if vec is not None:
+                    self._mem.move_to_end(k)
+                    found[k] = vec
+                else:
+                    missing[k] = None
+            if missing and self._db is not None:
+                for k, blob in self._select(list(missing)):
+                    vec = np.frombuffer(blob, dtype="float32")
+                    found[k] = vec
+                    self._remember(k, vec)
+                    self.stats["disk_hits"] += 1
+            out = []
+            for k in keys:
+                vec = found.get(k)
+                if vec is None:
+                    self.stats["misses"] += 1
+                    out.append(None)
+                else:
+                    self.stats["hits"] += 1
+                    out.append(vec.tolist())
+        return out
+
+    def put_many(self, model: str, texts: List[str], vectors: List[List[float]]):
+        rows = []
+        with self._lock:
+            for t, v in zip(texts, vectors):
+                k = cache_key(model, t)
+                vec = np.asarray(v, dtype="float32")
+                self._remember(k, vec)
+                rows.append((k, vec.tobytes()))
+            if self._db is not None and rows:
+                self._db.executemany("INSERT OR REPLACE INTO embeddings (key, vec) VALUES (?, ?)", rows)
+                self._db.commit()
+
+    def _select(self, keys: List[str]):
+        # stay well under SQLite's bound-parameter limit
+        for i in range(0, len(keys), 500):
+            part = keys[i:i + 500]
+            q = "SELECT key, vec FROM embeddings WHERE key IN (%s)" % ",".join("?" * len(part))
+            yield from self._db.execute(q, part)
+
+    def _remember(self, key: str, vec: np.ndarray):
+        self._mem[key] = vec
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_items:
+            self._mem.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def hit_rate(self) -> float:
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total else 0.0
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
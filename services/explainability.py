@@ -1,42 +1,173 @@
-# explainability.py - Explainability helpers (perturbation, provenance) 
+# explainability.py - Explainability helpers (perturbation, provenance)
 # services/explainability.py
-from typing import List, Dict, Any
-import copy
-import math
+from typing import List, Dict, Any, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+import os, time, asyncio, hashlib, threading
 
-def explain_response_perturbation(llm_client, prompt: Dict[str, Any], response: str, retrieved_chunks: List[Dict], top_n: int = 5) -> Dict:
+# Per-request budget for perturbation calls
+EXPLAIN_MAX_CONCURRENCY = int(os.getenv("EXPLAIN_MAX_CONCURRENCY", "4"))
+EXPLAIN_MAX_CALLS = int(os.getenv("EXPLAIN_MAX_CALLS", "6"))
+EXPLAIN_TIME_BUDGET = float(os.getenv("EXPLAIN_TIME_BUDGET", "15"))
+EXPLAIN_CACHE_SIZE = int(os.getenv("EXPLAIN_CACHE_SIZE", "5000"))
+
+class _PerturbationCache:
+    """
+    Bounded LRU of perturbation scores keyed on sha256(prompt text, masked response).
+    The same answer to the same prompt always produces the same perturbation prompts.
+    """
+    def __init__(self, max_items: int = EXPLAIN_CACHE_SIZE):
+        self.max_items = max_items
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(prompt_text: str, masked: str) -> str:
+        return hashlib.sha256(f"{prompt_text}\x00{masked}".encode()).hexdigest()
+
+    def get(self, key: str):
+        with self._lock:
+            if key not in self._data:
+                return None, False
+            self._data.move_to_end(key)
+            return self._data[key], True
+
+    def put(self, key: str, score):
+        with self._lock:
+            self._data[key] = score
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+
+perturbation_cache = _PerturbationCache()
+
+def explain_response_perturbation(llm_client, prompt: Dict[str, Any], response: str, retrieved_chunks: List[Dict], top_n: int = 5,
+                                  base: Optional[Dict] = None, max_concurrency: int = EXPLAIN_MAX_CONCURRENCY,
+                                  max_calls: int = EXPLAIN_MAX_CALLS, time_budget: float = EXPLAIN_TIME_BUDGET) -> Dict:
     """
     Lightweight perturbation-based token importance:
     - Mask tokens in the response and re-run LLM to see change in logprob or semantic similarity.
     - For efficiency, we mask groups of tokens (words) and measure delta in confidence or similarity.
     - Also return provenance: which chunks were cited.
+    Pass `base` (the primary generation) to avoid regenerating it. Perturbations run
+    concurrently (at most `max_concurrency`), capped at `max_calls` LLM calls and
+    `time_budget` seconds; tokens not scored within budget are reported as skipped.
     """
     tokens = response.split()
-    n = len(tokens)
-    if n == 0:
+    plan = _plan(prompt, tokens, top_n)
+    if plan is None:
         return {"token_importance": [], "provenance": [c["id"] for c in retrieved_chunks]}
 
-    # For demo: mask each token and measure whether LLM answer changes (cheap proxy)
-    base = llm_client.generate(prompt, return_logprobs=True)
-    base_text = base["text"]
+    deadline = time.monotonic() + time_budget
+    calls = 0
+    if base is None:
+        base = llm_client.generate(prompt, return_logprobs=True)
+        calls += 1
     base_score = _avg_logprob(base.get("logprobs"))
 
-    importances = []
-    for i in range(min(n, top_n)):
+    scores, todo = _from_cache(plan)
+    cached = len(scores)
+    todo = todo[:max(0, max_calls - calls)]
+    timed_out = False
+    if todo:
+        pool = ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(todo))))
+        futures = {pool.submit(llm_client.generate, p["prompt"], return_logprobs=True): p for p in todo}
+        done, not_done = wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+        for f in not_done:
+            f.cancel()
+        pool.shutdown(wait=False)
+        timed_out = bool(not_done)
+        for f in done:
+            if f.exception() is None:
+                _record(futures[f], f.result(), scores)
+        calls += len(done)
+    return _summarize(plan, scores, base_score, retrieved_chunks, calls, cached, timed_out)
+
+async def explain_response_perturbation_async(llm_client, prompt: Dict[str, Any], response: str, retrieved_chunks: List[Dict], top_n: int = 5,
+                                              base: Optional[Dict] = None, max_concurrency: int = EXPLAIN_MAX_CONCURRENCY,
+                                              max_calls: int = EXPLAIN_MAX_CALLS, time_budget: float = EXPLAIN_TIME_BUDGET) -> Dict:
+    """
+    Same as explain_response_perturbation, for AsyncOpenAIClient.
+    """
+    tokens = response.split()
+    plan = _plan(prompt, tokens, top_n)
+    if plan is None:
+        return {"token_importance": [], "provenance": [c["id"] for c in retrieved_chunks]}
+
+    deadline = time.monotonic() + time_budget
+    calls = 0
+    if base is None:
+        base = await llm_client.generate(prompt, return_logprobs=True)
+        calls += 1
+    base_score = _avg_logprob(base.get("logprobs"))
+
+    scores, todo = _from_cache(plan)
+    cached = len(scores)
+    todo = todo[:max(0, max_calls - calls)]
+    timed_out = False
+    if todo:
+        sem = asyncio.Semaphore(max(1, max_concurrency))
+
+        async def run(p):
+            async with sem:
+                return p, await llm_client.generate(p["prompt"], return_logprobs=True)
+
+        tasks = [asyncio.create_task(run(p)) for p in todo]
+        done, pending = await asyncio.wait(tasks, timeout=max(0.0, deadline - time.monotonic()))
+        for t in pending:
+            t.cancel()
+        timed_out = bool(pending)
+        for t in done:
+            if not t.cancelled() and t.exception() is None:
+                p, pert = t.result()
+                _record(p, pert, scores)
+        calls += len(done)
+    return _summarize(plan, scores, base_score, retrieved_chunks, calls, cached, timed_out)
+
+def _plan(prompt: Dict[str, Any], tokens: List[str], top_n: int):
+    if not tokens:
+        return None
+    plan = []
+    for i in range(min(len(tokens), top_n)):
         masked_tokens = tokens.copy()
         masked_tokens[i] = "[MASK]"
         masked_resp_text = " ".join(masked_tokens)
         # Build a new prompt that asks model to score similarity (cheap approach)
         pert_prompt = {"template_id": prompt["template_id"], "text": prompt["text"] + f"\n\nEVALUATE: Is the following paraphrase equivalent? \"{masked_resp_text}\""}
-        pert = llm_client.generate(pert_prompt, return_logprobs=True)
-        pert_score = _avg_logprob(pert.get("logprobs"))
+        plan.append({"index": i, "token": tokens[i], "prompt": pert_prompt,
+                     "key": perturbation_cache.key(prompt["text"], masked_resp_text)})
+    return plan
+
+def _from_cache(plan: List[Dict]):
+    scores, todo = {}, []
+    for p in plan:
+        score, hit = perturbation_cache.get(p["key"])
+        if hit:
+            scores[p["index"]] = score
+        else:
+            todo.append(p)
+    return scores, todo
+
+def _record(p: Dict, pert: Dict, scores: Dict):
+    score = _avg_logprob(pert.get("logprobs"))
+    perturbation_cache.put(p["key"], score)
+    scores[p["index"]] = score
+
+def _summarize(plan, scores, base_score, retrieved_chunks, calls, cached, timed_out) -> Dict:
+    importances = []
+    for p in plan:
+        if p["index"] not in scores:
+            continue
+        pert_score = scores[p["index"]]
         delta = base_score - pert_score if base_score is not None and pert_score is not None else 0.0
-        importances.append({"token": tokens[i], "delta": delta})
+        importances.append({"token": p["token"], "delta": delta})
 
     # Sort by delta descending
     importances = sorted(importances, key=lambda x: -x["delta"])
     provenance = [c["id"] for c in retrieved_chunks]
-    return {"token_importance": importances, "provenance": provenance}
+    budget = {"llm_calls": calls, "cache_hits": cached, "scored": len(scores),
+              "skipped": len(plan) - len(scores), "timed_out": timed_out}
+    return {"token_importance": importances, "provenance": provenance, "budget": budget}
 
 def _avg_logprob(logprobs_obj):
     if not logprobs_obj:
@@ -48,4 +179,4 @@ def _avg_logprob(logprobs_obj):
             return None
         return sum(toks) / len(toks)
     except Exception:
-        return None
\ No newline at end of file
+        return None
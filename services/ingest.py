@@ -0,0 +1,155 @@
+# ingest.py - Streaming PDF ingest pipeline and job tracking
+# services/ingest.py
+import os, time, uuid, asyncio, logging, tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional
+from services.pdf_ingest import iter_pdf_pages, count_pages
+from services.chunker import iter_chunks
+from services.telemetry import span
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+INGEST_PAGES_PER_TASK = int(os.getenv("INGEST_PAGES_PER_TASK", "8"))
+# chunks embedded and indexed per step; bounds memory for very large files
+INGEST_BATCH_CHUNKS = int(os.getenv("INGEST_BATCH_CHUNKS", "64"))
+INGEST_SPOOL_DIR = os.getenv("INGEST_SPOOL_DIR") or None
+MAX_TRACKED_JOBS = 1000
+
+logger = logging.getLogger(__name__)
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+def page_pool() -> Optional[ProcessPoolExecutor]:
+    # one process pool per API worker, created on first ingest; INGEST_WORKERS=0 extracts inline
+    global _pool
+    if _pool is None and INGEST_WORKERS > 0:
+        _pool = ProcessPoolExecutor(max_workers=INGEST_WORKERS)
+    return _pool
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+class IngestJob:
+    def __init__(self, doc_id: str, filename: str):
+        self.job_id = uuid.uuid4().hex
+        self.doc_id = doc_id
+        self.filename = filename
+        self.status = "queued"
+        self.total_pages = None
+        self.pages_done = 0
+        self.chunks_done = 0
+        self.result = None
+        self.timings = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def to_dict(self) -> Dict:
+        return {
+            "job_id": self.job_id,
+            "doc_id": self.doc_id,
+            "filename": self.filename,
+            "status": self.status,
+            "total_pages": self.total_pages,
+            "pages_done": self.pages_done,
+            "chunks_done": self.chunks_done,
+            "result": self.result,
+            "timings": self.timings,
+            "error": self.error,
+            "created": self.created,
+            "finished": self.finished,
+        }
+
+class JobRegistry:
+    """
+    In-process job table for the async ingest endpoint (per API worker; oldest jobs are forgotten).
+    """
+    def __init__(self, max_jobs: int = MAX_TRACKED_JOBS):
+        self.max_jobs = max_jobs
+        self._jobs: "OrderedDict[str, IngestJob]" = OrderedDict()
+
+    def create(self, doc_id: str, filename: str) -> IngestJob:
+        job = IngestJob(doc_id, filename)
+        self._jobs[job.job_id] = job
+        while len(self._jobs) > self.max_jobs:
+            self._jobs.popitem(last=False)
+        return job
+
+    def get(self, job_id: str) -> Optional[IngestJob]:
+        return self._jobs.get(job_id)
+
+async def spool_upload(upload, chunk_bytes: int = 1 << 20) -> str:
+    """
+    Copy an UploadFile to a temp file on disk without reading it into memory at once.
+    """
+    fd, path = tempfile.mkstemp(suffix=".pdf", dir=INGEST_SPOOL_DIR)
+    with os.fdopen(fd, "wb") as out:
+        while True:
+            data = await upload.read(chunk_bytes)
+            if not data:
+                break
+            out.write(data)
+    return path
+
+def _take(it, n):
+    batch = []
+    for item in it:
+        batch.append(item)
+        if len(batch) >= n:
+            break
+    return batch
+
+async def ingest_pdf_file(path: str, doc_id: str, llm, vectorstore, job: Optional[IngestJob] = None) -> Dict:
+    """
+    Stream a spooled PDF into the vector store: pages are extracted in the process pool,
+    chunked by a generator and embedded/indexed INGEST_BATCH_CHUNKS at a time, so
+    memory stays bounded and chunks become searchable as they are indexed.
+    """
+    job = job or IngestJob(doc_id, os.path.basename(path))
+    job.status = "running"
+    upsert = None
+    try:
+        with span("count_pages"):
+            job.total_pages = await asyncio.to_thread(count_pages, path)
+
+        def on_page(n):
+            job.pages_done = n + 1
+
+        pages = (text for _, text in iter_pdf_pages(path, executor=page_pool(), pages_per_task=INGEST_PAGES_PER_TASK,
+                                                     on_page=on_page))
+        chunks = iter_chunks(pages, doc_id=doc_id)
+        upsert = await asyncio.to_thread(vectorstore.begin_upsert, doc_id)
+        while True:
+            # the generators block on extraction, so pull each batch in a worker thread
+            with span("extract_chunk"):
+                batch = await asyncio.to_thread(_take, chunks, INGEST_BATCH_CHUNKS)
+            if not batch:
+                break
+            # MinHash signatures and LSH lookups for near-duplicate detection: off the loop as well
+            fresh = await asyncio.to_thread(upsert.changed, batch)
+            with span("embed"):
+                embeddings = await llm.embed_batch([c["text"] for c in fresh])
+            vectors = {c["content_hash"]: e for c, e in zip(fresh, embeddings)}
+            with span("index"):
+                await asyncio.to_thread(upsert.add, batch, vectors)
+            job.chunks_done += len(batch)
+        with span("finish"):
+            job.result = await asyncio.to_thread(upsert.finish)
+        job.status = "done"
+        return {"chunks_indexed": job.chunks_done, "pages": job.total_pages, **job.result}
+    except Exception as e:
+        job.status = "failed"
+        job.error = str(e)
+        logger.exception("Ingest of %s failed", doc_id)
+        if upsert is not None:
+            # chunks indexed before the failure must not stay live next to the previous version
+            try:
+                await asyncio.to_thread(upsert.abort)
+            except Exception:
+                logger.exception("Rolling back the partial ingest of %s failed", doc_id)
+        raise
+    finally:
+        job.finished = time.time()
@@ -1,43 +1,289 @@
 # services/llm_client.py (excerpt)
-import os, time, logging
+import os, time, random, asyncio, logging
 import openai
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, AsyncIterator
+from services.tokenizer import count_tokens
+from services.embedding_cache import EmbeddingCache, normalize_text
+from services.llm_providers import LLMProvider, make_provider
+from services.telemetry import TELEMETRY_ENABLED, record_retry, record_tokens
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
 MODEL = os.getenv("OPENAI_MODEL", "gpt-5-nano")
 EMBED_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-large")
+# "openai" (remote) or "local" (in-process sentence-transformers, no network)
+EMBED_BACKEND = os.getenv("EMBEDDING_BACKEND", "openai")
+LOCAL_EMBED_MODEL = os.getenv("LOCAL_EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+# Per-request caps for batched embedding calls
+EMBED_BATCH_MAX_TOKENS = int(os.getenv("EMBED_BATCH_MAX_TOKENS", "8000"))
+EMBED_BATCH_MAX_ITEMS = int(os.getenv("EMBED_BATCH_MAX_ITEMS", "256"))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+# Async client: max in-flight provider calls per process, and per-call timeout (seconds)
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+SYSTEM_PROMPT = os.getenv(
+    "SYSTEM_PROMPT",
+    "You are ContractMiner, an assistant that answers questions about contracts using only the supplied context."
+)
+
+logger = logging.getLogger(__name__)
+
+_local_models = {}
+
+def _load_local_model(name: str):
+    # sentence-transformers is heavy; import and load lazily, once per process
+    if name not in _local_models:
+        from sentence_transformers import SentenceTransformer
+        _local_models[name] = SentenceTransformer(name)
+    return _local_models[name]
+
+def _completion_to_dict(completion: Dict, model: str) -> Dict:
+    return {"text": completion["text"].strip(), "model": model, "logprobs": completion["logprobs"]}
+
+def _merge_logprobs(acc, part: Dict) -> Dict:
+    # streamed completions carry logprobs per chunk; concatenate the per-token lists
+    if acc is None:
+        return {k: list(v) if isinstance(v, list) else v for k, v in part.items()}
+    for k, v in part.items():
+        if isinstance(v, list):
+            acc[k] = (acc.get(k) or []) + v
+    return acc
 
 class OpenAIClient:
-    def __init__(self, max_retries: int = 3, backoff: float = 1.0):
-        self.model = MODEL
-        self.embed_model = EMBED_MODEL
+    def __init__(self, max_retries: int = 3, backoff: float = 1.0, embed_backend: str = None,
+                 batch_max_tokens: int = EMBED_BATCH_MAX_TOKENS, batch_max_items: int = EMBED_BATCH_MAX_ITEMS,
+                 embed_concurrency: int = EMBED_CONCURRENCY, cache: EmbeddingCache = None,
+                 provider: LLMProvider = None):
+        # raw model calls (LLM_PROVIDER: OpenAI, or the deterministic fake for offline runs)
+        self.provider = provider or make_provider()
+        self.model = self.provider.completion_model(MODEL)
+        self.embed_backend = embed_backend or EMBED_BACKEND
+        self.embed_model = LOCAL_EMBED_MODEL if self.embed_backend == "local" else self.provider.embedding_model(EMBED_MODEL)
         self.max_retries = max_retries
         self.backoff = backoff
+        self.batch_max_tokens = batch_max_tokens
+        self.batch_max_items = batch_max_items
+        self.embed_concurrency = max(1, embed_concurrency)
+        self.cache = cache
+
+    def system_prompt(self) -> str:
+        return SYSTEM_PROMPT
 
     def embed_text(self, text: str) -> List[float]:
-        # batch small texts if needed; simple single-call with retry
+        return self.embed_batch([text])[0]
+
+    def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed many texts with as few round trips as possible.
+        Texts are packed into requests capped by token count and item count,
+        and up to `embed_concurrency` requests are in flight at once.
+        Output order matches input order. With a cache attached only misses
+        are sent, and repeated texts within one call are embedded once.
+        """
+        if not texts:
+            return []
+        results, todo = self._cache_lookup(texts)
+        if todo:
+            results = self._cache_fill(texts, results, todo, self._embed_uncached(list(todo.values())))
+        return results
+
+    def _cache_lookup(self, texts: List[str]):
+        # returns (cached vector or None per text, {normalized text: first raw occurrence} still to embed)
+        if self.cache is None:
+            results = [None] * len(texts)
+        else:
+            results = self.cache.get_many(self.embed_model, texts)
+        todo = {}
+        for t, r in zip(texts, results):
+            if r is None:
+                todo.setdefault(normalize_text(t), t)
+        return results, todo
+
+    def _cache_fill(self, texts, results, todo, vectors):
+        if self.cache is not None:
+            self.cache.put_many(self.embed_model, list(todo.values()), vectors)
+        fresh = dict(zip(todo.keys(), vectors))
+        return [fresh[normalize_text(t)] if r is None else r for t, r in zip(texts, results)]
+
+    def _embed_uncached(self, texts: List[str]) -> List[List[float]]:
+        if self.embed_backend == "local":
+            return self._encode_local(texts)
+
+        batches = self._plan_batches(texts)
+        if len(batches) == 1:
+            done = [self._embed_request([texts[i] for i in batches[0]])]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.embed_concurrency, len(batches))) as pool:
+                done = list(pool.map(lambda b: self._embed_request([texts[i] for i in b]), batches))
+        return self._unbatch(len(texts), batches, done)
+
+    def _unbatch(self, n: int, batches: List[List[int]], done: List[List[List[float]]]) -> List[List[float]]:
+        results: List[List[float]] = [None] * n
+        for batch, vectors in zip(batches, done):
+            for i, vec in zip(batch, vectors):
+                results[i] = vec
+        return results
+
+    def _encode_local(self, texts: List[str]) -> List[List[float]]:
+        model = _load_local_model(self.embed_model)
+        return model.encode(list(texts), batch_size=64, convert_to_numpy=True).tolist()
+
+    def _plan_batches(self, texts: List[str]) -> List[List[int]]:
+        # Greedy packing of input positions; a single oversized text gets its own request
+        batches, current, current_tokens = [], [], 0
+        for i, t in enumerate(texts):
+            n = count_tokens(t)
+            if current and (current_tokens + n > self.batch_max_tokens or len(current) >= self.batch_max_items):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(i)
+            current_tokens += n
+        if current:
+            batches.append(current)
+        return batches
+
+    def _backoff_delay(self, attempt: int) -> float:
+        # exponential backoff with full jitter so retrying callers do not stampede together
+        return random.uniform(0, self.backoff * (2 ** attempt))
+
+    def _embed_request(self, inputs: List[str]) -> List[List[float]]:
         for attempt in range(self.max_retries):
             try:
-                resp = openai.Embedding.create(model=self.embed_model, input=text)
-                return resp["data"][0]["embedding"]
+                return self.provider.embed(self.embed_model, inputs)
             except Exception as e:
-                time.sleep(self.backoff * (2 ** attempt))
+                logger.warning("Embedding batch failed (attempt %d): %s", attempt + 1, e)
+                if attempt + 1 < self.max_retries:
+                    record_retry("embed")
+                    time.sleep(self._backoff_delay(attempt))
         raise RuntimeError("Embedding call failed after retries")
 
     def generate(self, prompt: Dict[str, str], return_logprobs: bool = False) -> Dict:
         for attempt in range(self.max_retries):
             try:
-                completion = openai.Completion.create(
-                    model=self.model,
-                    prompt=prompt["text"],
-                    max_tokens=512,
-                    temperature=0.0,
-                    top_p=1.0,
-                    logprobs=5 if return_logprobs else None
-                )
-                text = completion["choices"][0]["text"].strip()
-                logprobs = completion["choices"][0].get("logprobs")
-                return {"text": text, "model": self.model, "logprobs": logprobs}
+                completion = self.provider.complete(self.model, prompt["text"], max_tokens=512,
+                                                    logprobs=5 if return_logprobs else None)
+                return _completion_to_dict(completion, self.model)
             except Exception as e:
-                time.sleep(self.backoff * (2 ** attempt))
-        raise RuntimeError("LLM generate failed after retries")
\ No newline at end of file
+                logger.warning("LLM generate failed (attempt %d): %s", attempt + 1, e)
+                if attempt + 1 < self.max_retries:
+                    record_retry("generate")
+                    time.sleep(self._backoff_delay(attempt))
+        raise RuntimeError("LLM generate failed after retries")
+
+class AsyncOpenAIClient(OpenAIClient):
+    """
+    asyncio flavour of OpenAIClient for the API layer.
+    - one pooled provider connection (HTTP keep-alive) shared by all requests
+    - at most `max_concurrency` provider calls in flight per process
+    - per-call timeout and non-blocking jittered backoff between retries
+    Batch planning, caching and local embedding are shared with the sync client.
+    """
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, timeout: float = LLM_TIMEOUT,
+                 provider: LLMProvider = None, **kwargs):
+        super().__init__(provider=provider or make_provider(timeout=timeout), **kwargs)
+        self.max_concurrency = max(1, max_concurrency)
+        self.timeout = timeout
+        self._loop = None
+        self._sem = None
+
+    def _bind(self):
+        # the semaphore belongs to one event loop; rebind if it changed (e.g. in tests)
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._sem = asyncio.Semaphore(self.max_concurrency)
+
+    async def _call(self, what: str, operation: str, fn, *args):
+        self._bind()
+        for attempt in range(self.max_retries):
+            try:
+                async with self._sem:
+                    return await asyncio.wait_for(fn(*args), timeout=self.timeout)
+            except Exception as e:
+                logger.warning("%s failed (attempt %d): %s", what, attempt + 1, e)
+                if attempt + 1 < self.max_retries:
+                    record_retry(operation)
+                    await asyncio.sleep(self._backoff_delay(attempt))
+        raise RuntimeError(f"{what} failed after retries")
+
+    async def embed_text(self, text: str) -> List[float]:
+        return (await self.embed_batch([text]))[0]
+
+    async def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        # the cache reads and commits SQLite under a lock that ingest threads also take
+        results, todo = await asyncio.to_thread(self._cache_lookup, texts)
+        if todo:
+            vectors = await self._embed_uncached_async(list(todo.values()))
+            results = await asyncio.to_thread(self._cache_fill, texts, results, todo, vectors)
+        return results
+
+    async def _embed_uncached_async(self, texts: List[str]) -> List[List[float]]:
+        if self.embed_backend == "local":
+            return await asyncio.to_thread(self._encode_local, texts)
+        batches = self._plan_batches(texts)
+        done = await asyncio.gather(*[
+            self._call("Embedding batch", "embed", self._embed_request_async, [texts[i] for i in b]) for b in batches
+        ])
+        return self._unbatch(len(texts), batches, done)
+
+    async def _embed_request_async(self, inputs: List[str]) -> List[List[float]]:
+        return await self.provider.aembed(self.embed_model, inputs)
+
+    async def generate(self, prompt: Dict[str, str], return_logprobs: bool = False) -> Dict:
+        return await self._call("LLM generate", "generate", self._generate_request, prompt, return_logprobs)
+
+    async def _generate_request(self, prompt: Dict[str, str], return_logprobs: bool) -> Dict:
+        completion = await self.provider.acomplete(self.model, prompt["text"], max_tokens=512,
+                                                   logprobs=5 if return_logprobs else None)
+        return _completion_to_dict(completion, self.model)
+
+    async def generate_stream(self, prompt: Dict[str, str], return_logprobs: bool = False) -> AsyncIterator[Dict]:
+        """
+        Stream a completion: yields {"type": "delta", "text": ...} as the provider emits tokens,
+        then one {"type": "final", "response": <same dict generate() returns>}.
+        Connecting is retried like generate(); once tokens have been yielded a failure is raised
+        to the caller. `timeout` bounds the wait for each chunk, not the whole stream.
+        """
+        self._bind()
+        async with self._sem:
+            stream = None
+            for attempt in range(self.max_retries):
+                try:
+                    stream = await asyncio.wait_for(self.provider.open_stream(
+                        self.model, prompt["text"], max_tokens=512, logprobs=5 if return_logprobs else None
+                    ), timeout=self.timeout)
+                    break
+                except Exception as e:
+                    logger.warning("LLM stream failed (attempt %d): %s", attempt + 1, e)
+                    if attempt + 1 < self.max_retries:
+                        record_retry("stream")
+                        await asyncio.sleep(self._backoff_delay(attempt))
+            if stream is None:
+                raise RuntimeError("LLM stream failed after retries")
+
+            parts, logprobs = [], None
+            it = stream.__aiter__()
+            while True:
+                try:
+                    part = await asyncio.wait_for(it.__anext__(), timeout=self.timeout)
+                except StopAsyncIteration:
+                    break
+                if part["logprobs"] is not None:
+                    logprobs = _merge_logprobs(logprobs, part["logprobs"])
+                if part["text"]:
+                    # leading whitespace is dropped like generate() strips it
+                    text = part["text"] if parts else part["text"].lstrip()
+                    if text:
+                        parts.append(text)
+                        yield {"type": "delta", "text": text}
+        text = "".join(parts).rstrip()
+        if TELEMETRY_ENABLED:
+            # streamed completions carry no usage block; count locally
+            record_tokens("stream", count_tokens(prompt["text"]), count_tokens(text))
+        yield {"type": "final", "response": {"text": text, "model": self.model, "logprobs": logprobs}}
+
+    async def aclose(self):
+        await self.provider.aclose()
+        self._loop = None
@@ -0,0 +1,246 @@
+# llm_providers.py - Model provider backends behind OpenAIClient (OpenAI, deterministic fake)
+# services/llm_providers.py
+import os, re, time, asyncio, hashlib
+import numpy as np
+import openai
+from functools import lru_cache
+from typing import List, Dict, Optional, AsyncIterator
+from services.tokenizer import count_tokens
+from services.telemetry import TELEMETRY_ENABLED, record_tokens
+
+# "openai" or "fake" (deterministic local stand-ins for offline tests and benchmarks)
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "openai")
+FAKE_EMBED_DIM = int(os.getenv("FAKE_EMBED_DIM", "256"))
+# simulated provider latency: per embedding request, per completion call, per generated token
+FAKE_EMBED_LATENCY_MS = float(os.getenv("FAKE_EMBED_LATENCY_MS", "0"))
+FAKE_LLM_LATENCY_MS = float(os.getenv("FAKE_LLM_LATENCY_MS", "0"))
+FAKE_LLM_TOKEN_LATENCY_MS = float(os.getenv("FAKE_LLM_TOKEN_LATENCY_MS", "0"))
+# 0 = completions come back without logprobs, like providers that do not expose them
+FAKE_LLM_LOGPROBS = os.getenv("FAKE_LLM_LOGPROBS", "1") == "1"
+
+class LLMProvider:
+    """
+    Raw model calls. OpenAIClient keeps batching, caching, retries and the concurrency cap,
+    and talks to the provider only through these methods. Completions come back as
+    {"text", "logprobs"} with logprobs in the OpenAI completions layout (or None).
+    """
+    name = "base"
+
+    def completion_model(self, model: str) -> str:
+        return model
+
+    def embedding_model(self, model: str) -> str:
+        # also the embedding cache namespace, so backends must not share names
+        return model
+
+    def embed(self, model: str, inputs: List[str]) -> List[List[float]]:
+        raise NotImplementedError
+
+    def complete(self, model: str, prompt: str, max_tokens: int, logprobs: Optional[int]) -> Dict:
+        raise NotImplementedError
+
+    async def aembed(self, model: str, inputs: List[str]) -> List[List[float]]:
+        raise NotImplementedError
+
+    async def acomplete(self, model: str, prompt: str, max_tokens: int, logprobs: Optional[int]) -> Dict:
+        raise NotImplementedError
+
+    async def open_stream(self, model: str, prompt: str, max_tokens: int, logprobs: Optional[int]) -> AsyncIterator[Dict]:
+        """
+        Connect and return an iterator of {"text", "logprobs"} parts; awaiting this is the
+        step the client retries, iterating is not.
+        """
+        raise NotImplementedError
+
+    async def aclose(self):
+        pass
+
+class OpenAIProvider(LLMProvider):
+    name = "openai"
+
+    def __init__(self, timeout: Optional[float] = None):
+        self.timeout = timeout
+        self._client = None
+        self._loop = None
+
+    def _http(self):
+        # the pooled HTTP client belongs to one event loop; rebuild if it changed (e.g. in tests)
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            self._loop = loop
+            self._client = openai.AsyncOpenAI(api_key=openai.api_key, timeout=self.timeout, max_retries=0)
+        return self._client
+
+    def embed(self, model, inputs):
+        return _embeddings(openai.embeddings.create(model=model, input=inputs))
+
+    def complete(self, model, prompt, max_tokens, logprobs):
+        return _completion(openai.completions.create(model=model, prompt=prompt, max_tokens=max_tokens,
+                                                     temperature=0.0, top_p=1.0, logprobs=logprobs))
+
+    async def aembed(self, model, inputs):
+        return _embeddings(await self._http().embeddings.create(model=model, input=inputs))
+
+    async def acomplete(self, model, prompt, max_tokens, logprobs):
+        return _completion(await self._http().completions.create(model=model, prompt=prompt, max_tokens=max_tokens,
+                                                                 temperature=0.0, top_p=1.0, logprobs=logprobs))
+
+    async def open_stream(self, model, prompt, max_tokens, logprobs):
+        stream = await self._http().completions.create(model=model, prompt=prompt, max_tokens=max_tokens,
+                                                       temperature=0.0, top_p=1.0, logprobs=logprobs, stream=True)
+        return self._stream_parts(stream)
+
+    async def _stream_parts(self, stream):
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            yield {"text": choice.text or "",
+                   "logprobs": choice.logprobs.model_dump() if choice.logprobs is not None else None}
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.close()
+        self._client = None
+        self._loop = None
+
+def _embeddings(resp) -> List[List[float]]:
+    usage = getattr(resp, "usage", None)
+    if usage is not None:
+        record_tokens("embed", usage.prompt_tokens or 0)
+    # provider may return items out of order; index refers to input position
+    return [d.embedding for d in sorted(resp.data, key=lambda d: d.index)]
+
+def _completion(completion) -> Dict:
+    usage = getattr(completion, "usage", None)
+    if usage is not None:
+        record_tokens("generate", usage.prompt_tokens or 0, usage.completion_tokens or 0)
+    choice = completion.choices[0]
+    return {"text": choice.text, "logprobs": choice.logprobs.model_dump() if choice.logprobs is not None else None}
+
+_WORD = re.compile(r"[a-z0-9]+")
+# ignored when matching a question against context sentences
+_STOPWORDS = frozenset("a an and are be by can do does for how in is it must of on or the this to what when "
+                       "which who with".split())
+
+def _words(text: str) -> List[str]:
+    return _WORD.findall(text.lower())
+
+@lru_cache(maxsize=65536)
+def _feature(token: str) -> int:
+    return int.from_bytes(hashlib.blake2b(token.encode(), digest_size=8).digest(), "little")
+
+class FakeProvider(LLMProvider):
+    """
+    Deterministic stand-in for offline tests and benchmarks; no network, same output for
+    the same input in every process.
+    - embeddings: hashed bag of words and word bigrams, L2-normalized, so texts sharing
+      terms are close and retrieval behaves plausibly
+    - completions: the context sentence sharing most words with the question (or
+      'Insufficient context.'), with logprobs that drop as that overlap shrinks, so
+      confidence and perturbation explanations respond to the prompt
+    Latency is simulated per call and per generated token.
+    """
+    name = "fake"
+
+    def __init__(self, dim: int = FAKE_EMBED_DIM, embed_latency_ms: float = FAKE_EMBED_LATENCY_MS,
+                 latency_ms: float = FAKE_LLM_LATENCY_MS, token_latency_ms: float = FAKE_LLM_TOKEN_LATENCY_MS,
+                 logprobs: bool = FAKE_LLM_LOGPROBS):
+        self.dim = dim
+        self.embed_latency = embed_latency_ms / 1000
+        self.latency = latency_ms / 1000
+        self.token_latency = token_latency_ms / 1000
+        self.logprobs = logprobs
+
+    def completion_model(self, model):
+        return f"fake/{model}"
+
+    def embedding_model(self, model):
+        return f"fake/{model}/{self.dim}"
+
+    def embed_one(self, text: str) -> List[float]:
+        words = _words(text)
+        vec = np.zeros(self.dim, dtype="float32")
+        for feats, weight in ((words, 1.0), ([a + " " + b for a, b in zip(words, words[1:])], 0.5)):
+            for f in feats:
+                h = _feature(f)
+                vec[h % self.dim] += weight if (h >> 32) & 1 else -weight
+        norm = np.linalg.norm(vec)
+        if norm == 0:
+            vec[_feature(text) % self.dim] = 1.0
+            norm = 1.0
+        return (vec / norm).tolist()
+
+    def _embed(self, inputs):
+        if TELEMETRY_ENABLED:
+            record_tokens("embed", sum(count_tokens(t) for t in inputs))
+        return [self.embed_one(t) for t in inputs]
+
+    def answer(self, prompt: str, max_tokens: int) -> Dict:
+        """
+        The completion for `prompt` as {"text", "logprobs"} (tokens carry their leading space).
+        """
+        context, _, question = prompt.rpartition("USER QUESTION:")
+        context = context.partition("CONTEXT:")[2] or context or prompt
+        question = set(_words(question.split("\n\n")[0] if question else prompt)) - _STOPWORDS
+        best, overlap = "", 0
+        for sentence in re.split(r"(?<=[.;:])\s+", context):
+            n = len(question & set(_words(sentence)))
+            if n > overlap:
+                best, overlap = sentence, n
+        words = best.split()[:max_tokens] if overlap else ["Insufficient", "context."]
+        tokens = [" " + w for w in words]
+        support = overlap / max(len(question), 1)
+        token_logprobs = [-0.05 - 0.6 * (1 - support) - (_feature(t) % 100) / 400 for t in tokens]
+        offsets = np.cumsum([len(prompt)] + [len(t) for t in tokens[:-1]]).tolist()
+        logprobs = {"tokens": tokens, "token_logprobs": token_logprobs,
+                    "top_logprobs": [{t: lp} for t, lp in zip(tokens, token_logprobs)], "text_offset": offsets}
+        return {"text": "".join(tokens), "logprobs": logprobs}
+
+    def _complete(self, prompt, max_tokens, logprobs):
+        out = self.answer(prompt, max_tokens)
+        if TELEMETRY_ENABLED:
+            record_tokens("generate", count_tokens(prompt), len(out["logprobs"]["tokens"]))
+        if not (logprobs and self.logprobs):
+            out["logprobs"] = None
+        return out
+
+    def _call_seconds(self, out) -> float:
+        return self.latency + self.token_latency * len(out["text"].split())
+
+    def embed(self, model, inputs):
+        time.sleep(self.embed_latency)
+        return self._embed(inputs)
+
+    def complete(self, model, prompt, max_tokens, logprobs):
+        out = self._complete(prompt, max_tokens, logprobs)
+        time.sleep(self._call_seconds(out))
+        return out
+
+    async def aembed(self, model, inputs):
+        await asyncio.sleep(self.embed_latency)
+        return self._embed(inputs)
+
+    async def acomplete(self, model, prompt, max_tokens, logprobs):
+        out = self._complete(prompt, max_tokens, logprobs)
+        await asyncio.sleep(self._call_seconds(out))
+        return out
+
+    async def open_stream(self, model, prompt, max_tokens, logprobs):
+        await asyncio.sleep(self.latency)
+        return self._stream_parts(self.answer(prompt, max_tokens), bool(logprobs and self.logprobs))
+
+    async def _stream_parts(self, out, with_logprobs):
+        lp = out["logprobs"]
+        for i, tok in enumerate(lp["tokens"]):
+            await asyncio.sleep(self.token_latency)
+            part = {k: [v[i]] for k, v in lp.items()} if with_logprobs else None
+            yield {"text": tok, "logprobs": part}
+
+def make_provider(name: Optional[str] = None, timeout: Optional[float] = None) -> LLMProvider:
+    name = (name or LLM_PROVIDER).lower()
+    if name == "openai":
+        return OpenAIProvider(timeout=timeout)
+    if name == "fake":
+        return FakeProvider()
+    raise ValueError(f"Unknown LLM provider {name!r}; expected 'openai' or 'fake'")
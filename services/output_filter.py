@@ -1,25 +1,89 @@
 # output_filter.py - PII redaction and policy filters 
 # services/output_filter.py
-import re
-from typing import Tuple, Dict
+from typing import Tuple, Dict, List
+from services.trust_scanner import DEFAULT_RULES, default_scanner
 
-PII_PATTERNS = {
-    "email": r'\b[\w\.-]+@[\w\.-]+\.\w+\b',
-    "ssn": r'\b\d{3}-\d{2}-\d{4}\b',
-    "phone": r'\b(?:\+?\d{1,3})?[-.\s]?(?:\d{2,4}[-.\s]?){2,4}\d{2,4}\b'
-}
+PII_PATTERNS = {r["name"]: r["pattern"] for r in DEFAULT_RULES if r["kind"] == "pii"}
+# Example policy: long confidential dumps are blocked
+POLICY_KEYWORD = "confidential"
+POLICY_MAX_CHARS = 1000
 
 def filter_output_and_redact(text: str) -> Tuple[str, Dict]:
-    redactions = []
-    filtered = text
-    for label, pat in PII_PATTERNS.items():
-        matches = re.findall(pat, filtered)
-        if matches:
-            redactions.append({"type": label, "matches": matches})
-            filtered = re.sub(pat, f"[REDACTED_{label.upper()}]", filtered)
+    # all PII types are found and replaced in a single pass over the original text
+    filtered, matches = default_scanner().redact(text, kinds=("pii",))
+    redactions = group_redactions(matches)
     # Policy checks (example)
-    if "confidential" in filtered.lower() and len(filtered) > 1000:
-        # Example policy: long confidential dumps are blocked
+    if POLICY_KEYWORD in filtered.lower() and len(filtered) > POLICY_MAX_CHARS:
         filtered = "[REDACTED_FOR_POLICY]"
         redactions.append({"type":"policy_block", "reason":"long confidential content"})
-    return filtered, {"redactions": redactions}
\ No newline at end of file
+    return filtered, {"redactions": redactions}
+
+class StreamingOutputFilter:
+    """
+    filter_output_and_redact for a token stream. feed() returns the redacted text that is safe
+    to send now; finish() returns the remainder. PII matches crossing chunk boundaries are
+    caught by the scanner's hold-back buffer. For the policy check, output is held from the
+    point the keyword appears; if the response then grows past POLICY_MAX_CHARS it is blocked
+    (`blocked` is set and nothing further is sent). Text sent before the keyword appeared is
+    already with the client: `sent_chars` says how much, and the caller must retract it (the
+    /query_stream "policy" event) so the client ends up where filter_output_and_redact would.
+    """
+    def __init__(self, holdback: int = None):
+        kwargs = {} if holdback is None else {"holdback": holdback}
+        self._redactor = default_scanner().stream_redactor(kinds=("pii",), **kwargs)
+        self._tail = ""       # last chars sent, to spot the keyword across chunk boundaries
+        self._held = []       # redacted text held once the keyword has appeared
+        self._length = 0
+        self.sent_chars = 0   # redacted text returned by feed()/finish() so far
+        self.suspect = False
+        self.blocked = False
+
+    def feed(self, delta: str) -> str:
+        if self.blocked:
+            return ""
+        return self._sent(self._check(self._redactor.feed(delta)))
+
+    def finish(self) -> str:
+        if self.blocked:
+            return ""
+        out = self._check(self._redactor.finish())
+        if self.suspect and not self.blocked:
+            out += "".join(self._held)
+            self._held = []
+        return self._sent(out)
+
+    def _sent(self, text: str) -> str:
+        self.sent_chars += len(text)
+        return text
+
+    def _check(self, text: str) -> str:
+        self._length += len(text)
+        if not self.suspect:
+            window = (self._tail + text).lower()
+            if POLICY_KEYWORD not in window:
+                self._tail = window[-len(POLICY_KEYWORD):]
+                return text
+            self.suspect = True
+            # send up to the keyword, hold from there
+            cut = max(0, window.index(POLICY_KEYWORD) - len(self._tail))
+            self._held.append(text[cut:])
+            text = text[:cut]
+        else:
+            self._held.append(text)
+            text = ""
+        if self._length > POLICY_MAX_CHARS:
+            self.blocked = True
+            self._held = []
+        return text
+
+    def meta(self) -> Dict:
+        redactions = group_redactions(self._redactor.matches)
+        if self.blocked:
+            redactions.append({"type":"policy_block", "reason":"long confidential content"})
+        return {"redactions": redactions}
+
+def group_redactions(matches: List[Dict]) -> List[Dict]:
+    by_type = {}
+    for m in matches:
+        by_type.setdefault(m["rule"], []).append(m["text"])
+    return [{"type": label, "matches": found} for label, found in by_type.items()]
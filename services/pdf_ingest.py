@@ -1,7 +1,9 @@
-# pdf_ingest.py - PDF extraction utilities 
+# pdf_ingest.py - PDF extraction utilities
 # services/pdf_ingest.py
 from pypdf import PdfReader
-from typing import List
+from typing import List, Iterator, Tuple, Optional, Callable
+from concurrent.futures import Executor
+from collections import deque
 import io
 
 def extract_text_from_pdf(content: bytes) -> str:
@@ -12,4 +14,42 @@ def extract_text_from_pdf(content: bytes) -> str:
     pages = []
     for p in reader.pages:
         pages.append(p.extract_text() or "")
-    return "\n".join(pages)
\ No newline at end of file
+    return "\n".join(pages)
+
+def count_pages(path: str) -> int:
+    return len(PdfReader(path).pages)
+
+def extract_page_range(path: str, start: int, end: int) -> List[str]:
+    """
+    Text of pages [start, end) of the PDF at `path`. Top-level so process pools can pickle it.
+    """
+    reader = PdfReader(path)
+    return [(reader.pages[i].extract_text() or "") for i in range(start, min(end, len(reader.pages)))]
+
+def iter_pdf_pages(path: str, executor: Optional[Executor] = None, pages_per_task: int = 8,
+                   max_pending: int = 4, on_page: Callable[[int], None] = None) -> Iterator[Tuple[int, str]]:
+    """
+    Yield (page_number, text) in page order without holding the whole document in memory.
+    With an executor, page ranges are extracted in parallel; at most `max_pending`
+    ranges are in flight so memory stays bounded on very large files.
+    """
+    total = count_pages(path)
+    ranges = deque((s, min(s + pages_per_task, total)) for s in range(0, total, pages_per_task))
+    if executor is None:
+        for start, end in ranges:
+            for offset, text in enumerate(extract_page_range(path, start, end)):
+                if on_page:
+                    on_page(start + offset)
+                yield start + offset, text
+        return
+
+    pending = deque()
+    while ranges or pending:
+        while ranges and len(pending) < max_pending:
+            start, end = ranges.popleft()
+            pending.append((start, executor.submit(extract_page_range, path, start, end)))
+        start, fut = pending.popleft()
+        for offset, text in enumerate(fut.result()):
+            if on_page:
+                on_page(start + offset)
+            yield start + offset, text
@@ -1,18 +1,126 @@
-# prompt_template.py - Prompt templating utilities 
+# prompt_template.py - Prompt templating utilities
 # services/prompt_template.py
-from typing import List, Dict
+from typing import List, Dict, Optional
+import os
+import re
+from services.tokenizer import count_tokens
 
-def build_prompt(system_instructions: str, user_text: str, context_chunks: List[Dict]) -> Dict:
-    """
-    Returns a dict with 'template_id' and 'text' to keep template metadata for audits.
-    """
-    template_id = "contract_miner_v1"
-    context_text = "\n\n---\n\n".join([f"[{c['id']}]\n{c['text']}" for c in context_chunks])
-    prompt_text = (
-        f"SYSTEM: {system_instructions}\n\n"
-        f"CONTEXT:\n{context_text}\n\n"
-        f"USER QUESTION: {user_text}\n\n"
+# Max tokens of retrieved context per prompt
+PROMPT_CONTEXT_TOKENS = int(os.getenv("PROMPT_CONTEXT_TOKENS", "3000"))
+# Share of a block's word trigrams already present in a packed block at which it counts as a near-duplicate
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.8"))
+
+# Prompt layout; block/separator format each packed context block. Stored once per version by the audit log.
+TEMPLATE = {
+    "id": "contract_miner_v2",
+    "text": (
+        "SYSTEM: {system}\n\n"
+        "CONTEXT:\n{context}\n\n"
+        "USER QUESTION: {question}\n\n"
         "INSTRUCTIONS: Answer concisely, cite chunk ids in square brackets for provenance. "
         "If the answer is not supported by the context, say 'Insufficient context' and list follow-ups."
-    )
-    return {"template_id": template_id, "text": prompt_text}
\ No newline at end of file
+    ),
+    "block": "[{ids}]\n{text}",
+    "separator": "\n\n---\n\n",
+}
+
+def build_prompt(system_instructions: str, user_text: str, context_chunks: List[Dict],
+                 token_budget: Optional[int] = None) -> Dict:
+    """
+    Returns a dict with 'template_id' and 'text' to keep template metadata for audits,
+    plus 'context_ids' (chunk ids that made it into the prompt), 'packing' stats and
+    'parts' (template, system prompt, context blocks, question) that render_prompt turns back into 'text'.
+    """
+    blocks, packing = pack_context(context_chunks, PROMPT_CONTEXT_TOKENS if token_budget is None else token_budget)
+    parts = {
+        "template": TEMPLATE,
+        "system": system_instructions,
+        "blocks": [{"ids": b["ids"], "text": b["text"]} for b in blocks],
+        "question": user_text,
+    }
+    context_ids = [i for b in blocks for i in b["ids"]]
+    return {"template_id": TEMPLATE["id"], "text": render_prompt(parts), "context_ids": context_ids,
+            "packing": packing, "parts": parts}
+
+def render_prompt(parts: Dict) -> str:
+    template = parts["template"]
+    context = template["separator"].join(
+        template["block"].format(ids=", ".join(b["ids"]), text=b["text"]) for b in parts["blocks"])
+    return template["text"].format(system=parts["system"], context=context, question=parts["question"])
+
+def pack_context(chunks: List[Dict], token_budget: int, dedup_threshold: float = CONTEXT_DEDUP_THRESHOLD):
+    """
+    Turn retrieved chunks into prompt context blocks:
+    - overlapping/adjacent chunks of the same document are merged into one block
+      (chunk_text windows overlap, so neighbours would otherwise repeat text)
+    - near-duplicate blocks (e.g. the same boilerplate in two contracts) are dropped
+    - blocks are taken in retrieval-score order until `token_budget` is used up
+    Every block keeps the ids of the chunks it came from so citations still resolve.
+    Returns (blocks, stats).
+    """
+    blocks = _merge_spans(chunks)
+    stats = {
+        "chunks_in": len(chunks),
+        "tokens_in": sum(count_tokens(c["text"]) for c in chunks),
+        "merged": len(chunks) - len(blocks),
+        "near_duplicates": 0,
+        "over_budget": 0,
+        "budget": token_budget,
+    }
+    blocks.sort(key=lambda b: -b["score"])
+
+    packed, shingles, used = [], [], 0
+    for b in blocks:
+        sh = _shingles(b["text"])
+        if any(_coverage(sh, other) >= dedup_threshold for other in shingles):
+            stats["near_duplicates"] += 1
+            continue
+        # block header ("[id, ...]\n") and separator cost tokens too
+        cost = count_tokens(b["text"]) + count_tokens(", ".join(b["ids"])) + 4
+        if used + cost > token_budget:
+            stats["over_budget"] += 1
+            continue
+        used += cost
+        packed.append(b)
+        shingles.append(sh)
+    stats["blocks"] = len(packed)
+    stats["context_tokens"] = used
+    stats["tokens_saved"] = max(0, stats["tokens_in"] - used)
+    return packed, stats
+
+def _merge_spans(chunks: List[Dict]) -> List[Dict]:
+    by_doc, blocks = {}, []
+    for c in chunks:
+        if c.get("doc_id") is None or c.get("start") is None or c.get("end") is None:
+            blocks.append({"ids": [c["id"]], "text": c["text"], "score": c.get("score", 0.0)})
+        else:
+            by_doc.setdefault(c["doc_id"], []).append(c)
+    for doc_chunks in by_doc.values():
+        doc_chunks.sort(key=lambda c: c["start"])
+        cur = None
+        for c in doc_chunks:
+            if cur is not None and c["start"] <= cur["end"]:
+                if c["end"] > cur["end"]:
+                    cur["text"] += c["text"][cur["end"] - c["start"]:]
+                    cur["end"] = c["end"]
+                cur["ids"].append(c["id"])
+                cur["score"] = max(cur["score"], c.get("score", 0.0))
+            else:
+                if cur is not None:
+                    blocks.append(cur)
+                cur = {"ids": [c["id"]], "text": c["text"], "score": c.get("score", 0.0),
+                       "start": c["start"], "end": c["end"]}
+        blocks.append(cur)
+    return [{"ids": b["ids"], "text": b["text"], "score": b["score"]} for b in blocks]
+
+def _shingles(text: str, n: int = 3) -> set:
+    words = re.findall(r'\w+', text.lower())
+    if len(words) < n:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + n]) for i in range(len(words) - n + 1)}
+
+def _coverage(a: set, b: set) -> float:
+    # fraction of `a` already contained in `b`; a chunk repeated inside a merged block scores 1.0
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a)
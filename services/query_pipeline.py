@@ -0,0 +1,156 @@
+# query_pipeline.py - Shared query steps and the batched question-answering runner
+# services/query_pipeline.py
+import os, time, uuid, asyncio, hashlib, logging
+from typing import List, Dict, Optional, Callable, AsyncIterator
+from services.sanitizer import sanitize_input, detect_prompt_injection
+from services.prompt_template import build_prompt
+from services.output_filter import filter_output_and_redact
+from services.explainability import explain_response_perturbation_async
+from services.confidence import compute_confidence
+from services.retriever import similarity_scores
+
+# generations in flight per batch (the LLM client also caps calls per process)
+QUERY_BATCH_CONCURRENCY = int(os.getenv("QUERY_BATCH_CONCURRENCY", "8"))
+# questions embedded and searched together; later waves are retrieved while earlier ones generate
+QUERY_BATCH_WAVE = int(os.getenv("QUERY_BATCH_WAVE", "256"))
+QUERY_BATCH_MAX_ITEMS = int(os.getenv("QUERY_BATCH_MAX_ITEMS", "5000"))
+
+logger = logging.getLogger(__name__)
+
+def audit_record(input_hash, prompt, retrieved, llm_resp, filtered_text, redaction_meta, confidence,
+                 explanation, explain_later, cache_hit, **extra) -> Dict:
+    return {
+        "ts": time.time(),
+        "input_hash": input_hash,
+        "prompt_template": prompt["template_id"],
+        "prompt_text": prompt["text"],
+        "prompt_parts": prompt.get("parts"),
+        "retrieved_ids": [r["id"] for r in retrieved],
+        "context_ids": prompt.get("context_ids"),
+        "packing": prompt.get("packing"),
+        "model_version": llm_resp.get("model"),
+        "raw_response": llm_resp["text"],
+        "filtered_response": filtered_text,
+        "confidence": confidence,
+        "explanation": explanation,
+        "explanation_status": "pending" if explain_later else None,
+        "redaction": redaction_meta,
+        "cache_hit": cache_hit,
+        **extra
+    }
+
+class BatchQueryRunner:
+    """
+    Answers many questions as one job (the in-process API behind /query_batch):
+    - questions are embedded in one batched call per wave and searched with one matrix search
+    - generations run with at most `max_concurrency` in flight; identical questions share
+      one generation through the response cache
+    - every item is sanitized, checked, filtered and audited like a /query call, and
+      yielded as soon as it finishes (not in input order; items carry their 'index')
+    `admit(index)` is called once per question and may refuse it (per-item rate limiting).
+    """
+    def __init__(self, llm, retriever, vectorstore, response_cache, audit,
+                 max_concurrency: int = QUERY_BATCH_CONCURRENCY, wave: int = QUERY_BATCH_WAVE):
+        self.llm = llm
+        self.retriever = retriever
+        self.vectorstore = vectorstore
+        self.response_cache = response_cache
+        self.audit = audit
+        self.max_concurrency = max(1, max_concurrency)
+        self.wave = max(1, wave)
+
+    async def run(self, questions: List[str], top_k: int = 5, include_explain: bool = False,
+                  admit: Optional[Callable[[int], bool]] = None) -> AsyncIterator[Dict]:
+        batch_id = uuid.uuid4().hex
+        out: asyncio.Queue = asyncio.Queue()
+        sem = asyncio.Semaphore(self.max_concurrency)
+
+        accepted = []
+        for i, q in enumerate(questions):
+            if admit is not None and not admit(i):
+                out.put_nowait({"index": i, "status": 429, "error": "Rate limit exceeded"})
+            elif detect_prompt_injection(q):
+                out.put_nowait({"index": i, "status": 400, "error": "Prompt injection detected"})
+            else:
+                accepted.append((i, sanitize_input(q)))
+
+        async def answer(i, sanitized, retrieval, generation):
+            try:
+                async with sem:
+                    item = await self._answer(i, sanitized, retrieval, generation, top_k, include_explain, batch_id)
+            except Exception as e:
+                logger.exception("Batch item %d failed", i)
+                item = {"index": i, "status": 500, "error": str(e)}
+            out.put_nowait(item)
+
+        async def produce():
+            tasks = []
+            try:
+                for start in range(0, len(accepted), self.wave):
+                    wave = accepted[start:start + self.wave]
+                    texts = [t for _, t in wave]
+                    generation = self.vectorstore.generation
+                    try:
+                        retrievals = await self.retriever.retrieve_batch(
+                            texts, lambda: self.llm.embed_batch(texts), top_k=top_k)
+                    except Exception as e:
+                        logger.exception("Batch retrieval failed")
+                        for i, _ in wave:
+                            out.put_nowait({"index": i, "status": 500, "error": str(e)})
+                        continue
+                    tasks += [asyncio.ensure_future(answer(i, t, r, generation)) for (i, t), r in zip(wave, retrievals)]
+                await asyncio.gather(*tasks)
+            finally:
+                for t in tasks:
+                    t.cancel()
+                out.put_nowait(None)
+
+        producer = asyncio.ensure_future(produce())
+        try:
+            while True:
+                item = await out.get()
+                if item is None:
+                    break
+                yield {"batch_id": batch_id, **item}
+            await producer
+        finally:
+            producer.cancel()
+
+    async def _answer(self, index, sanitized, retrieval, generation, top_k, include_explain, batch_id) -> Dict:
+        embedding = retrieval["embedding"]
+        cached = self.response_cache.find_similar(embedding, generation) if embedding is not None else None
+        if cached is not None:
+            cache_hit = "similar"
+        else:
+            retrieved = retrieval["results"]
+            prompt = build_prompt(system_instructions=self.llm.system_prompt(), user_text=sanitized, context_chunks=retrieved)
+
+            async def _generate():
+                resp = await self.llm.generate(prompt, return_logprobs=True)
+                return {"retrieved": retrieved, "prompt": prompt, "llm_resp": resp}
+
+            key = self.response_cache.make_key(prompt["template_id"], [r["id"] for r in retrieved], sanitized)
+            cached, cache_hit = await self.response_cache.get_or_compute(key, generation, _generate, embedding=embedding)
+        retrieved, prompt, llm_resp = cached["retrieved"], cached["prompt"], cached["llm_resp"]
+
+        filtered_text, redaction_meta = filter_output_and_redact(llm_resp["text"])
+        explanation = None
+        if include_explain:
+            explanation = await explain_response_perturbation_async(
+                llm_client=self.llm, prompt=prompt, response=llm_resp["text"], retrieved_chunks=retrieved, base=llm_resp)
+        confidence = compute_confidence(logprobs=llm_resp.get("logprobs"), retrieval_scores=similarity_scores(retrieved),
+                                        calibration_model=None)
+        input_hash = hashlib.sha256(sanitized.encode()).hexdigest()
+        audit_id = await self.audit.alog(audit_record(input_hash, prompt, retrieved, llm_resp, filtered_text, redaction_meta,
+                                                     confidence, explanation, False, cache_hit,
+                                                     retrieval_mode=retrieval["mode"], batch_id=batch_id, batch_index=index))
+        return {
+            "index": index,
+            "status": 200,
+            "response": filtered_text,
+            "confidence_score": confidence,
+            "explanation": explanation,
+            "model_version": llm_resp.get("model"),
+            "input_hash": input_hash,
+            "audit_id": audit_id
+        }
@@ -0,0 +1,172 @@
+# response_cache.py - Response cache with in-flight request coalescing for /query
+# services/response_cache.py
+import os, time, asyncio, hashlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Callable, Awaitable, Tuple
+import numpy as np
+from services.embedding_cache import normalize_text
+
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "2000"))
+# cosine threshold for reusing an answer to a near-identical question; 0 disables
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0"))
+
+class ResponseCache:
+    """
+    Caches LLM results in front of generate().
+    - exact key: prompt template id + retrieved chunk ids + normalized sanitized question
+    - optional similarity match on the query embedding; /query and /query_stream check it
+      before the dense search (Retriever.retrieve `reuse`), so a hit skips that search too
+    - entries expire after `ttl` seconds and are ignored once the index generation moves on
+    - identical concurrent misses are coalesced so only one LLM call is made
+    Used from the event loop only, so no locking is needed.
+    """
+    def __init__(self, ttl: float = RESPONSE_CACHE_TTL, max_items: int = RESPONSE_CACHE_SIZE,
+                 similarity_threshold: float = RESPONSE_CACHE_SIMILARITY):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.similarity_threshold = similarity_threshold
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.stats = {"hits": 0, "similar_hits": 0, "coalesced": 0, "misses": 0, "expired": 0}
+        # unit query embeddings of the entries, one row per slot, grown by doubling up to max_items
+        # rows; a lookup is a single matrix-vector product with no per-query copying
+        self._reset_slots(0)
+
+    @staticmethod
+    def make_key(template_id: str, chunk_ids: List[str], question: str) -> str:
+        raw = "\x1f".join([template_id, ",".join(chunk_ids), normalize_text(question).lower()])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, key: str, generation: int) -> Optional[Dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry["generation"] != generation or time.monotonic() - entry["at"] > self.ttl:
+            self._drop(key)
+            self.stats["expired"] += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry["value"]
+
+    def find_similar(self, embedding, generation: int) -> Optional[Dict]:
+        if self.similarity_threshold <= 0 or not self._slots:
+            return None
+        query = _unit(embedding)
+        if query.shape[0] != self._matrix.shape[1]:
+            return None
+        n = len(self._slot_key)
+        sims = self._matrix[:n] @ query
+        sims[self._slot_generation[:n] != generation] = -np.inf
+        best = int(np.argmax(sims))
+        if sims[best] < self.similarity_threshold:
+            return None
+        value = self.get(self._slot_key[best], generation)
+        if value is not None:
+            self.stats["similar_hits"] += 1
+        return value
+
+    def put(self, key: str, value: Dict, generation: int, embedding=None):
+        self._entries[key] = {"value": value, "generation": generation, "at": time.monotonic()}
+        self._entries.move_to_end(key)
+        if embedding is not None:
+            self._index(key, _unit(embedding), generation)
+        else:
+            self._unindex(key)
+        while len(self._entries) > self.max_items:
+            self._drop(next(iter(self._entries)))
+
+    def _drop(self, key: str):
+        del self._entries[key]
+        self._unindex(key)
+
+    def _index(self, key: str, vec: np.ndarray, generation: int):
+        if self._matrix.shape[1] != vec.shape[0]:
+            # first embedding, or the embedding model changed: old rows are not comparable
+            self._reset_slots(vec.shape[0])
+        slot = self._slots.get(key)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+            else:
+                slot = len(self._slot_key)
+                if slot == self._matrix.shape[0]:
+                    self._grow()
+                self._slot_key.append(None)
+            self._slots[key] = slot
+            self._slot_key[slot] = key
+        self._matrix[slot] = vec
+        self._slot_generation[slot] = generation
+
+    def _unindex(self, key: str):
+        slot = self._slots.pop(key, None)
+        if slot is not None:
+            self._slot_key[slot] = None
+            self._slot_generation[slot] = -1
+            self._free.append(slot)
+
+    def _grow(self):
+        rows = max(1, min(max(2 * self._matrix.shape[0], 64), self.max_items + 1))
+        matrix = np.zeros((rows, self._matrix.shape[1]), dtype="float32")
+        matrix[:self._matrix.shape[0]] = self._matrix
+        gens = np.full(rows, -1, dtype=np.int64)
+        gens[:self._slot_generation.shape[0]] = self._slot_generation
+        self._matrix, self._slot_generation = matrix, gens
+
+    def _reset_slots(self, dim: int):
+        self._matrix = np.zeros((0, dim), dtype="float32")
+        self._slot_generation = np.empty(0, dtype=np.int64)  # -1 marks a free slot
+        self._slot_key: List[Optional[str]] = []  # slot -> entry key
+        self._slots: Dict[str, int] = {}  # entry key -> slot
+        self._free: List[int] = []
+
+    async def get_or_compute(self, key: str, generation: int, compute: Callable[[], Awaitable[Dict]],
+                             embedding=None) -> Tuple[Dict, Optional[str]]:
+        """
+        Returns (value, hit) where hit is "exact", "coalesced" or None (freshly computed).
+        """
+        value = self.get(key, generation)
+        if value is not None:
+            self.stats["hits"] += 1
+            return value, "exact"
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.stats["coalesced"] += 1
+            # shield: a cancelled waiter must not cancel the shared call
+            return await asyncio.shield(inflight), "coalesced"
+
+        self.stats["misses"] += 1
+        # the call runs as its own task so that cancelling the request that started it (e.g. a
+        # client disconnect) neither cancels nor fails the requests coalesced onto it
+        task = asyncio.ensure_future(self._fill(key, generation, compute, embedding))
+        task.add_done_callback(_retrieve_exception)
+        self._inflight[key] = task
+        return await asyncio.shield(task), None
+
+    async def _fill(self, key: str, generation: int, compute: Callable[[], Awaitable[Dict]], embedding) -> Dict:
+        try:
+            value = await compute()
+            self.put(key, value, generation, embedding)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    def hit_rate(self) -> float:
+        # answers served without a new LLM call, over all lookups that reached the cache
+        served = self.stats["hits"] + self.stats["similar_hits"] + self.stats["coalesced"]
+        total = served + self.stats["misses"]
+        return served / total if total else 0.0
+
+    def invalidate(self):
+        self._entries.clear()
+        self._reset_slots(0)
+
+def _retrieve_exception(task: asyncio.Future):
+    # a failed call nobody is left waiting for must not log "exception was never retrieved"
+    if not task.cancelled():
+        task.exception()
+
+def _unit(embedding) -> np.ndarray:
+    v = np.asarray(embedding, dtype="float32").ravel()
+    n = np.linalg.norm(v)
+    return v / n if n > 0 else v
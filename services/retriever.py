@@ -1,11 +1,145 @@
-# retriever.py - Retrieval logic / vectorstore adapter 
+# retriever.py - Retrieval logic / vectorstore adapter
 # services/retriever.py
-from typing import List, Dict
+import os, asyncio, logging
+from typing import Any, List, Dict, Optional, Callable, Awaitable
 from storage.vectorstore import VectorStore
+from services.telemetry import traced
+
+# "hybrid" (BM25 + dense, fused), "dense" or "lexical"
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+# reciprocal rank fusion constant; larger values flatten the rank contribution
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", "60"))
+# candidates taken from each ranker per requested result
+HYBRID_CANDIDATES_PER_RESULT = int(os.getenv("HYBRID_CANDIDATES_PER_RESULT", "4"))
+# seconds to wait for the query embedding before answering from the lexical index alone
+RETRIEVAL_EMBED_TIMEOUT = float(os.getenv("RETRIEVAL_EMBED_TIMEOUT", "2.0"))
+
+logger = logging.getLogger(__name__)
 
 class Retriever:
-    def __init__(self, vectorstore: VectorStore):
+    def __init__(self, vectorstore: VectorStore, mode: str = RETRIEVAL_MODE, rrf_k: int = HYBRID_RRF_K,
+                 embed_timeout: float = RETRIEVAL_EMBED_TIMEOUT, nprobe: Optional[int] = None, ef: Optional[int] = None):
         self.vs = vectorstore
+        self.mode = mode
+        self.rrf_k = rrf_k
+        self.embed_timeout = embed_timeout
+        # ANN search knobs (None = the vector store defaults)
+        self.nprobe = nprobe
+        self.ef = ef
+
+    @traced("dense_search")
+    def retrieve_by_embedding(self, embedding, top_k=5, nprobe: Optional[int] = None, ef: Optional[int] = None,
+                              rerank: Optional[bool] = None) -> List[Dict]:
+        """
+        Dense search. `nprobe` (IVF lists probed) and `ef` (HNSW candidate list size) raise
+        recall at the cost of latency; `rerank` forces exact re-scoring of the candidates on/off.
+        """
+        return self.vs.query(embedding, top_k=top_k, nprobe=nprobe or self.nprobe, ef=ef or self.ef, rerank=rerank)
+
+    @traced("lexical_search")
+    def retrieve_lexical(self, text: str, top_k=5) -> List[Dict]:
+        return self.vs.lexical_query(text, top_k=top_k)
+
+    def _candidates(self, top_k: int) -> int:
+        return max(top_k * HYBRID_CANDIDATES_PER_RESULT, 20)
+
+    def retrieve_hybrid(self, text: str, embedding, top_k=5) -> List[Dict]:
+        n = self._candidates(top_k)
+        return self.fuse(self.retrieve_by_embedding(embedding, n), self.retrieve_lexical(text, n), top_k)
+
+    async def retrieve(self, text: str, embed: Callable[[], Awaitable], top_k=5,
+                       reuse: Optional[Callable[[Any], Optional[Dict]]] = None) -> Dict:
+        """
+        Run the lexical search (in a thread) while the query embedding is being computed, then
+        the dense search (in a thread as well, overlapping the lexical one if it is still
+        running), and fuse both. If the embedding fails or takes longer than
+        `embed_timeout`, answer from the lexical index alone.
+        `reuse` is called with the embedding before the dense search; if it returns a value
+        (e.g. a cached answer to a similar question) the search is skipped and the result is
+        {"mode": "reused", "reused": value, "results": None}.
+        Returns {"results", "mode" ("hybrid"|"dense"|"lexical"), "embedding" (None if unavailable)}.
+        """
+        n = self._candidates(top_k)
+        lexical = None
+        if self.mode != "dense":
+            lexical = asyncio.ensure_future(asyncio.to_thread(self.retrieve_lexical, text, n))
+        embedding = None
+        if self.mode != "lexical":
+            try:
+                timeout = self.embed_timeout if lexical is not None else None
+                embedding = await asyncio.wait_for(embed(), timeout=timeout)
+            except Exception as e:
+                if lexical is None:
+                    raise
+                logger.warning("Query embedding unavailable (%s); using lexical retrieval only", e or type(e).__name__)
+        if embedding is None:
+            return {"results": self.fuse([], await lexical, top_k), "mode": "lexical", "embedding": None}
+        if reuse is not None:
+            value = reuse(embedding)
+            if value is not None:
+                if lexical is not None:
+                    lexical.cancel()
+                return {"results": None, "mode": "reused", "reused": value, "embedding": embedding}
+        # index search, chunk fetch and a possible reader reload all block; keep them off the loop
+        dense = asyncio.to_thread(self.retrieve_by_embedding, embedding, n if lexical is not None else top_k)
+        if lexical is None:
+            return {"results": await dense, "mode": "dense", "embedding": embedding}
+        dense, lex = await asyncio.gather(dense, lexical)
+        return {"results": self.fuse(dense, lex, top_k), "mode": "hybrid", "embedding": embedding}
+
+    async def retrieve_batch(self, texts: List[str], embed_batch: Callable[[], Awaitable], top_k=5) -> List[Dict]:
+        """
+        retrieve() for many questions: one batched embedding call, one matrix search over
+        all query vectors, and the lexical searches meanwhile; both searches run in worker threads. If the
+        batched embedding fails, every question falls back to lexical retrieval.
+        """
+        n = self._candidates(top_k)
+        lexical = None
+        if self.mode != "dense":
+            lexical = asyncio.ensure_future(asyncio.to_thread(lambda: [self.retrieve_lexical(t, n) for t in texts]))
+        embeddings = None
+        if self.mode != "lexical":
+            try:
+                embeddings = await embed_batch()
+            except Exception as e:
+                if lexical is None:
+                    raise
+                logger.warning("Batch embedding unavailable (%s); using lexical retrieval only", e or type(e).__name__)
+        if embeddings is None:
+            return [{"results": self.fuse([], lex, top_k), "mode": "lexical", "embedding": None} for lex in await lexical]
+        dense = asyncio.to_thread(self.vs.query_batch, embeddings, n if lexical is not None else top_k,
+                                  nprobe=self.nprobe, ef=self.ef)
+        if lexical is None:
+            return [{"results": d, "mode": "dense", "embedding": e} for d, e in zip(await dense, embeddings)]
+        dense, lexical = await asyncio.gather(dense, lexical)
+        return [{"results": self.fuse(d, lex, top_k), "mode": "hybrid", "embedding": e}
+                for d, lex, e in zip(dense, lexical, embeddings)]
+
+    @traced("fuse")
+    def fuse(self, dense: List[Dict], lexical: List[Dict], top_k=5) -> List[Dict]:
+        """
+        Reciprocal rank fusion. 'score' becomes the fused score scaled to [0, 1] (1 = ranked
+        first by both); the per-ranker scores are kept as 'dense_score' / 'lexical_score'
+        (None when that ranker did not return the chunk). Hits with equal scores share a rank,
+        so near-duplicates that share one vector are told apart by the lexical ranking alone.
+        """
+        fused: Dict[str, Dict] = {}
+        for field, hits in (("dense_score", dense), ("lexical_score", lexical)):
+            rank, prev = 0, None
+            for i, hit in enumerate(hits):
+                if hit["score"] != prev:
+                    rank, prev = i, hit["score"]
+                entry = fused.setdefault(hit["id"], {**hit, "dense_score": None, "lexical_score": None, "rrf": 0.0})
+                entry[field] = hit["score"]
+                entry["rrf"] += 1.0 / (self.rrf_k + rank + 1)
+        best = 2.0 / (self.rrf_k + 1)
+        ranked = sorted(fused.values(), key=lambda e: -e["rrf"])[:top_k]
+        return [{**{k: v for k, v in e.items() if k != "rrf"}, "score": e["rrf"] / best} for e in ranked]
 
-    def retrieve_by_embedding(self, embedding, top_k=5) -> List[Dict]:
-        return self.vs.query(embedding, top_k=top_k)
\ No newline at end of file
+def similarity_scores(results: List[Dict]) -> List[float]:
+    """
+    Dense similarities of retrieval results for confidence scoring: fused results carry them
+    in 'dense_score' (lexical-only hits have none), plain dense results in 'score'.
+    """
+    return [r["dense_score"] if "dense_score" in r else r["score"] for r in results
+            if r.get("dense_score", r["score"]) is not None]
@@ -1,23 +1,18 @@
 # sanitizer.py - Input sanitization and prompt-injection detection 
 # services/sanitizer.py
 import re
+from services.trust_scanner import default_scanner
+
+# Plain precompiled passes: for these character-class substitutions the scanner's combined
+# regex is slower than re.sub (see benchmarks/bench_trust_scanner.py)
+_URL = re.compile(r'https?://[^\s\x00-\x1f\x7f-\x9f]+')
+_SPACE = re.compile(r'[\s\x00-\x1f\x7f-\x9f]+')
 
 def sanitize_input(text: str) -> str:
     # Basic sanitization: strip control chars, long URLs, and excessive whitespace
-    text = re.sub(r'[\x00-\x1f\x7f-\x9f]', ' ', text)
-    text = re.sub(r'https?://\S+', '[REDACTED_URL]', text)
-    text = re.sub(r'\s+', ' ', text).strip()
-    return text
+    text = _URL.sub('[REDACTED_URL]', text)
+    return _SPACE.sub(' ', text).strip()
 
 def detect_prompt_injection(text: str) -> bool:
-    # Heuristic checks for common injection patterns
-    patterns = [
-        r'ignore (previous|all) instructions',
-        r'do not follow system',
-        r'follow these new instructions',
-        r'execute the following'
-    ]
-    for p in patterns:
-        if re.search(p, text, flags=re.I):
-            return True
-    return False
\ No newline at end of file
+    # Heuristic checks for common injection patterns (rules of kind "injection" in the trust scanner)
+    return default_scanner().first(text, kinds=("injection",)) is not None
@@ -0,0 +1,236 @@
+# telemetry.py - Per-stage request tracing and Prometheus-format metrics
+# services/telemetry.py
+import os, time, math, asyncio, threading, functools
+from contextvars import ContextVar
+from typing import Dict, List, Tuple, Optional, Callable, Iterable
+
+# 0 turns spans into shared no-ops and stops recording metrics
+TELEMETRY_ENABLED = os.getenv("TELEMETRY_ENABLED", "1") == "1"
+# latency histogram bucket bounds, seconds
+TELEMETRY_BUCKETS = tuple(float(b) for b in os.getenv(
+    "TELEMETRY_BUCKETS", "0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30").split(","))
+
+def _label_str(names: Tuple[str, ...], values: Tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(str(v))}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _fmt(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(n, "") for n in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(labels.get(n, "") for n in self.labels), 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        lines += [f"{self.name}{_label_str(self.labels, k)} {_fmt(v)}" for k, v in items]
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Iterable[float] = TELEMETRY_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values: Dict[Tuple, List] = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(n, "") for n in self.labels)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+                    break
+            row[-2] += value
+            row[-1] += 1
+
+    def count(self, **labels) -> int:
+        row = self._values.get(tuple(labels.get(n, "") for n in self.labels))
+        return row[-1] if row else 0
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        names = self.labels + ("le",)
+        for key, row in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, row):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_label_str(names, key + (_fmt(bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_str(self.labels, key)} {_fmt(row[-2])}")
+            lines.append(f"{self.name}_count{_label_str(self.labels, key)} {row[-1]}")
+        return lines
+
+class Registry:
+    """
+    Metrics of this process, rendered in the Prometheus text exposition format.
+    Collectors are callables returning [(name, type, help, [(labels, value), ...])] for
+    values that already live elsewhere (cache stats, queue depths); they run at scrape time.
+    """
+    def __init__(self):
+        self.metrics = []
+        self.collectors: List[Callable] = []
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets=TELEMETRY_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, fn: Callable):
+        self.collectors.append(fn)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        for fn in self.collectors:
+            for name, kind, help, samples in fn():
+                lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+                for labels, value in samples:
+                    lines.append(f"{name}{_label_str(tuple(labels), tuple(labels.values()))} {_fmt(value)}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram("rag_stage_duration_seconds", "Time spent in one pipeline stage",
+                                   ("pipeline", "stage"))
+REQUEST_SECONDS = REGISTRY.histogram("rag_request_duration_seconds", "End-to-end pipeline time", ("pipeline",))
+LLM_TOKENS = REGISTRY.counter("llm_tokens_total", "Tokens sent to / received from the model provider",
+                              ("operation", "kind"))
+LLM_RETRIES = REGISTRY.counter("llm_retries_total", "Provider calls retried after a failure", ("operation",))
+
+class Trace:
+    """
+    Stage timings of one request. Stages are summed by name (an ingest embeds many batches),
+    and every span is also observed in the stage latency histogram.
+    """
+    def __init__(self, pipeline: str):
+        self.pipeline = pipeline
+        self.stages: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self._start = time.perf_counter()
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        STAGE_SECONDS.observe(seconds, pipeline=self.pipeline, stage=stage)
+
+    def count(self, name: str, n: int):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def finish(self) -> Dict:
+        REQUEST_SECONDS.observe(time.perf_counter() - self._start, pipeline=self.pipeline)
+        return self.breakdown()
+
+    def breakdown(self) -> Dict:
+        """
+        {"total_ms", "stages": {stage: ms}, **counts} - the form stored with audit records.
+        """
+        return {"total_ms": round((time.perf_counter() - self._start) * 1000, 3),
+                "stages": {k: round(v * 1000, 3) for k, v in self.stages.items()}, **self.counts}
+
+_current: ContextVar[Optional[Trace]] = ContextVar("telemetry_trace", default=None)
+
+def start_trace(pipeline: str) -> Optional[Trace]:
+    """
+    Begin tracing the current request (task); spans opened below it, including in awaited
+    coroutines and threads started with asyncio.to_thread, attach to it. None when disabled.
+    """
+    if not TELEMETRY_ENABLED:
+        return None
+    trace = Trace(pipeline)
+    _current.set(trace)
+    return trace
+
+def current_trace() -> Optional[Trace]:
+    return _current.get()
+
+class _Span:
+    __slots__ = ("trace", "stage", "t0")
+
+    def __init__(self, trace: Trace, stage: str):
+        self.trace, self.stage = trace, stage
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add(self.stage, time.perf_counter() - self.t0)
+        return False
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+def span(stage: str):
+    """
+    `with span("retrieve"): ...` times a stage of the current trace; a shared no-op without one.
+    """
+    trace = _current.get()
+    return _NO_SPAN if trace is None else _Span(trace, stage)
+
+def traced(stage: str):
+    """
+    Decorator form of span() for plain and async functions.
+    """
+    def wrap(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def run_async(*args, **kwargs):
+                with span(stage):
+                    return await fn(*args, **kwargs)
+            return run_async
+
+        @functools.wraps(fn)
+        def run(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return run
+    return wrap
+
+def record_retry(operation: str):
+    if TELEMETRY_ENABLED:
+        LLM_RETRIES.inc(operation=operation)
+
+def record_tokens(operation: str, prompt: int = 0, completion: int = 0):
+    if not TELEMETRY_ENABLED:
+        return
+    trace = _current.get()
+    for kind, n in (("prompt", prompt), ("completion", completion)):
+        if n:
+            LLM_TOKENS.inc(n, operation=operation, kind=kind)
+            if trace is not None:
+                trace.count(f"{operation}_{kind}_tokens", n)
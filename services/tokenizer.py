@@ -0,0 +1,22 @@
+# tokenizer.py - Local token counting helpers
+# services/tokenizer.py
+import os
+
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "cl100k_base")
+
+# tiktoken is optional; fall back to a ~4 chars/token heuristic if missing
+try:
+    import tiktoken
+    _ENCODER = tiktoken.get_encoding(TOKENIZER_ENCODING)
+except Exception:
+    _ENCODER = None
+
+def count_tokens(text: str) -> int:
+    """
+    Count tokens locally (no network). Exact with tiktoken, approximate otherwise.
+    """
+    if not text:
+        return 0
+    if _ENCODER is not None:
+        return len(_ENCODER.encode(text, disallowed_special=()))
+    return max(1, (len(text) + 3) // 4)
@@ -0,0 +1,285 @@
+# trust_scanner.py - Single-pass scanner for injection phrases, URLs and PII
+# services/trust_scanner.py
+import os, re, json, time, logging, threading
+from typing import List, Dict, Optional, Iterable, Tuple
+
+# Optional JSON file with extra/overriding rules; re-read when its mtime changes
+TRUST_PATTERNS_PATH = os.getenv("TRUST_PATTERNS_PATH") or None
+TRUST_RELOAD_SECONDS = float(os.getenv("TRUST_RELOAD_SECONDS", "5"))
+# chars a stream redactor holds back; must cover the longest match a rule can produce
+TRUST_STREAM_HOLDBACK = int(os.getenv("TRUST_STREAM_HOLDBACK", "128"))
+
+logger = logging.getLogger(__name__)
+
+# Rule order matters: at a given position the first matching rule wins.
+DEFAULT_RULES = [
+    {"name": "ignore_instructions", "kind": "injection", "pattern": r'ignore (previous|all) instructions', "ignore_case": True},
+    {"name": "override_system", "kind": "injection", "pattern": r'do not follow system', "ignore_case": True},
+    {"name": "new_instructions", "kind": "injection", "pattern": r'follow these new instructions', "ignore_case": True},
+    {"name": "execute", "kind": "injection", "pattern": r'execute the following', "ignore_case": True},
+    {"name": "url", "kind": "url", "pattern": r'https?://[^\s\x00-\x1f\x7f-\x9f]+', "replacement": "[REDACTED_URL]"},
+    {"name": "email", "kind": "pii", "pattern": r'\b[\w\.-]+@[\w\.-]+\.\w+\b'},
+    {"name": "ssn", "kind": "pii", "pattern": r'\b\d{3}-\d{2}-\d{4}\b'},
+    # separator belongs to the country code, so a match never starts on the space before the number
+    {"name": "phone", "kind": "pii", "pattern": r'\b(?:\+?\d{1,3}[-.\s]?)?(?:\d{2,4}[-.\s]?){2,4}\d{2,4}\b'},
+]
+
+class _RuleSet:
+    """
+    Immutable compiled state: every rule becomes a named alternative of one regex,
+    so a scan is a single finditer over the text.
+    Rules that start with a literal (most injection phrases) are prefiltered with a
+    substring check and left out of the regex when the literal is absent, which keeps
+    the common no-match case at C string-search speed.
+    """
+    def __init__(self, rules: List[Dict]):
+        self.rules = rules
+        self.by_group = {}
+        self.literals = {}
+        self._compiled = {}
+        self._by_kinds = {}
+        self._lock = threading.Lock()
+        self._order = {f"r{i}": i for i in range(len(rules))}
+        for i, r in enumerate(rules):
+            re.compile(r["pattern"])  # fail on a bad pattern at load time, not on first use
+            self.by_group[f"r{i}"] = r
+            lit = _literal_prefix(r["pattern"])
+            self.literals[f"r{i}"] = lit.lower() if lit and r.get("ignore_case") else lit
+
+    def regex(self, kinds: Optional[frozenset], text: str):
+        plain, literal = self._groups(kinds)
+        groups, lowered = list(plain), None
+        for group in literal:
+            lit = self.literals[group]
+            if self.by_group[group].get("ignore_case"):
+                lowered = text.lower() if lowered is None else lowered
+                if lit not in lowered:
+                    continue
+            elif lit not in text:
+                continue
+            groups.append(group)
+        if len(groups) > len(plain):
+            groups.sort(key=self._order.get)
+        key = tuple(groups)
+        rx = self._compiled.get(key)
+        if rx is None and groups:
+            parts = []
+            for group in groups:
+                flags = "(?i:" if self.by_group[group].get("ignore_case") else "(?:"
+                parts.append(f"(?P<{group}>{flags}{self.by_group[group]['pattern']}))")
+            rx = re.compile("|".join(parts))
+            with self._lock:
+                if len(self._compiled) > 256:
+                    self._compiled.clear()
+                self._compiled[key] = rx
+        return rx
+
+    def _groups(self, kinds: Optional[frozenset]):
+        # (groups always in the regex, groups gated by their literal prefix) for a set of kinds
+        found = self._by_kinds.get(kinds)
+        if found is None:
+            selected = [g for g, r in self.by_group.items() if kinds is None or r["kind"] in kinds]
+            found = ([g for g in selected if self.literals[g] is None], [g for g in selected if self.literals[g] is not None])
+            self._by_kinds[kinds] = found
+        return found
+
+class TrustScanner:
+    """
+    Precompiled trust-scanning engine shared by the sanitizer, injection check and output filter.
+    scan() returns match spans for all (or selected) rule kinds in one pass; redact() rewrites
+    matches with their replacement; stream_redactor() does the same incrementally for token streams.
+    Rules come from DEFAULT_RULES, overridden/extended by name from `path` (JSON list or
+    {"rules": [...]}, a rule with "disabled": true removes it); the file is hot-reloaded.
+    """
+    def __init__(self, rules: Optional[List[Dict]] = None, path: Optional[str] = TRUST_PATTERNS_PATH,
+                 reload_interval: float = TRUST_RELOAD_SECONDS):
+        self.base_rules = list(rules if rules is not None else DEFAULT_RULES)
+        self.path = path
+        self.reload_interval = reload_interval
+        self._mtime = None
+        self._checked = 0.0
+        self._ruleset = _RuleSet(self.base_rules)
+        if path:
+            self.reload()
+
+    def reload(self) -> bool:
+        """
+        Re-read the pattern file. A broken file is logged and the previous rules stay active.
+        """
+        self._checked = time.monotonic()
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return False
+        try:
+            rules = self.base_rules
+            if mtime is not None:
+                with open(self.path) as f:
+                    data = json.load(f)
+                rules = _merge_rules(self.base_rules, data.get("rules", []) if isinstance(data, dict) else data)
+            self._ruleset = _RuleSet(rules)
+            self._mtime = mtime
+            logger.info("Loaded %d trust scanner rules", len(rules))
+            return True
+        except Exception:
+            logger.exception("Invalid trust pattern file %s; keeping previous rules", self.path)
+            self._mtime = mtime
+            return False
+
+    def _rules(self) -> _RuleSet:
+        if self.path and time.monotonic() - self._checked >= self.reload_interval:
+            self.reload()
+        return self._ruleset
+
+    def scan(self, text: str, kinds: Optional[Iterable[str]] = None, pos: int = 0) -> List[Dict]:
+        """
+        Non-overlapping matches, left to right: [{'rule', 'kind', 'start', 'end', 'text', 'replacement'}].
+        """
+        rs = self._rules()
+        rx = rs.regex(frozenset(kinds) if kinds is not None else None, text)
+        if rx is None:
+            return []
+        return [_match(rs, m) for m in rx.finditer(text, pos)]
+
+    def first(self, text: str, kinds: Optional[Iterable[str]] = None) -> Optional[Dict]:
+        rs = self._rules()
+        rx = rs.regex(frozenset(kinds) if kinds is not None else None, text)
+        m = rx.search(text) if rx is not None else None
+        return _match(rs, m) if m else None
+
+    def redact(self, text: str, kinds: Optional[Iterable[str]] = None) -> Tuple[str, List[Dict]]:
+        """
+        Replace every match that has a replacement in one pass. Returns (text, matches).
+        """
+        matches = self.scan(text, kinds)
+        return _apply(text, matches, 0, len(text)), matches
+
+    def stream_redactor(self, kinds: Optional[Iterable[str]] = None, holdback: int = TRUST_STREAM_HOLDBACK,
+                        step: Optional[int] = None):
+        return StreamRedactor(self, kinds, holdback, step)
+
+class StreamRedactor:
+    """
+    Incremental redact(): feed() text chunks as they arrive and get back the redacted text
+    that is safe to emit; finish() returns the rest. Text near the end of what has been seen
+    is held back (up to `holdback` chars) so a match spanning chunk boundaries is still caught.
+    The buffer is only rescanned once `step` new chars have arrived, so each char is scanned
+    about (holdback + step) / step times rather than once per tiny token.
+    """
+    _CONTEXT = 16  # emitted chars kept so \b and lookbehinds see the real preceding text
+
+    def __init__(self, scanner: TrustScanner, kinds: Optional[Iterable[str]] = None, holdback: int = TRUST_STREAM_HOLDBACK,
+                 step: Optional[int] = None):
+        self.scanner = scanner
+        self.kinds = list(kinds) if kinds is not None else None
+        self.holdback = holdback
+        self.step = holdback if step is None else step
+        self.matches: List[Dict] = []
+        self._buf = ""
+        self._pos = 0      # start of the not yet emitted part of _buf
+        self._offset = 0   # stream offset of _buf[0]
+
+    def feed(self, chunk: str) -> str:
+        self._buf += chunk
+        safe = len(self._buf) - self.holdback
+        if safe - self._pos < max(self.step, 1):
+            return ""
+        cut, final = safe, []
+        for m in self.scanner.scan(self._buf, self.kinds, pos=self._pos):
+            if m["start"] >= safe:
+                break
+            if m["end"] >= len(self._buf):
+                # touches the end of what we have: it may still grow
+                cut = m["start"]
+                break
+            final.append(m)
+            cut = max(cut, m["end"])
+        return self._emit(final, cut)
+
+    def finish(self) -> str:
+        final = self.scanner.scan(self._buf, self.kinds, pos=self._pos)
+        return self._emit(final, len(self._buf))
+
+    def _emit(self, matches: List[Dict], cut: int) -> str:
+        out = _apply(self._buf, matches, self._pos, cut)
+        for m in matches:
+            self.matches.append({**m, "start": m["start"] + self._offset, "end": m["end"] + self._offset})
+        keep = max(0, cut - self._CONTEXT)
+        self._buf = self._buf[keep:]
+        self._offset += keep
+        self._pos = cut - keep
+        return out
+
+def _match(rs: _RuleSet, m) -> Dict:
+    r = rs.by_group[m.lastgroup]
+    return {"rule": r["name"], "kind": r["kind"], "start": m.start(), "end": m.end(), "text": m.group(),
+            "replacement": _replacement(r)}
+
+def _replacement(rule: Dict) -> Optional[str]:
+    if "replacement" in rule:
+        return rule["replacement"]
+    if rule["kind"] == "pii":
+        return f"[REDACTED_{rule['name'].upper()}]"
+    return None
+
+def _apply(text: str, matches: List[Dict], start: int, end: int) -> str:
+    out, pos = [], start
+    for m in matches:
+        if m["replacement"] is None:
+            continue
+        out.append(text[pos:m["start"]])
+        out.append(m["replacement"])
+        pos = m["end"]
+    out.append(text[pos:end])
+    return "".join(out)
+
+def _literal_prefix(pattern: str, min_len: int = 3) -> Optional[str]:
+    """
+    Leading ASCII literal every match of `pattern` must start with, or None.
+    """
+    # a top-level alternation means matches need not share the prefix
+    depth, i = 0, 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == "\\":
+            i += 1  # skip the escaped char
+        elif ch == "[":
+            # skip the character class; "]" right after "[" or "[^" is a literal
+            i += 2 if pattern[i + 1:i + 2] == "^" else 1
+            i += pattern[i:i + 1] == "]"
+            while i < len(pattern) and pattern[i] != "]":
+                i += 2 if pattern[i] == "\\" else 1
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == "|" and depth == 0:
+            return None
+        i += 1
+    lit = []
+    for i, ch in enumerate(pattern):
+        if ch in ".^$*+?{}[]|()\\" or not ch.isascii():
+            break
+        if i + 1 < len(pattern) and pattern[i + 1] in "*?{":
+            break
+        lit.append(ch)
+    return "".join(lit) if len(lit) >= min_len else None
+
+def _merge_rules(base: List[Dict], overrides: List[Dict]) -> List[Dict]:
+    rules = {r["name"]: r for r in base}
+    for r in overrides:
+        if r.get("disabled"):
+            rules.pop(r["name"], None)
+        else:
+            rules[r["name"]] = {**rules.get(r["name"], {}), **r}
+    return list(rules.values())
+
+_default_scanner = None
+
+def default_scanner() -> TrustScanner:
+    global _default_scanner
+    if _default_scanner is None:
+        _default_scanner = TrustScanner()
+    return _default_scanner
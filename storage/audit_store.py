@@ -1,31 +1,550 @@
-# audit_store.py - Audit logging (SQLite / persistent store) 
+# audit_store.py - Audit logging (SQLite / persistent store)
 # storage/audit_store.py
-from sqlalchemy import create_engine, Column, Integer, String, Float, Text, JSON
+from sqlalchemy import (create_engine, event, inspect, insert, select, text, Column, Integer, String, Float, Text,
+                        JSON, LargeBinary)
 from sqlalchemy.orm import declarative_base, sessionmaker
-import os, json
+from collections import OrderedDict
+from typing import Dict, List, Optional, Union, Iterator
+import os, json, time, zlib, queue, asyncio, hashlib, logging, threading
 import datetime
+from services.prompt_template import render_prompt
+
+# "1" = log() enqueues and a writer thread group-commits batches; "0" = one transaction per record
+AUDIT_WRITE_BEHIND = os.getenv("AUDIT_WRITE_BEHIND", "1") == "1"
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", "10000"))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "256"))
+# how long the writer waits for more records before committing a partial batch (ms)
+AUDIT_FLUSH_INTERVAL_MS = float(os.getenv("AUDIT_FLUSH_INTERVAL_MS", "50"))
+# drain the queue on close(); with "0" records still queued at shutdown are lost
+AUDIT_FLUSH_ON_SHUTDOWN = os.getenv("AUDIT_FLUSH_ON_SHUTDOWN", "1") == "1"
+# decoded blobs kept in memory for reads; templates and system prompts repeat across most records
+AUDIT_BLOB_CACHE_SIZE = int(os.getenv("AUDIT_BLOB_CACHE_SIZE", "1024"))
+# write attempts per batch before it is spilled to a local file, and the cap on the backoff between them (s)
+AUDIT_WRITE_ATTEMPTS = int(os.getenv("AUDIT_WRITE_ATTEMPTS", "5"))
+AUDIT_RETRY_MAX_SECONDS = float(os.getenv("AUDIT_RETRY_MAX_SECONDS", "5"))
+# JSON-lines file for batches the database refused; replayed once writes succeed again.
+# Empty = next to a SQLite database, else ./storage/audit_spill.jsonl
+AUDIT_SPILL_PATH = os.getenv("AUDIT_SPILL_PATH") or None
+AUDIT_PAGE_MAX = 1000
+
+# payload fields moved out of the JSON row into content-addressed blobs, with the blob kind
+_BLOB_FIELDS = {"raw_response": "text", "filtered_response": "text", "explanation": "json"}
+
+logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
 class Audit(Base):
     __tablename__ = "audits"
     id = Column(Integer, primary_key=True)
+    audit_id = Column(String, index=True, unique=True)
     ts = Column(String, default=lambda: datetime.datetime.utcnow().isoformat())
     input_hash = Column(String, index=True)
+    created_at = Column(Float, index=True)
+    model_version = Column(String, index=True)
+    confidence = Column(Float, index=True)
     payload = Column(JSON)
 
+class AuditBlob(Base):
+    """
+    zlib-compressed text shared by audit records (prompt templates, system prompts,
+    context chunk texts, responses), keyed by the sha256 of the uncompressed bytes.
+    """
+    __tablename__ = "audit_blobs"
+    hash = Column(String, primary_key=True)
+    kind = Column(String)
+    size = Column(Integer)
+    data = Column(LargeBinary)
+
+_CROCKFORD = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+def new_ulid() -> str:
+    """
+    26-char ULID: 48-bit millisecond timestamp + 80 random bits, Crockford base32.
+    Sorts by creation time, so ids can be handed out before the row is written.
+    """
+    value = (int(time.time() * 1000) << 80) | int.from_bytes(os.urandom(10), "big")
+    out = []
+    for _ in range(26):
+        out.append(_CROCKFORD[value & 31])
+        value >>= 5
+    return "".join(reversed(out))
+
 class AuditStore:
-    def __init__(self, db_url: str):
+    """
+    Audit records keyed by a ULID assigned in log(). In write-behind mode records go
+    through a bounded queue to a writer thread that inserts them in multi-row group
+    commits; when the queue is full log() blocks (back-pressure) and the wait is counted in stats.
+    Async handlers use alog(), which waits for queue space in a worker thread instead of
+    blocking the event loop. A batch that still fails after `write_attempts` is appended to a
+    local spill file and replayed by the writer once the database accepts writes again, so
+    an issued audit id is never silently lost; stats["spill_pending"] shows what is waiting.
+
+    Large repeated payload pieces are stored once in `audit_blobs` and referenced by hash
+    ({"$blob": <sha256>}); a record's prompt is kept as template/system/chunk references
+    (`prompt_ref`) and re-rendered on read. Timestamp, model version and confidence are
+    indexed columns for search()/iter_records().
+    """
+    def __init__(self, db_url: str, write_behind: bool = AUDIT_WRITE_BEHIND, queue_size: int = AUDIT_QUEUE_SIZE,
+                 batch_size: int = AUDIT_BATCH_SIZE, flush_interval_ms: float = AUDIT_FLUSH_INTERVAL_MS,
+                 flush_on_shutdown: bool = AUDIT_FLUSH_ON_SHUTDOWN, write_attempts: int = AUDIT_WRITE_ATTEMPTS,
+                 spill_path: Optional[str] = AUDIT_SPILL_PATH):
         self.db_url = db_url
         self.engine = create_engine(db_url, echo=False, future=True)
+        if self.engine.dialect.name == "sqlite":
+            event.listen(self.engine, "connect", _sqlite_pragmas)
         Base.metadata.create_all(self.engine)
+        self._add_missing_columns({"audit_id": "VARCHAR", "created_at": "FLOAT", "model_version": "VARCHAR",
+                                   "confidence": "FLOAT"})
         self.Session = sessionmaker(bind=self.engine)
+        self.write_behind = write_behind
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.flush_on_shutdown = flush_on_shutdown
+        self.write_attempts = max(1, write_attempts)
+        self.spill_path = spill_path or _default_spill_path(self.engine)
+        self.stats = {"enqueued": 0, "written": 0, "batches": 0, "failed_batches": 0,
+                      "queue_full": 0, "blocked_seconds": 0.0, "max_depth": 0,
+                      "spilled": 0, "replayed": 0, "dropped": 0, "spill_pending": _count_lines(self.spill_path),
+                      "last_error": None,
+                      "blobs_written": 0, "blobs_deduped": 0, "blob_bytes_in": 0, "blob_bytes_stored": 0}
+        self._known_blobs: "OrderedDict[str, None]" = OrderedDict()  # hashes already in the table (writer side)
+        self._blob_cache: "OrderedDict[str, object]" = OrderedDict()  # decoded blobs (read side)
+        self._cache_lock = threading.Lock()
+        self._queue: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self._closed = False
+        self._writer = None
+        if write_behind:
+            self._writer = threading.Thread(target=self._run_writer, name="audit-writer", daemon=True)
+            self._writer.start()
+
+    def _add_missing_columns(self, columns: Dict[str, str]):
+        # databases created before ULID ids / indexed columns; their old rows keep NULLs there
+        have = {c["name"] for c in inspect(self.engine).get_columns("audits")}
+        with self.engine.begin() as conn:
+            for name, decl in columns.items():
+                if name not in have:
+                    conn.execute(text(f"ALTER TABLE audits ADD COLUMN {name} {decl}"))
+                    unique = "UNIQUE " if name == "audit_id" else ""
+                    conn.execute(text(f"CREATE {unique}INDEX IF NOT EXISTS ix_audits_{name} ON audits ({name})"))
+
+    def log(self, record: dict) -> str:
+        """
+        Record an audit entry and return its id. If the record carries 'prompt_parts'
+        (see build_prompt), 'prompt_text' is not stored verbatim but rebuilt from the parts on read.
+        """
+        audit_id, op = _insert_op(record)
+        self._submit(op)
+        return audit_id
+
+    async def alog(self, record: dict) -> str:
+        """
+        log() for the event loop: a record that fits in the queue is enqueued inline; a full
+        queue (or synchronous mode) is waited on in a worker thread.
+        """
+        audit_id, op = _insert_op(record)
+        if self.write_behind and not self._closed:
+            try:
+                self._queue.put_nowait(op)
+            except queue.Full:
+                pass
+            else:
+                self._enqueued()
+                return audit_id
+        await asyncio.to_thread(self._submit, op)
+        return audit_id
+
+    def _submit(self, op):
+        if not self.write_behind or self._closed:
+            self._write([op])
+        else:
+            self._enqueue(op)
 
-    def log(self, record: dict) -> int:
+    def attach_explanation(self, audit_id: Union[str, int], explanation: dict):
+        """
+        Fill in an explanation computed after the record was written (background explain mode).
+        In write-behind mode the update is queued behind the insert it refers to.
+        """
+        op = ("attach", audit_id, explanation)
+        if not self.write_behind or self._closed:
+            return self._write([op])[0]
+        self._enqueue(op)
+        return True
+
+    def get(self, audit_id: Union[str, int], expand: bool = True) -> Optional[Dict]:
+        session = self.Session()
+        try:
+            a = session.execute(select(Audit).where(_id_clause(audit_id))).scalar_one_or_none()
+            if a is None:
+                return None
+            return self._records(session, [a], expand)[0]
+        finally:
+            session.close()
+
+    def search(self, since: Optional[float] = None, until: Optional[float] = None, model_version: Optional[str] = None,
+               min_confidence: Optional[float] = None, max_confidence: Optional[float] = None,
+               input_hash: Optional[str] = None, cursor: Optional[str] = None, limit: int = 100,
+               expand: bool = False) -> Dict:
+        """
+        One page of records matching the filters, oldest first, using only indexed columns.
+        Pass the returned 'next_cursor' back to get the following page (None when exhausted).
+        Keyset pagination: each page is one short indexed query, however deep the export goes.
+        """
+        limit = max(1, min(int(limit), AUDIT_PAGE_MAX))
+        q = select(Audit)
+        if since is not None:
+            q = q.where(Audit.created_at >= since)
+        if until is not None:
+            q = q.where(Audit.created_at < until)
+        if model_version is not None:
+            q = q.where(Audit.model_version == model_version)
+        if min_confidence is not None:
+            q = q.where(Audit.confidence >= min_confidence)
+        if max_confidence is not None:
+            q = q.where(Audit.confidence <= max_confidence)
+        if input_hash is not None:
+            q = q.where(Audit.input_hash == input_hash)
+        if cursor:
+            q = q.where(Audit.id > int(cursor))
+        q = q.order_by(Audit.id).limit(limit + 1)
         session = self.Session()
-        a = Audit(input_hash=record.get("input_hash"), payload=record)
-        session.add(a)
-        session.commit()
-        id_ = a.id
-        session.close()
-        return id_
\ No newline at end of file
+        try:
+            rows = list(session.execute(q).scalars())
+            more = len(rows) > limit
+            rows = rows[:limit]
+            return {"items": self._records(session, rows, expand),
+                    "next_cursor": str(rows[-1].id) if more else None}
+        finally:
+            session.close()
+
+    def iter_records(self, page_size: int = 500, expand: bool = True, **filters) -> Iterator[Dict]:
+        """
+        Stream every matching record page by page (for exports); memory is bounded by one page.
+        """
+        cursor = None
+        while True:
+            page = self.search(cursor=cursor, limit=page_size, expand=expand, **filters)
+            yield from page["items"]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return
+
+    def _records(self, session, rows, expand: bool) -> List[Dict]:
+        blobs = self._load_blobs(session, {h for a in rows for h in _blob_refs(a.payload or {})}) if expand else {}
+        out = []
+        for a in rows:
+            payload = a.payload or {}
+            if expand:
+                payload = _expand(payload, blobs)
+            out.append({"id": a.audit_id or a.id, "ts": a.ts, "created_at": a.created_at, "input_hash": a.input_hash,
+                        "model_version": a.model_version, "confidence": a.confidence, "payload": payload})
+        return out
+
+    def _load_blobs(self, session, hashes) -> Dict[str, object]:
+        found, missing = {}, []
+        with self._cache_lock:
+            for h in hashes:
+                if h in self._blob_cache:
+                    self._blob_cache.move_to_end(h)
+                    found[h] = self._blob_cache[h]
+                else:
+                    missing.append(h)
+        for i in range(0, len(missing), 500):
+            part = missing[i:i + 500]
+            for h, kind, data in session.execute(
+                    select(AuditBlob.hash, AuditBlob.kind, AuditBlob.data).where(AuditBlob.hash.in_(part))):
+                raw = zlib.decompress(data).decode()
+                found[h] = json.loads(raw) if kind in ("json", "template") else raw
+                with self._cache_lock:
+                    self._blob_cache[h] = found[h]
+                    while len(self._blob_cache) > AUDIT_BLOB_CACHE_SIZE:
+                        self._blob_cache.popitem(last=False)
+        return found
+
+    def _enqueue(self, op):
+        try:
+            self._queue.put_nowait(op)
+        except queue.Full:
+            self.stats["queue_full"] += 1
+            t0 = time.perf_counter()
+            self._queue.put(op)
+            self.stats["blocked_seconds"] += time.perf_counter() - t0
+        self._enqueued()
+
+    def _enqueued(self):
+        self.stats["enqueued"] += 1
+        self.stats["max_depth"] = max(self.stats["max_depth"], self._queue.qsize())
+
+    def _run_writer(self):
+        self._replay_spill()
+        while True:
+            op = self._queue.get()
+            if op is None:
+                self._queue.task_done()
+                return
+            batch = [op]
+            stop = False
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    nxt = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if nxt is None:
+                    stop = True
+                    break
+                batch.append(nxt)
+            if self._write_with_retry(batch) and self.stats["spill_pending"]:
+                self._replay_spill()
+            for _ in range(len(batch) + stop):
+                self._queue.task_done()
+            if stop:
+                return
+
+    def _write_with_retry(self, batch) -> bool:
+        # while this retries the queue fills up, which is the back-pressure on log()
+        for attempt in range(self.write_attempts):
+            try:
+                self._write(batch)
+                return True
+            except Exception as e:
+                self.stats["failed_batches"] += 1
+                self.stats["last_error"] = f"{type(e).__name__}: {e}"
+                logger.exception("Audit batch of %d records failed (attempt %d)", len(batch), attempt + 1)
+                if attempt + 1 < self.write_attempts:
+                    time.sleep(min(AUDIT_RETRY_MAX_SECONDS, 0.1 * 2 ** attempt))
+        self._spill(batch)
+        return False
+
+    def _spill(self, batch):
+        try:
+            with open(self.spill_path, "a") as f:
+                f.write("".join(json.dumps(list(op), default=str) + "\n" for op in batch))
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception:
+            self.stats["dropped"] += len(batch)
+            logger.exception("Could not spill %d audit operations to %s; they are lost", len(batch), self.spill_path)
+            return
+        self.stats["spilled"] += len(batch)
+        self.stats["spill_pending"] += len(batch)
+        logger.error("Spilled %d audit operations to %s after %d failed attempts", len(batch), self.spill_path,
+                     self.write_attempts)
+
+    def _replay_spill(self):
+        """
+        Write spilled operations back in order (writer thread only). Stops at the first batch
+        that still fails and keeps it and everything after it for the next attempt.
+        """
+        if not self.stats["spill_pending"]:
+            return
+        try:
+            with open(self.spill_path) as f:
+                ops = [tuple(json.loads(line)) for line in f if line.strip()]
+        except FileNotFoundError:
+            self.stats["spill_pending"] = 0
+            return
+        done = 0
+        while done < len(ops):
+            batch = ops[done:done + self.batch_size]
+            try:
+                # a crash between a replay's commit and the file rewrite leaves rows that already exist
+                written = self._existing_ids([op[1]["audit_id"] for op in batch if op[0] == "insert"])
+                self._write([op for op in batch if op[0] != "insert" or op[1]["audit_id"] not in written])
+            except Exception as e:
+                self.stats["last_error"] = f"{type(e).__name__}: {e}"
+                logger.warning("Replaying spilled audit operations failed, %d still pending: %s", len(ops) - done, e)
+                break
+            done += len(batch)
+        if done == len(ops):
+            os.remove(self.spill_path)
+        elif done:
+            tmp = self.spill_path + ".tmp"
+            with open(tmp, "w") as f:
+                f.write("".join(json.dumps(list(op), default=str) + "\n" for op in ops[done:]))
+            os.replace(tmp, self.spill_path)
+        if done:
+            self.stats["replayed"] += done
+            logger.info("Replayed %d spilled audit operations", done)
+        self.stats["spill_pending"] = len(ops) - done
+
+    def _existing_ids(self, audit_ids: List[str]) -> set:
+        if not audit_ids:
+            return set()
+        session = self.Session()
+        try:
+            return set(session.execute(select(Audit.audit_id).where(Audit.audit_id.in_(audit_ids))).scalars())
+        finally:
+            session.close()
+
+    def _write(self, ops) -> List[bool]:
+        """
+        Apply queued operations in one transaction: new blobs, all inserts as one multi-row
+        INSERT, then explanation updates (which may target rows from the same batch).
+        """
+        blobs = {}
+        rows = [{**op[1], "payload": _compact(op[1]["payload"], blobs)} for op in ops if op[0] == "insert"]
+        attaches = [(op[1], _blob_ref(blobs, "json", op[2])) for op in ops if op[0] == "attach"]
+        results = []
+        session = self.Session()
+        try:
+            new_blobs = self._store_blobs(session, blobs)
+            if rows:
+                session.execute(insert(Audit), rows)
+            for audit_id, explanation in attaches:
+                a = session.execute(select(Audit).where(_id_clause(audit_id))).scalar_one_or_none()
+                if a is not None:
+                    # JSON columns only detect reassignment, not in-place mutation
+                    a.payload = {**(a.payload or {}), "explanation": explanation, "explanation_status": "done"}
+                results.append(a is not None)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        with self._cache_lock:
+            for h in new_blobs:
+                self._known_blobs[h] = None
+            while len(self._known_blobs) > 100000:
+                self._known_blobs.popitem(last=False)
+        if rows:
+            self.stats["written"] += len(rows)
+            self.stats["batches"] += 1
+        return results
+
+    def _store_blobs(self, session, blobs: Dict[str, tuple]) -> List[str]:
+        candidates = [h for h in blobs if h not in self._known_blobs]
+        existing = set()
+        for i in range(0, len(candidates), 500):
+            part = candidates[i:i + 500]
+            existing.update(session.execute(select(AuditBlob.hash).where(AuditBlob.hash.in_(part))).scalars())
+        new = [h for h in candidates if h not in existing]
+        if new:
+            data = []
+            for h in new:
+                kind, raw = blobs[h]
+                packed = zlib.compress(raw, 6)
+                data.append({"hash": h, "kind": kind, "size": len(raw), "data": packed})
+                self.stats["blob_bytes_in"] += len(raw)
+                self.stats["blob_bytes_stored"] += len(packed)
+            # another process may have stored the same blob since the lookup
+            session.execute(insert(AuditBlob).prefix_with("OR IGNORE", dialect="sqlite"), data)
+        self.stats["blobs_written"] += len(new)
+        self.stats["blobs_deduped"] += len(blobs) - len(new)
+        return new + list(existing)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Block until everything queued so far is committed. Returns False on timeout.
+        """
+        if not self.write_behind:
+            return True
+        if timeout is None:
+            self._queue.join()
+            return True
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.005)
+        return True
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def close(self):
+        """
+        Stop the writer. With flush_on_shutdown the queue is drained first; later log() calls write synchronously.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._writer is not None:
+            if self.flush_on_shutdown:
+                self._queue.put(None)
+                self._writer.join()
+            else:
+                dropped = self._queue.qsize()
+                if dropped:
+                    logger.warning("Closing audit store with %d unwritten records", dropped)
+        self.engine.dispose()
+
+def _default_spill_path(engine) -> str:
+    if engine.dialect.name == "sqlite" and engine.url.database not in (None, "", ":memory:"):
+        return engine.url.database + ".spill.jsonl"
+    return "./storage/audit_spill.jsonl"
+
+def _count_lines(path: str) -> int:
+    try:
+        with open(path) as f:
+            return sum(1 for line in f if line.strip())
+    except FileNotFoundError:
+        return 0
+
+def _insert_op(record: dict):
+    audit_id = new_ulid()
+    row = {"audit_id": audit_id, "ts": datetime.datetime.utcnow().isoformat(),
+           "created_at": float(record.get("ts") or time.time()), "input_hash": record.get("input_hash"),
+           "model_version": record.get("model_version"), "confidence": _as_float(record.get("confidence")),
+           "payload": record}
+    return audit_id, ("insert", row)
+
+def _compact(record: dict, blobs: Dict[str, tuple]) -> dict:
+    payload = dict(record)
+    parts = payload.pop("prompt_parts", None)
+    if parts is not None:
+        payload.pop("prompt_text", None)
+        payload["prompt_ref"] = {
+            "template": _blob_ref(blobs, "template", parts["template"])["$blob"],
+            "system": _blob_ref(blobs, "text", parts["system"])["$blob"],
+            "blocks": [{"ids": b["ids"], "text": _blob_ref(blobs, "text", b["text"])["$blob"]} for b in parts["blocks"]],
+            "question": parts["question"],
+        }
+    for field, kind in _BLOB_FIELDS.items():
+        if payload.get(field) is not None:
+            payload[field] = _blob_ref(blobs, kind, payload[field])
+    return payload
+
+def _blob_ref(blobs: Dict[str, tuple], kind: str, value) -> dict:
+    raw = (value if kind == "text" else json.dumps(value, sort_keys=True)).encode()
+    h = hashlib.sha256(raw).hexdigest()
+    blobs[h] = (kind, raw)
+    return {"$blob": h}
+
+def _blob_refs(payload: dict) -> List[str]:
+    refs = [v["$blob"] for v in payload.values() if isinstance(v, dict) and "$blob" in v]
+    ref = payload.get("prompt_ref")
+    if ref:
+        refs += [ref["template"], ref["system"]] + [b["text"] for b in ref["blocks"]]
+    return refs
+
+def _expand(payload: dict, blobs: Dict[str, object]) -> dict:
+    out = {k: (blobs.get(v["$blob"]) if isinstance(v, dict) and "$blob" in v else v) for k, v in payload.items()}
+    ref = out.pop("prompt_ref", None)
+    if ref:
+        out["prompt_text"] = render_prompt({
+            "template": blobs.get(ref["template"]),
+            "system": blobs.get(ref["system"]),
+            "blocks": [{"ids": b["ids"], "text": blobs.get(b["text"])} for b in ref["blocks"]],
+            "question": ref["question"],
+        })
+    return out
+
+def _as_float(value) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _id_clause(audit_id):
+    # integer ids are rows logged before ULIDs were introduced
+    if isinstance(audit_id, int):
+        return Audit.id == audit_id
+    return Audit.audit_id == audit_id
+
+def _sqlite_pragmas(dbapi_conn, _record):
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.close()
@@ -0,0 +1,275 @@
+# chunk_store.py - SQLite side store for chunk text and metadata
+# storage/chunk_store.py
+import os, re, json, sqlite3, logging, threading, pathlib, itertools
+from contextlib import contextmanager
+from typing import List, Dict, Tuple, Iterable, Optional
+
+_COLUMNS = ("id", "text", "doc_id", "content_hash", "dup_of")
+# max distinct query terms sent to the full-text index
+_MAX_QUERY_TERMS = 32
+
+logger = logging.getLogger(__name__)
+
+class ChunkStore:
+    """
+    Chunk text + metadata keyed by the integer row label used in the vector index.
+    Lives next to the index so startup does not load every chunk into Python objects;
+    rows are fetched on demand for query results.
+    Deleted/replaced chunks are tombstoned (deleted=1) until compaction purges them.
+    Chunk text is also indexed in an FTS5 table (an inverted index ranked with BM25) kept in
+    sync by triggers, so lexical search is persisted in the same transactions as the chunks.
+    With read_only=True (processes that only serve queries) the database is opened mode=ro
+    and its schema is left to the writer.
+    Near-duplicate chunks (storage/near_dup.py) are stored as alias rows: their own text, id
+    and document, plus dup_of = the row whose vector they share. Aliases have no vector, but
+    their text is full-text indexed like any chunk and they are returned with their own text
+    (see aliases()). The LSH bucket keys of chunks that have a vector live in chunk_lsh.
+    """
+    def __init__(self, path: str, read_only: bool = False):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        if read_only and os.path.exists(path):
+            uri = pathlib.Path(path).resolve().as_uri() + "?mode=ro"
+            self.db = sqlite3.connect(uri, uri=True, check_same_thread=False, isolation_level=None)
+            self.has_fts = self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'chunks_fts'").fetchone() is not None
+            return
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            " row INTEGER PRIMARY KEY,"
+            " id TEXT NOT NULL,"
+            " text TEXT NOT NULL,"
+            " meta TEXT)"
+        )
+        self._add_missing_columns({"doc_id": "TEXT", "content_hash": "TEXT", "deleted": "INTEGER NOT NULL DEFAULT 0",
+                                   "dup_of": "INTEGER"})
+        self.db.execute("CREATE INDEX IF NOT EXISTS chunks_doc ON chunks (doc_id)")
+        # tombstones are re-read whenever another process commits; keep that lookup off a table scan
+        self.db.execute("CREATE INDEX IF NOT EXISTS chunks_deleted ON chunks (row) WHERE deleted = 1")
+        self.db.execute("CREATE INDEX IF NOT EXISTS chunks_dup_of ON chunks (dup_of) WHERE dup_of IS NOT NULL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS chunk_lsh (band INTEGER NOT NULL, bucket INTEGER NOT NULL,"
+                        " row INTEGER NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS chunk_lsh_bucket ON chunk_lsh (band, bucket)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS chunk_lsh_row ON chunk_lsh (row)")
+        self.has_fts = self._init_fts()
+        if read_only:
+            # the writer had not created the store yet; we made an empty one but never write to it
+            self.db.execute("PRAGMA query_only=ON")
+
+    def _init_fts(self) -> bool:
+        # REPLACE only fires the delete trigger with recursive triggers on
+        self.db.execute("PRAGMA recursive_triggers=ON")
+        exists = self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'chunks_fts'").fetchone()
+        try:
+            self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5("
+                            "text, content='chunks', content_rowid='row', tokenize='unicode61')")
+        except sqlite3.OperationalError as e:
+            logger.warning("SQLite FTS5 unavailable (%s); lexical search disabled", e)
+            return False
+        self.db.executescript("""
+            CREATE TRIGGER IF NOT EXISTS chunks_fts_ins AFTER INSERT ON chunks BEGIN
+                INSERT INTO chunks_fts (rowid, text) VALUES (new.row, new.text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS chunks_fts_del AFTER DELETE ON chunks BEGIN
+                INSERT INTO chunks_fts (chunks_fts, rowid, text) VALUES ('delete', old.row, old.text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS chunks_fts_upd AFTER UPDATE OF text ON chunks BEGIN
+                INSERT INTO chunks_fts (chunks_fts, rowid, text) VALUES ('delete', old.row, old.text);
+                INSERT INTO chunks_fts (rowid, text) VALUES (new.row, new.text);
+            END;
+        """)
+        if not exists:
+            # stores created before lexical search: index the existing chunks once
+            self.db.execute("INSERT INTO chunks_fts (chunks_fts) VALUES ('rebuild')")
+        return True
+
+    def _add_missing_columns(self, columns: Dict[str, str]):
+        # stores created before document ids existed
+        have = {r[1] for r in self.db.execute("PRAGMA table_info(chunks)")}
+        for name, decl in columns.items():
+            if name not in have:
+                self.db.execute(f"ALTER TABLE chunks ADD COLUMN {name} {decl}")
+
+    def insert(self, rows: Iterable[Tuple[int, Dict]], lsh_keys: Iterable[Optional[List[Tuple[int, int]]]] = ()):
+        """
+        Insert (row, chunk) pairs in one transaction. Chunk keys other than id/text/doc_id/content_hash/dup_of
+        go to `meta`. Existing rows are overwritten (used to refresh ids/offsets of unchanged chunks on upsert).
+        `lsh_keys`, aligned with `rows`, are the (band, bucket) keys to register each row under (None: none).
+        """
+        data, buckets = [], []
+        for (row, c), keys in itertools.zip_longest(rows, lsh_keys):
+            extra = {k: v for k, v in c.items() if k not in _COLUMNS}
+            data.append((int(row), c["id"], c["text"], c.get("doc_id"), c.get("content_hash"),
+                         json.dumps(extra) if extra else None, c.get("dup_of")))
+            buckets += [(band, bucket, int(row)) for band, bucket in keys or ()]
+        with self._tx():
+            self.db.executemany(
+                "INSERT OR REPLACE INTO chunks (row, id, text, doc_id, content_hash, meta, dup_of, deleted)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, 0)", data)
+            self.db.executemany("INSERT INTO chunk_lsh (band, bucket, row) VALUES (?, ?, ?)", buckets)
+
+    @contextmanager
+    def _tx(self):
+        with self._lock:
+            self.db.execute("BEGIN")
+            try:
+                yield
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def fetch(self, rows: List[int]) -> Dict[int, Dict]:
+        """
+        Live chunks by row.
+        """
+        out = {}
+        with self._lock:
+            for i in range(0, len(rows), 500):
+                part = [int(r) for r in rows[i:i + 500]]
+                marks = ",".join("?" * len(part))
+                q = ("SELECT row, id, text, doc_id, content_hash, meta FROM chunks"
+                     " WHERE deleted = 0 AND row IN (%s)" % marks)
+                for row, id_, text, doc_id, content_hash, meta in self.db.execute(q, part):
+                    item = {"id": id_, "text": text, "doc_id": doc_id, "content_hash": content_hash}
+                    if meta:
+                        item.update(json.loads(meta))
+                    out[row] = item
+        return out
+
+    def lsh_candidates(self, keys: List[Tuple[int, int]], limit: int = 50) -> List[Tuple[int, str]]:
+        """
+        (row, text) of live searchable chunks registered under any of the (band, bucket) keys.
+        """
+        if not keys:
+            return []
+        values = ",".join("(?, ?)" for _ in keys)
+        with self._lock:
+            return list(self.db.execute(
+                "SELECT chunks.row, chunks.text FROM chunks WHERE chunks.deleted = 0 AND chunks.row IN"
+                " (SELECT row FROM chunk_lsh WHERE (band, bucket) IN (VALUES %s)) LIMIT ?" % values,
+                [v for k in keys for v in k] + [int(limit)]))
+
+    def aliases(self, rows: List[int]) -> Dict[int, List[Tuple[int, Dict]]]:
+        """
+        Live alias rows pointing at each of `rows`: {row: [(alias_row, chunk)]} in row order.
+        """
+        out: Dict[int, List[Tuple[int, Dict]]] = {}
+        with self._lock:
+            for i in range(0, len(rows), 500):
+                part = [int(r) for r in rows[i:i + 500]]
+                q = ("SELECT row, dup_of, id, text, doc_id, content_hash, meta FROM chunks"
+                     " WHERE deleted = 0 AND dup_of IN (%s) ORDER BY row" % ",".join("?" * len(part)))
+                for row, dup_of, id_, text, doc_id, content_hash, meta in self.db.execute(q, part):
+                    item = {"id": id_, "text": text, "doc_id": doc_id, "content_hash": content_hash}
+                    if meta:
+                        item.update(json.loads(meta))
+                    out.setdefault(dup_of, []).append((row, item))
+        return out
+
+    def alias_rows(self, rows: List[int]) -> List[int]:
+        """
+        The members of `rows` that are aliases (rows without a vector of their own).
+        """
+        out = []
+        with self._lock:
+            for i in range(0, len(rows), 500):
+                part = [int(r) for r in rows[i:i + 500]]
+                q = "SELECT row FROM chunks WHERE dup_of IS NOT NULL AND row IN (%s)" % ",".join("?" * len(part))
+                out += [r for (r,) in self.db.execute(q, part)]
+        return out
+
+    def repoint(self, moves: Dict[int, int]):
+        """
+        Point the aliases of each old row at its new row (the old one is being retired).
+        """
+        with self._tx():
+            self.db.executemany("UPDATE chunks SET dup_of = ? WHERE dup_of = ?",
+                                [(int(new), int(old)) for old, new in moves.items()])
+
+    def search_text(self, query: str, limit: int = 20) -> List[Tuple[int, float]]:
+        """
+        BM25-ranked (row, score) pairs of live chunks matching any term of `query`; higher is better.
+        Aliases match on their own text.
+        Dotted/hyphenated terms such as clause numbers ("12.3") match as exact phrases.
+        """
+        match = fts_query(query)
+        if not self.has_fts or not match:
+            return []
+        with self._lock:
+            return [(row, -score) for row, score in self.db.execute(
+                "SELECT chunks_fts.rowid, bm25(chunks_fts) AS score FROM chunks_fts"
+                " JOIN chunks ON chunks.row = chunks_fts.rowid"
+                " WHERE chunks_fts MATCH ? AND chunks.deleted = 0"
+                " ORDER BY score LIMIT ?", (match, int(limit)))]
+
+    def doc_rows(self, doc_id: str) -> List[Tuple[int, str]]:
+        """
+        Live (row, content_hash) pairs of a document, in row order.
+        """
+        with self._lock:
+            return list(self.db.execute(
+                "SELECT row, content_hash FROM chunks WHERE doc_id = ? AND deleted = 0 ORDER BY row", (doc_id,)))
+
+    def mark_deleted(self, rows: List[int], refresh: Iterable[Tuple[int, Dict]] = ()):
+        """
+        Tombstone `rows`; optionally rewrite metadata of `refresh` rows in the same transaction
+        (an upsert keeps unchanged chunks but their ids/offsets may have moved).
+        """
+        data = []
+        for row, c in refresh:
+            extra = {k: v for k, v in c.items() if k not in _COLUMNS}
+            data.append((c["id"], c.get("doc_id"), json.dumps(extra) if extra else None, int(row)))
+        with self._tx():
+            self.db.executemany("UPDATE chunks SET deleted = 1 WHERE row = ?", [(int(r),) for r in rows])
+            self.db.executemany("UPDATE chunks SET id = ?, doc_id = ?, meta = ? WHERE row = ?", data)
+
+    def deleted_rows(self) -> List[int]:
+        """
+        Tombstoned rows that have a vector in the index (deleted aliases have none).
+        """
+        with self._lock:
+            return [r for (r,) in self.db.execute("SELECT row FROM chunks WHERE deleted = 1 AND dup_of IS NULL")]
+
+    def purge(self, rows: List[int]):
+        """
+        Physically remove tombstoned rows once compaction has dropped their vectors, and
+        any tombstoned aliases.
+        """
+        params = [(int(r),) for r in rows]
+        with self._tx():
+            self.db.executemany("DELETE FROM chunks WHERE row = ? AND deleted = 1", params)
+            self.db.executemany("DELETE FROM chunk_lsh WHERE row = ?", params)
+            self.db.execute("DELETE FROM chunks WHERE deleted = 1 AND dup_of IS NOT NULL")
+
+    def truncate(self, next_row: int) -> int:
+        """
+        Drop rows at or beyond `next_row`: leftovers of an ingest that crashed before its manifest commit.
+        """
+        with self._lock:
+            self.db.execute("DELETE FROM chunk_lsh WHERE row >= ?", (int(next_row),))
+            cur = self.db.execute("DELETE FROM chunks WHERE row >= ?", (int(next_row),))
+            return cur.rowcount
+
+    def count(self) -> int:
+        with self._lock:
+            return self.db.execute("SELECT COUNT(*) FROM chunks WHERE deleted = 0").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+def fts_query(text: str) -> str:
+    """
+    FTS5 MATCH expression OR-ing the terms of free text; every term is quoted, so user
+    input cannot inject FTS operators.
+    """
+    phrases = []
+    for term in re.findall(r"\w+(?:[.\-/]\w+)*", text.lower()):
+        phrase = '"' + " ".join(re.findall(r"[^\W_]+", term)) + '"'
+        if phrase != '""' and phrase not in phrases:
+            phrases.append(phrase)
+    return " OR ".join(phrases[:_MAX_QUERY_TERMS])
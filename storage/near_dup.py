@@ -0,0 +1,79 @@
+# near_dup.py - MinHash / LSH near-duplicate detection for chunks at ingest
+# storage/near_dup.py
+import os, re, hashlib
+import numpy as np
+from typing import List, Optional, Set, Tuple
+
+# chunks whose word shingles overlap an indexed chunk at least this much (Jaccard) share its vector
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "1") == "1"
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.85"))
+DEDUP_SHINGLE_WORDS = int(os.getenv("DEDUP_SHINGLE_WORDS", "5"))
+# shorter chunks are too little evidence to call duplicates; they are always indexed
+DEDUP_MIN_WORDS = int(os.getenv("DEDUP_MIN_WORDS", "20"))
+# signature length = bands * rows per band; 16 x 8 makes pairs at 0.85 candidates ~99% of the
+# time and pairs at 0.5 only ~6%
+DEDUP_BANDS = int(os.getenv("DEDUP_BANDS", "16"))
+DEDUP_BAND_ROWS = int(os.getenv("DEDUP_BAND_ROWS", "8"))
+
+_PRIME = (1 << 61) - 1
+_WORD = re.compile(r"\w+")
+
+def shingles(text: str, size: int = DEDUP_SHINGLE_WORDS) -> Set[str]:
+    words = _WORD.findall(text.lower())
+    if len(words) <= size:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+def _hash64(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "little")
+
+class MinHashLSH:
+    """
+    MinHash signatures over word shingles, cut into bands for locality-sensitive hashing.
+    Every band of a signature hashes to one (band, bucket) key; chunks sharing any key are
+    candidate duplicates, which are then confirmed by exact shingle Jaccard. The keys of
+    indexed chunks are persisted by the chunk store, so a lookup costs one indexed query
+    per chunk no matter how large the corpus is.
+    """
+    def __init__(self, threshold: float = DEDUP_THRESHOLD, bands: int = DEDUP_BANDS, band_rows: int = DEDUP_BAND_ROWS,
+                 shingle_words: int = DEDUP_SHINGLE_WORDS, min_words: int = DEDUP_MIN_WORDS, seed: int = 1):
+        self.threshold = threshold
+        self.bands = bands
+        self.band_rows = band_rows
+        self.shingle_words = shingle_words
+        self.min_words = min_words
+        # fixed seed: persisted bucket keys must stay comparable across processes and restarts
+        rng = np.random.default_rng(seed)
+        n = bands * band_rows
+        self._a = rng.integers(1, 1 << 31, size=n, dtype=np.uint64)
+        self._b = rng.integers(0, 1 << 31, size=n, dtype=np.uint64)
+
+    def shingles(self, text: str) -> Optional[Set[str]]:
+        """
+        Shingle set of `text`, or None if it is too short to deduplicate.
+        """
+        if len(_WORD.findall(text)) < self.min_words:
+            return None
+        return shingles(text, self.shingle_words)
+
+    def signature(self, sh: Set[str]) -> np.ndarray:
+        # 32-bit shingle hashes keep a * x + b below 2**63, so uint64 arithmetic does not wrap
+        x = np.fromiter((_hash64(s) & 0xFFFFFFFF for s in sh), dtype=np.uint64, count=len(sh))
+        return ((self._a[:, None] * x[None, :] + self._b[:, None]) % _PRIME).min(axis=1)
+
+    def keys(self, sh: Set[str]) -> List[Tuple[int, int]]:
+        """
+        (band, bucket) LSH keys of a shingle set; buckets are signed 64-bit for SQLite.
+        """
+        sig = self.signature(sh).reshape(self.bands, self.band_rows)
+        out = []
+        for band, part in enumerate(sig):
+            digest = hashlib.blake2b(part.tobytes(), digest_size=8).digest()
+            out.append((band, int.from_bytes(digest, "little", signed=True)))
+        return out
+
+    def is_duplicate(self, a: Set[str], b: Set[str]) -> bool:
+        return jaccard(a, b) >= self.threshold
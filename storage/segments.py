@@ -0,0 +1,168 @@
+# segments.py - Append-only vector segments with an atomic manifest
+# storage/segments.py
+import os, json, copy, logging
+from typing import Dict, List, Tuple, Optional
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process writer lock
+    fcntl = None
+
+MANIFEST = "MANIFEST.json"
+
+logger = logging.getLogger(__name__)
+
+def _empty_manifest() -> Dict:
+    return {"version": 1, "dim": None, "generation": 0, "next_row": 0, "next_segment": 1,
+            "segments": [], "snapshot": None}
+
+class SegmentStore:
+    """
+    Directory of immutable segments plus a manifest naming the live ones.
+    - segment = <name>.rows.npy (int64 row labels) + <name>.vec.npy (L2-normalized float32)
+    - files are written under a temp name and renamed into place
+    - the manifest is replaced atomically, so a crash mid-ingest leaves the previous
+      manifest (and therefore the previous index) intact
+    """
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.manifest = self._load()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def _load(self) -> Dict:
+        path = self._file(MANIFEST)
+        if not os.path.exists(path):
+            return _empty_manifest()
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def exists(self) -> bool:
+        return os.path.exists(self._file(MANIFEST))
+
+    def stamp(self) -> Optional[Tuple[int, int, int]]:
+        """
+        Cheap change marker of the committed manifest (a commit replaces the file, so the inode changes).
+        """
+        try:
+            st = os.stat(self._file(MANIFEST))
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def reload(self) -> Dict:
+        """
+        Re-read the manifest committed by another process.
+        """
+        self.manifest = self._load()
+        return self.manifest
+
+    def new_segment_name(self, manifest: Dict) -> str:
+        name = f"seg-{manifest['next_segment']:06d}"
+        manifest["next_segment"] += 1
+        return name
+
+    def write_segment(self, name: str, rows: np.ndarray, vecs: np.ndarray) -> Dict:
+        self._write_npy(f"{name}.rows.npy", np.asarray(rows, dtype="int64"))
+        self._write_npy(f"{name}.vec.npy", np.asarray(vecs, dtype="float32"))
+        return {"name": name, "count": int(len(rows))}
+
+    def read_segment(self, seg: Dict, mmap: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+        mode = "r" if mmap else None
+        rows = np.load(self._file(f"{seg['name']}.rows.npy"), mmap_mode=mode)
+        vecs = np.load(self._file(f"{seg['name']}.vec.npy"), mmap_mode=mode)
+        return rows, vecs
+
+    def _write_npy(self, fname: str, arr: np.ndarray):
+        tmp = self._file(fname + ".tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, arr)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._file(fname))
+
+    def write_file(self, fname: str, data: bytes):
+        tmp = self._file(fname + ".tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._file(fname))
+
+    def path_of(self, fname: str) -> str:
+        return self._file(fname)
+
+    def draft(self) -> Dict:
+        """
+        Working copy of the manifest to mutate and then commit().
+        """
+        return copy.deepcopy(self.manifest)
+
+    def commit(self, manifest: Dict):
+        manifest["generation"] = manifest.get("generation", 0) + 1
+        self.write_file(MANIFEST, json.dumps(manifest, indent=1).encode())
+        self.manifest = manifest
+
+    def referenced_files(self) -> set:
+        names = {MANIFEST}
+        for seg in self.manifest["segments"]:
+            names.add(f"{seg['name']}.rows.npy")
+            names.add(f"{seg['name']}.vec.npy")
+        snap = self.manifest.get("snapshot")
+        if snap:
+            names.add(snap["file"])
+        return names
+
+    def remove_unreferenced(self) -> List[str]:
+        """
+        Delete segment/snapshot files the manifest does not name (crashed ingest, finished compaction).
+        """
+        keep = self.referenced_files()
+        removed = []
+        for fname in os.listdir(self.root):
+            if fname not in keep:
+                try:
+                    os.remove(self._file(fname))
+                    removed.append(fname)
+                except OSError:
+                    pass
+        return removed
+
+class WriterLock:
+    """
+    Advisory exclusive lock (flock) naming the single process allowed to change a store.
+    Held for the life of the process and released by the OS when it exits.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = None
+
+    def acquire(self, blocking: bool = False) -> bool:
+        if self._fd is not None:
+            return True
+        if fcntl is None:
+            logger.warning("No flock on this platform; %s is not protected against a second writer", self.path)
+            self._fd = -1
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except OSError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None and self._fd >= 0:
+            os.close(self._fd)  # closing the descriptor drops the flock
+        self._fd = None
+
+    @property
+    def held(self) -> bool:
+        return self._fd is not None
@@ -0,0 +1,183 @@
+# vector_index.py - ANN index construction, training and search for the vector store
+# storage/vector_index.py
+import os, logging
+from typing import Optional, Tuple
+import numpy as np
+
+# Try FAISS first, fallback to hnswlib if FAISS not available
+try:
+    import faiss
+    HAS_FAISS = True
+except Exception:
+    HAS_FAISS = False
+    import hnswlib
+
+# flat (exact), ivf_flat, ivf_pq, hnsw, sq8 (int8 scalar quantization) or sq_fp16.
+# Without FAISS every type maps to an hnswlib graph.
+VECTORSTORE_INDEX = os.getenv("VECTORSTORE_INDEX", "flat")
+# kinds that need training stay exact (flat) until the corpus reaches this many vectors;
+# the next compaction then trains and snapshots the configured index
+VECTORSTORE_TRAIN_THRESHOLD = int(os.getenv("VECTORSTORE_TRAIN_THRESHOLD", "20000"))
+VECTORSTORE_TRAIN_SAMPLE = int(os.getenv("VECTORSTORE_TRAIN_SAMPLE", "100000"))
+# 0 = derived from the corpus size at training time
+VECTORSTORE_IVF_NLIST = int(os.getenv("VECTORSTORE_IVF_NLIST", "0"))
+VECTORSTORE_PQ_M = int(os.getenv("VECTORSTORE_PQ_M", "0"))
+VECTORSTORE_PQ_BITS = int(os.getenv("VECTORSTORE_PQ_BITS", "8"))
+VECTORSTORE_HNSW_M = int(os.getenv("VECTORSTORE_HNSW_M", "32"))
+VECTORSTORE_HNSW_EF_CONSTRUCTION = int(os.getenv("VECTORSTORE_HNSW_EF_CONSTRUCTION", "200"))
+# search-time defaults: IVF lists probed, HNSW candidate list size
+VECTORSTORE_NPROBE = int(os.getenv("VECTORSTORE_NPROBE", "16"))
+VECTORSTORE_EF_SEARCH = int(os.getenv("VECTORSTORE_EF_SEARCH", "64"))
+# quantized indexes fetch top_k * factor candidates and re-score them exactly; 0 disables
+VECTORSTORE_RERANK_FACTOR = int(os.getenv("VECTORSTORE_RERANK_FACTOR", "4"))
+
+INDEX_KINDS = ("flat", "ivf_flat", "ivf_pq", "hnsw", "sq8", "sq_fp16")
+# kinds that cannot be built before they have seen data
+TRAINED_KINDS = ("ivf_flat", "ivf_pq", "sq8")
+# kinds whose scores are approximations of the true inner product
+LOSSY_KINDS = ("ivf_pq", "sq8", "sq_fp16")
+
+logger = logging.getLogger(__name__)
+
+def configured_kind(kind: Optional[str] = None) -> str:
+    kind = (kind or VECTORSTORE_INDEX).lower()
+    if kind not in INDEX_KINDS:
+        raise ValueError(f"Unknown vector index type {kind!r}; expected one of {', '.join(INDEX_KINDS)}")
+    return kind if HAS_FAISS else "hnsw"
+
+def buildable_kind(kind: str, total: int, threshold: int = VECTORSTORE_TRAIN_THRESHOLD) -> str:
+    """
+    The kind to build for a corpus of `total` vectors: `kind` itself, or flat while a
+    trained kind does not have enough data yet.
+    """
+    if kind in TRAINED_KINDS and total < max(threshold, 1):
+        return "flat"
+    return kind
+
+def new_index(kind: str, dim: int, capacity: int = 0, train: Optional[np.ndarray] = None):
+    """
+    Empty index of `kind`. FAISS indexes are wrapped in IDMap2 so search returns our stable
+    row labels; trained kinds are trained on `train` (a sample of normalized vectors).
+    """
+    if not HAS_FAISS:
+        index = hnswlib.Index(space='cosine', dim=dim)
+        # sized for the vectors it is built from; the store never adds to a built index
+        index.init_index(max_elements=max(capacity, 1),
+                         ef_construction=VECTORSTORE_HNSW_EF_CONSTRUCTION, M=VECTORSTORE_HNSW_M)
+        return index
+    ip = faiss.METRIC_INNER_PRODUCT
+    if kind == "flat":
+        inner = faiss.IndexFlatIP(dim)
+    elif kind == "hnsw":
+        inner = faiss.IndexHNSWFlat(dim, VECTORSTORE_HNSW_M, ip)
+        inner.hnsw.efConstruction = VECTORSTORE_HNSW_EF_CONSTRUCTION
+    elif kind == "sq8":
+        inner = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, ip)
+    elif kind == "sq_fp16":
+        inner = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16, ip)
+    elif kind in ("ivf_flat", "ivf_pq"):
+        if train is None:
+            raise ValueError(f"{kind} index needs training vectors")
+        nlist = VECTORSTORE_IVF_NLIST or _auto_nlist(len(train))
+        quantizer = faiss.IndexFlatIP(dim)
+        if kind == "ivf_flat":
+            inner = faiss.IndexIVFFlat(quantizer, dim, nlist, ip)
+        else:
+            inner = faiss.IndexIVFPQ(quantizer, dim, nlist, VECTORSTORE_PQ_M or _auto_pq_m(dim), VECTORSTORE_PQ_BITS, ip)
+        inner.nprobe = VECTORSTORE_NPROBE
+    else:
+        raise ValueError(f"Unknown vector index type {kind!r}")
+    if not inner.is_trained:
+        if train is None:
+            raise ValueError(f"{kind} index needs training vectors")
+        inner.train(np.ascontiguousarray(train, dtype="float32"))
+    return faiss.IndexIDMap2(inner)
+
+def training_sample(vecs: np.ndarray, size: int = VECTORSTORE_TRAIN_SAMPLE, seed: int = 0) -> np.ndarray:
+    if len(vecs) <= size:
+        return np.ascontiguousarray(vecs, dtype="float32")
+    pick = np.sort(np.random.default_rng(seed).choice(len(vecs), size=size, replace=False))
+    return np.ascontiguousarray(vecs[pick], dtype="float32")
+
+def _auto_nlist(n: int) -> int:
+    # ~4 * sqrt(n) lists, but keep >= 39 training points per centroid
+    return int(max(1, min(4 * np.sqrt(n), n // 39)))
+
+def _auto_pq_m(dim: int) -> int:
+    # largest sub-quantizer count <= 64 that divides dim (3072 -> 64 codes of 48 dims)
+    return max(m for m in range(1, min(64, dim) + 1) if dim % m == 0)
+
+def bytes_per_vector(kind: str, dim: int) -> int:
+    """
+    Approximate memory one vector takes in an index of `kind` (codes, graph links and the
+    IDMap label); used to report what deduplication saves.
+    """
+    if not HAS_FAISS or kind == "hnsw":
+        return 4 * dim + 2 * VECTORSTORE_HNSW_M * 4 + 8
+    code = {"flat": 4 * dim, "ivf_flat": 4 * dim, "sq8": dim, "sq_fp16": 2 * dim,
+            "ivf_pq": (VECTORSTORE_PQ_M or _auto_pq_m(dim)) * VECTORSTORE_PQ_BITS // 8}[kind]
+    return code + 8
+
+def index_add(index, vecs: np.ndarray, rows: np.ndarray):
+    if HAS_FAISS:
+        index.add_with_ids(np.ascontiguousarray(vecs, dtype="float32"), np.asarray(rows, dtype="int64"))
+    else:
+        index.add_items(np.asarray(vecs, dtype="float32"), np.asarray(rows, dtype="int64"))
+
+def index_count(index) -> int:
+    return index.ntotal if HAS_FAISS else index.get_current_count()
+
+def index_tombstone(index, rows) -> int:
+    """
+    Hide `rows` from hnswlib searches (it filters deleted labels natively; FAISS hits are
+    filtered by the caller). Returns how many labels were newly marked.
+    """
+    if HAS_FAISS:
+        return 0
+    marked = 0
+    for r in rows:
+        try:
+            index.mark_deleted(int(r))
+            marked += 1
+        except RuntimeError:
+            pass  # not in this index (e.g. purged already) or already marked
+    return marked
+
+def index_search(index, kind: str, mat: np.ndarray, k: int, nprobe: Optional[int] = None,
+                 ef: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    (scores, labels) for each query row, best first; missing hits have label -1.
+    Scores are inner products of normalized vectors (cosine similarity).
+    """
+    if not HAS_FAISS:
+        # set_ef is index-wide; callers hold the store lock while searching
+        index.set_ef(max(ef or VECTORSTORE_EF_SEARCH, k))
+        labels, distances = index.knn_query(mat, k=k)
+        return 1.0 - distances, labels.astype("int64")
+    params = None
+    if kind in ("ivf_flat", "ivf_pq"):
+        params = faiss.SearchParametersIVF(nprobe=nprobe or VECTORSTORE_NPROBE)
+    elif kind == "hnsw":
+        params = faiss.SearchParametersHNSW(efSearch=max(ef or VECTORSTORE_EF_SEARCH, k))
+    return index.search(mat, k, params=params)
+
+def load_index(path: str, dim: int, mmap: bool = False):
+    """
+    Read a saved index. With mmap=True a FAISS index is mapped read-only, so processes
+    serving the same snapshot share its pages; hnswlib always loads into memory.
+    """
+    if HAS_FAISS:
+        return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if mmap else 0)
+    index = hnswlib.Index(space='cosine', dim=dim)
+    index.load_index(path)
+    return index
+
+def save_index(index, segments, fname: str):
+    # written through the segment store so the snapshot lands atomically
+    if HAS_FAISS:
+        segments.write_file(fname, faiss.serialize_index(index).tobytes())
+    else:
+        index.save_index(segments.path_of(fname))
+
+def snapshot_suffix() -> str:
+    return "faiss" if HAS_FAISS else "hnsw"
@@ -1,103 +1,679 @@
 # storage/vectorstore.py
 import os
+import time
 import pickle
+import logging
+import threading
 import numpy as np
-from typing import List, Dict
-
-# Try FAISS first, fallback to hnswlib if FAISS not available
-try:
-    import faiss
-    _HAS_FAISS = True
-except Exception:
-    _HAS_FAISS = False
-    import hnswlib
+from typing import List, Dict, Optional, Set, Tuple
 
 from services.llm_client import OpenAIClient
+from services.tokenizer import count_tokens
+from storage.chunk_store import ChunkStore
+from storage.near_dup import DEDUP_ENABLED, MinHashLSH, shingles, jaccard
+from storage.segments import SegmentStore, WriterLock
+from storage.vector_index import (HAS_FAISS, LOSSY_KINDS, VECTORSTORE_RERANK_FACTOR, VECTORSTORE_TRAIN_THRESHOLD,
+                                  configured_kind, buildable_kind, new_index, training_sample, index_add, index_count,
+                                  index_tombstone, index_search, load_index, save_index, snapshot_suffix,
+                                  bytes_per_vector)
+
+# Merge segments in the background once there are more than this many,
+# or once this fraction of indexed vectors are tombstones
+COMPACT_SEGMENTS = int(os.getenv("VECTORSTORE_COMPACT_SEGMENTS", "8"))
+COMPACT_DEAD_RATIO = float(os.getenv("VECTORSTORE_COMPACT_DEAD_RATIO", "0.2"))
+# ...or once this many vectors are outside the snapshot (searched exactly, in private memory)
+COMPACT_DELTA_ROWS = int(os.getenv("VECTORSTORE_COMPACT_DELTA_ROWS", "10000"))
+# "writer", "reader", or "auto" (writer if no other process holds the writer lock)
+VECTORSTORE_ROLE = os.getenv("VECTORSTORE_ROLE", "auto")
+# seconds between checks of the manifest for commits by the writer (readers only)
+VECTORSTORE_RELOAD_INTERVAL = float(os.getenv("VECTORSTORE_RELOAD_INTERVAL", "1.0"))
+
+logger = logging.getLogger(__name__)
+
+def _normalize(arr: np.ndarray) -> np.ndarray:
+    arr = np.ascontiguousarray(arr, dtype="float32")
+    norms = np.linalg.norm(arr, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return arr / norms
 
 class VectorStore:
-    def __init__(self, path: str, dim: int = None):
+    """
+    Vector index persisted as append-only segments (storage/segments.py) with chunk text
+    and metadata in a SQLite side store (storage/chunk_store.py).
+    - ingest writes one small immutable segment + metadata rows, then commits the manifest
+    - a background compactor merges segments and snapshots the built index
+    - anything not committed to the manifest is discarded at startup
+    - documents can be upserted/deleted; removed chunks are tombstoned, filtered out
+      at query time and purged by compaction
+    - chunk text is full-text indexed in the side store for lexical_query()
+    - the index type is configurable (storage/vector_index.py); types that need training
+      are served exactly until the corpus is large enough, then trained by compaction
+    - the snapshot index is memory-mapped read-only; segments committed after it (the
+      "delta") are searched exactly from memory and folded in by the next compaction
+    - one process per store is the writer (it holds <path>.writer.lock); any number of
+      read-only processes share the mapped pages and reload when the manifest changes
+    - document upserts store near-duplicate chunks (MinHash/LSH, storage/near_dup.py) without
+      a vector of their own: they share the vector of the chunk they repeat, and a hit on it
+      returns every copy with its own text, as if each had been indexed
+    Files: <path>.segments/, <path>.chunks.db and <path>.writer.lock
+    """
+    def __init__(self, path: str, dim: int = None, embedder: OpenAIClient = None, index_kind: str = None,
+                 train_threshold: int = VECTORSTORE_TRAIN_THRESHOLD, rerank_factor: int = VECTORSTORE_RERANK_FACTOR,
+                 role: str = VECTORSTORE_ROLE, reload_interval: float = VECTORSTORE_RELOAD_INTERVAL,
+                 dedup: bool = DEDUP_ENABLED):
         self.path = path
         self.dim = dim  # will be set on first add if None
+        # one client per store; it batches and parallelizes embedding calls
+        self.embedder = embedder or OpenAIClient()
+        self.target_kind = configured_kind(index_kind)
+        self.train_threshold = train_threshold
+        self.rerank_factor = rerank_factor
+        self.reload_interval = reload_interval
+        self.near_dup = MinHashLSH() if dedup else None
+        self._lock = threading.RLock()
+        self._compacting = False
+        self._compact_lock = threading.Lock()  # one merge at a time (background or explicit)
+        self._vector_view = None
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.writer_lock = WriterLock(self.path + ".writer.lock")
+        if role == "reader":
+            self.read_only = True
+        elif self.writer_lock.acquire():
+            self.read_only = False
+        elif role == "writer":
+            raise RuntimeError(f"Another process is the writer of vector store {self.path}")
+        else:
+            self.read_only = True
+            logger.info("Vector store %s is owned by another process; serving it read-only", self.path)
         self._init_store()
 
+    @property
+    def generation(self) -> int:
+        # bumped whenever the index content changes; caches keyed on retrieval results compare against it
+        self.refresh()
+        return self.segments.manifest["generation"]
+
     def _init_store(self):
-        os.makedirs(os.path.dirname(self.path), exist_ok=True)
-        meta_path = self.path + ".meta"
-        if os.path.exists(meta_path):
-            with open(meta_path, "rb") as f:
-                meta = pickle.load(f)
-                self.dim = meta["dim"]
-                self.ids = meta["ids"]
-                self.metadatas = meta["metadatas"]
-        else:
-            self.ids = []
-            self.metadatas = []
-        if _HAS_FAISS:
-            self.index = None
-            if os.path.exists(self.path + ".index"):
-                self.index = faiss.read_index(self.path + ".index")
+        self.index, self.index_kind, self._snapshot_file, self._base_dead = None, None, None, 0
+        self._tombstones = set()
+        self._set_delta([])
+        self.segments = SegmentStore(self.path + ".segments")
+        self.chunks = ChunkStore(self.path + ".chunks.db", read_only=self.read_only)
+        if not self.read_only:
+            if not self.segments.exists() and os.path.exists(self.path + ".meta"):
+                self._migrate_legacy()
+            # discard leftovers of an ingest that did not reach its manifest commit
+            dropped = self.chunks.truncate(self.segments.manifest["next_row"])
+            removed = self.segments.remove_unreferenced()
+            if dropped or removed:
+                logger.warning("Discarded uncommitted ingest data: %d chunk rows, files %s", dropped, removed)
+        self._stamp = self.segments.stamp()
+        self._checked = time.monotonic()
+        self._load(self.segments.manifest)
+        if not self.read_only and self.dim is not None:
+            self._maybe_compact()
+
+    def _load(self, manifest: Dict):
+        """
+        (Re)build the in-memory view of `manifest`: the snapshot index (reopened only if it
+        changed), the delta of segments it does not cover, and the tombstones.
+        """
+        if manifest["dim"] is not None:
+            self.dim = manifest["dim"]
+        self._tombstones = set(self.chunks.deleted_rows())
+        self._vector_view = None
+        snap = manifest.get("snapshot")
+        if snap and snap["file"] != self._snapshot_file:
+            try:
+                index = load_index(self.segments.path_of(snap["file"]), self.dim, mmap=True)
+                # snapshots written before index types were configurable are flat (or hnswlib)
+                self._set_base(index, snap.get("kind", "flat" if HAS_FAISS else "hnsw"), snap["file"])
+            except Exception as e:
+                logger.warning("Ignoring unreadable index snapshot %s: %s", snap["file"], e)
+                self._set_base(None, None, None)
+        elif not snap:
+            self._set_base(None, None, None)
+        covered = set(snap["segments"]) if snap and self._snapshot_file else set()
+        self._set_delta([s for s in manifest["segments"] if s["name"] not in covered])
+        if self.index is not None:
+            self._base_dead += index_tombstone(self.index, self._tombstones)
+
+    def _set_base(self, index, kind: Optional[str], snapshot_file: Optional[str]):
+        self.index, self.index_kind, self._snapshot_file, self._base_dead = index, kind, snapshot_file, 0
+
+    def _set_delta(self, segments: List[Dict]):
+        # segments outside the snapshot, held in memory and searched exactly
+        parts = [self.segments.read_segment(s) for s in segments] if segments else []
+        self._delta_rows = np.concatenate([r for r, _ in parts]) if parts else np.empty(0, dtype="int64")
+        self._delta_vecs = (np.ascontiguousarray(np.concatenate([v for _, v in parts])) if parts
+                            else np.empty((0, self.dim or 0), dtype="float32"))
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        Read-only stores: pick up segments, snapshots and tombstones committed by the writer
+        process. Checks the manifest's stat at most every `reload_interval` seconds.
+        """
+        if not self.read_only:
+            return False
+        now = time.monotonic()
+        if not force and now - self._checked < self.reload_interval:
+            return False
+        self._checked = now
+        stamp = self.segments.stamp()
+        if stamp == self._stamp:
+            return False
+        with self._lock:
+            try:
+                self._load(self.segments.reload())
+                self._stamp = stamp
+            except Exception as e:
+                # e.g. a snapshot removed by a compaction that committed after our read; retry next time
+                logger.warning("Vector store reload failed: %s", e)
+                return False
+        logger.info("Reloaded vector store %s at generation %d", self.path, self.segments.manifest["generation"])
+        return True
+
+    def _check_writable(self):
+        if self.read_only:
+            raise PermissionError(f"Vector store {self.path} is open read-only; writes go to the writer process")
+
+    def _desired_kind(self, total: int) -> str:
+        return buildable_kind(self.target_kind, total, self.train_threshold)
+
+    def _migrate_legacy(self):
+        # one-off import of the old single-file layout (<path>.meta pickle + .index/.hnsw)
+        with open(self.path + ".meta", "rb") as f:
+            meta = pickle.load(f)
+        n = len(meta["metadatas"])
+        if n == 0:
+            return
+        if HAS_FAISS and os.path.exists(self.path + ".index"):
+            vecs = load_index(self.path + ".index", meta["dim"]).reconstruct_n(0, n)
+        elif not HAS_FAISS and os.path.exists(self.path + ".hnsw"):
+            legacy = load_index(self.path + ".hnsw", meta["dim"])
+            vecs = np.array(legacy.get_items(list(range(n))), dtype="float32")
         else:
-            # hnswlib fallback
-            self.index = None
-            if os.path.exists(self.path + ".hnsw"):
-                self.index = hnswlib.Index(space='cosine', dim=self.dim)
-                self.index.load_index(self.path + ".hnsw")
+            logger.warning("Legacy metadata found without a matching index; not migrating")
+            return
+        logger.info("Migrating %d legacy vectors into segments", n)
+        self._append(meta["metadatas"], _normalize(vecs))
 
     def add_documents(self, chunks: List[Dict]) -> List[str]:
-        client = OpenAIClient()
-        embeddings = []
+        if not chunks:
+            return []
+        embeddings = self.embedder.embed_batch([c["text"] for c in chunks])
+        return self.add_embeddings(chunks, embeddings)
+
+    def add_embeddings(self, chunks: List[Dict], embeddings: List[List[float]]) -> List[str]:
+        """
+        Index chunks whose embeddings were computed by the caller (e.g. the async client).
+        """
+        if not chunks:
+            return []
+        arr = _normalize(np.array(embeddings, dtype="float32"))
+        self._append(chunks, arr)
+        self._maybe_compact()
+        return [c["id"] for c in chunks]
+
+    def _append(self, chunks: List[Dict], arr: np.ndarray, lsh_keys=()) -> np.ndarray:
+        self._check_writable()
+        with self._lock:
+            manifest = self.segments.draft()
+            if manifest["dim"] is None:
+                manifest["dim"] = self.dim or arr.shape[1]
+                self.dim = manifest["dim"]
+            if arr.shape[1] != manifest["dim"]:
+                raise ValueError(f"Embedding dim {arr.shape[1]} does not match index dim {manifest['dim']}")
+            start = manifest["next_row"]
+            rows = np.arange(start, start + len(chunks), dtype="int64")
+            # order matters for crash safety: segment files, then metadata rows, then the manifest
+            name = self.segments.new_segment_name(manifest)
+            seg = self.segments.write_segment(name, rows, arr)
+            self.chunks.insert(zip(rows.tolist(), chunks), lsh_keys)
+            manifest["segments"].append(seg)
+            manifest["next_row"] = start + len(chunks)
+            self.segments.commit(manifest)
+            self._vector_view = None
+
+            # searchable right away from the delta; the next compaction moves it into the snapshot
+            self._delta_rows = np.concatenate([self._delta_rows, rows])
+            self._delta_vecs = np.concatenate([self._delta_vecs, arr]) if len(self._delta_vecs) else arr
+        return rows
+
+    def _add_aliases(self, aliases: List[Dict]) -> List[int]:
+        """
+        Store near-duplicate chunks (each with 'dup_of' = the row whose vector it shares) as
+        alias rows. They take no vector but are committed through the manifest like any
+        ingest, so a crash cannot leave them half-written.
+        """
+        self._check_writable()
+        with self._lock:
+            manifest = self.segments.draft()
+            start = manifest["next_row"]
+            rows = list(range(start, start + len(aliases)))
+            self.chunks.insert(zip(rows, aliases))
+            manifest["next_row"] = start + len(aliases)
+            self.segments.commit(manifest)
+        return rows
+
+    def find_duplicate(self, sh: Set[str], keys: List[Tuple[int, int]]) -> Optional[int]:
+        """
+        Row of the indexed chunk most similar to shingle set `sh` (LSH keys `keys`) if it
+        reaches the near-duplicate threshold, else None.
+        """
+        best, best_score = None, 0.0
+        for row, text in self.chunks.lsh_candidates(keys):
+            score = jaccard(sh, shingles(text, self.near_dup.shingle_words))
+            if score >= self.near_dup.threshold and score > best_score:
+                best, best_score = row, score
+        return best
+
+    def changed_chunks(self, doc_id: str, chunks: List[Dict]) -> List[Dict]:
+        """
+        Chunks of `doc_id` whose content hash is not already indexed, i.e. the only ones
+        an upsert needs embeddings for.
+        """
+        return DocumentUpsert(self, doc_id).changed(chunks)
+
+    def upsert_document(self, doc_id: str, chunks: List[Dict], vectors: Optional[Dict[str, List[float]]] = None) -> Dict:
+        """
+        Make the index hold exactly `chunks` for `doc_id`.
+        Unchanged chunks (same content_hash) keep their vectors and are never re-embedded;
+        new ones are embedded (or taken from `vectors`, keyed by content_hash) and appended;
+        chunks that disappeared are tombstoned.
+        """
+        with self._lock:
+            upsert = self.begin_upsert(doc_id)
+            upsert.add(chunks, vectors)
+            return upsert.finish()
+
+    def begin_upsert(self, doc_id: str) -> "DocumentUpsert":
+        """
+        Incremental form of upsert_document for streaming ingest: add() batches as they
+        are produced, then finish() tombstones whatever the new version no longer contains.
+        """
+        self._check_writable()
+        return DocumentUpsert(self, doc_id)
+
+    def delete_document(self, doc_id: str) -> int:
+        self._check_writable()
+        with self._lock:
+            rows = [r for r, _ in self.chunks.doc_rows(doc_id)]
+            if rows:
+                self._retire(rows)
+        self._maybe_compact()
+        return len(rows)
+
+    def _retire(self, rows: List[int], refresh=()):
+        # tombstones are durable in the chunk store; the manifest commit bumps the generation
+        aliases = set(self.chunks.alias_rows(rows)) if rows else set()
+        indexed = [r for r in rows if r not in aliases]
+        promoted = self._promote_aliases(indexed, set(rows))
+        self.chunks.mark_deleted(list(rows) + promoted, refresh=refresh)
+        self._tombstones.update(indexed)
+        if self.index is not None:
+            self._base_dead += index_tombstone(self.index, indexed)
+        self.segments.commit(self.segments.draft())
+
+    def _promote_aliases(self, rows: List[int], retiring: Set[int]) -> List[int]:
+        """
+        Chunks being retired may still be shared by near-duplicates in other documents. For
+        each, the first surviving alias is re-added as a searchable chunk with the same
+        vector (nothing is re-embedded) and the remaining aliases are pointed at it.
+        Returns the promoted aliases' old rows, to be retired along with `rows`.
+        """
+        heirs = {}
+        for row, group in (self.chunks.aliases(rows) if rows else {}).items():
+            alive = [(r, c) for r, c in group if r not in retiring]
+            if alive:
+                heirs[row] = alive[0]
+        if not heirs:
+            return []
+        old = np.array(sorted(heirs), dtype="int64")
+        chunks = [heirs[r][1] for r in old.tolist()]
+        keys = []
         for c in chunks:
-            emb = client.embed_text(c["text"])
-            emb = np.array(emb, dtype="float32")
-            embeddings.append(emb)
-            self.metadatas.append({"id": c["id"], "text": c["text"]})
-            self.ids.append(c["id"])
-
-        arr = np.vstack(embeddings)
-        if self.dim is None:
-            self.dim = arr.shape[1]
-
-        if _HAS_FAISS:
-            if self.index is None:
-                self.index = faiss.IndexFlatIP(self.dim)
-            faiss.normalize_L2(arr)
-            self.index.add(arr)
-            faiss.write_index(self.index, self.path + ".index")
-        else:
-            # hnswlib init or add
-            if self.index is None:
-                self.index = hnswlib.Index(space='cosine', dim=self.dim)
-                self.index.init_index(max_elements=100000, ef_construction=200, M=16)
-            ids = list(range(len(self.ids) - len(chunks), len(self.ids)))
-            self.index.add_items(arr, ids)
-            self.index.save_index(self.path + ".hnsw")
-
-        # persist metadata
-        with open(self.path + ".meta", "wb") as f:
-            pickle.dump({"dim": self.dim, "ids": self.ids, "metadatas": self.metadatas}, f)
-        return [m["id"] for m in self.metadatas[-len(chunks):]]
-
-    def query(self, embedding, top_k=5):
-        import numpy as np
-        vec = np.array(embedding, dtype="float32").reshape(1, -1)
-        if _HAS_FAISS:
-            faiss.normalize_L2(vec)
-            D, I = self.index.search(vec, top_k)
-            results = []
-            for score, idx in zip(D[0], I[0]):
-                if idx < 0:
-                    continue
-                meta = self.metadatas[idx]
-                results.append({"id": meta["id"], "text": meta["text"], "score": float(score)})
-            return results
-        else:
-            labels, distances = self.index.knn_query(vec, k=top_k)
-            results = []
-            for label, dist in zip(labels[0], distances[0]):
-                if label < 0:
-                    continue
-                meta = self.metadatas[label]
-                # hnswlib returns distance; convert to similarity proxy
-                score = float(1.0 - dist)
-                results.append({"id": meta["id"], "text": meta["text"], "score": score})
-            return results
\ No newline at end of file
+            sh = self.near_dup.shingles(c["text"]) if self.near_dup is not None else None
+            keys.append(self.near_dup.keys(sh) if sh else None)
+        new = self._append(chunks, self._vectors(old), keys)
+        self.chunks.repoint(dict(zip(old.tolist(), new.tolist())))
+        return [heirs[r][0] for r in old.tolist()]
+
+    def _maybe_compact(self):
+        if self.read_only:
+            return
+        manifest = self.segments.manifest
+        total = sum(s["count"] for s in manifest["segments"])
+        dead = len(self._tombstones) > max(1, total * COMPACT_DEAD_RATIO)
+        # a corpus that outgrew the untrained (flat) index is retrained by compaction
+        retrain = self.index is not None and self.index_kind != self._desired_kind(total)
+        grown = len(manifest["segments"]) > COMPACT_SEGMENTS or len(self._delta_rows) > COMPACT_DELTA_ROWS
+        if not (grown or dead or retrain) or self._compacting:
+            return
+        self._compacting = True
+        threading.Thread(target=self._compact_safely, name="vectorstore-compactor", daemon=True).start()
+
+    def _compact_safely(self):
+        try:
+            self.compact()
+        except Exception:
+            logger.exception("Vector store compaction failed")
+        finally:
+            self._compacting = False
+
+    def compact(self):
+        """
+        Merge all current segments into one, dropping tombstoned rows, and snapshot an
+        index built from it (training it first if the configured type needs training and
+        the corpus is past the threshold). The heavy work runs without the write lock;
+        ingests that land meanwhile stay as separate segments after the merged one.
+        """
+        self._check_writable()
+        with self._compact_lock:
+            self._compact()
+
+    def _compact(self):
+        merging = list(self.segments.manifest["segments"])
+        dead = set(self._tombstones)
+        total = sum(s["count"] for s in merging)
+        kind = self._desired_kind(total - len(dead))
+        if not merging or (len(merging) < 2 and not dead and self.segments.manifest.get("snapshot")
+                           and kind == self.index_kind):
+            return
+        parts = [self.segments.read_segment(s, mmap=False) for s in merging]
+        rows = np.concatenate([p[0] for p in parts])
+        vecs = np.concatenate([p[1] for p in parts])
+        if dead:
+            live = ~np.isin(rows, np.fromiter(dead, dtype="int64"))
+            rows, vecs = rows[live], vecs[live]
+        kind = self._desired_kind(len(rows))
+        train = training_sample(vecs) if kind != "flat" else None
+        if kind != self.index_kind:
+            logger.info("Building %s vector index over %d vectors", kind, len(rows))
+        snap_index = new_index(kind, self.dim, len(rows), train=train)
+        index_add(snap_index, vecs, rows)
+
+        with self._lock:
+            manifest = self.segments.draft()
+            names = [s["name"] for s in merging]
+            if [s["name"] for s in manifest["segments"][:len(names)]] != names:
+                return  # manifest changed underneath us; try again next time
+            name = self.segments.new_segment_name(manifest)
+            seg = self.segments.write_segment(name, rows, vecs)
+            snap_file = f"{name}.{snapshot_suffix()}"
+            save_index(snap_index, self.segments, snap_file)
+            newer = manifest["segments"][len(names):]
+            manifest["segments"] = [seg] + newer
+            manifest["snapshot"] = {"file": snap_file, "segments": [name], "kind": kind}
+            self.segments.commit(manifest)
+            self._vector_view = None
+            # serve the written file (mapped, shared with readers) rather than the private built copy
+            self._set_base(load_index(self.segments.path_of(snap_file), self.dim, mmap=True), kind, snap_file)
+            # files of the old snapshot stay readable for processes that still map them
+            self.segments.remove_unreferenced()
+            self.chunks.purge(list(dead))
+            self._tombstones -= dead
+            self._set_delta(newer)
+            self._base_dead += index_tombstone(self.index, self._tombstones)
+
+    def query(self, embedding, top_k=5, nprobe: int = None, ef: int = None, rerank: bool = None):
+        return self.query_batch([embedding], top_k=top_k, nprobe=nprobe, ef=ef, rerank=rerank)[0]
+
+    def query_batch(self, embeddings, top_k=5, nprobe: int = None, ef: int = None,
+                    rerank: bool = None) -> List[List[Dict]]:
+        """
+        Search many query vectors with one index call over the stacked matrix, and fetch
+        the chunk metadata for all hits in one pass. Returns one result list per query.
+        `nprobe` (IVF) and `ef` (HNSW) trade latency for recall; with `rerank` (default: on
+        for quantized indexes) top_k * rerank_factor candidates are re-scored exactly
+        against the stored vectors.
+        """
+        if len(embeddings) == 0:
+            return []
+        mat = _normalize(np.array(embeddings, dtype="float32").reshape(len(embeddings), -1))
+        self.refresh()
+        with self._lock:
+            if rerank is None:
+                rerank = self.index_kind in LOSSY_KINDS
+            want = top_k * max(self.rerank_factor, 1) if rerank else top_k
+            hits = self._search_delta(mat, want)
+            n_base = index_count(self.index) if self.index is not None else 0
+            if HAS_FAISS:
+                # over-fetch so tombstoned hits can be dropped without losing results
+                k = min(want + len(self._tombstones), n_base)
+            else:
+                k = min(want, n_base - self._base_dead)  # hnswlib skips deleted labels itself
+            if k > 0:
+                D, I = index_search(self.index, self.index_kind, mat, k, nprobe=nprobe, ef=ef)
+                for h, d, i in zip(hits, D, I):
+                    h += [(int(idx), float(score)) for score, idx in zip(d, i)
+                          if idx >= 0 and idx not in self._tombstones]
+            hits = [sorted(h, key=lambda e: -e[1])[:want] for h in hits]
+            if rerank:
+                hits = self._rerank(mat, hits, top_k)
+        rows = list({row for h in hits for row, _ in h})
+        metas = self.chunks.fetch(rows)
+        shared = self.chunks.aliases(rows)
+        out = []
+        for h in hits:
+            found = []
+            for row, score in h:
+                if row in metas:
+                    found.append({**metas[row], "score": score})
+                    # near-duplicates stored against this vector score the same, with their own text
+                    found += [{**c, "score": score, "dup_of": metas[row]["id"]} for _, c in shared.get(row, ())]
+            out.append(found[:top_k])
+        return out
+
+    def _search_delta(self, mat: np.ndarray, k: int) -> List[List]:
+        # brute force over the (small) delta: one matrix product for all queries
+        if not len(self._delta_rows):
+            return [[] for _ in range(len(mat))]
+        scores = mat @ self._delta_vecs.T
+        k = min(k + len(self._tombstones), scores.shape[1])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k] if k < scores.shape[1] else \
+            np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+        rows = self._delta_rows
+        return [[(int(rows[j]), float(s[j])) for j in t if int(rows[j]) not in self._tombstones]
+                for s, t in zip(scores, top)]
+
+    def _rerank(self, mat: np.ndarray, hits: List[List], top_k: int) -> List[List]:
+        # exact inner products against the segment vectors (memory-mapped, so only the
+        # candidate rows are paged in)
+        rows = np.array(sorted({row for h in hits for row, _ in h}), dtype="int64")
+        if not len(rows):
+            return hits
+        pos = {int(r): n for n, r in enumerate(rows)}
+        vecs = self._vectors(rows)
+        out = []
+        for q, h in zip(mat, hits):
+            exact = [(row, float(vecs[pos[row]] @ q)) for row, _ in h]
+            out.append(sorted(exact, key=lambda e: -e[1])[:top_k])
+        return out
+
+    def _vectors(self, rows: np.ndarray) -> np.ndarray:
+        """
+        Stored vectors for sorted `rows` (all live in committed segments). Segment rows
+        ascend and segments follow each other in row order, so a row is found by two
+        binary searches.
+        """
+        view = self._vector_view
+        if view is None:
+            segs = [self.segments.read_segment(s) for s in self.segments.manifest["segments"] if s["count"]]
+            view = self._vector_view = (np.array([int(r[0]) for r, _ in segs], dtype="int64"), segs)
+        starts, segs = view
+        out = np.empty((len(rows), self.dim), dtype="float32")
+        which = np.searchsorted(starts, rows, side="right") - 1
+        for s in np.unique(which):
+            mask = which == s
+            seg_rows, seg_vecs = segs[s]
+            out[mask] = seg_vecs[np.searchsorted(seg_rows, rows[mask])]
+        return out
+
+    def lexical_query(self, text: str, top_k=5):
+        """
+        BM25 keyword search over the chunk text (see ChunkStore.search_text); needs no embedding.
+        """
+        self.refresh()
+        hits = self.chunks.search_text(text, limit=top_k)
+        metas = self.chunks.fetch([row for row, _ in hits])
+        return [{**metas[row], "score": score} for row, score in hits if row in metas]
+
+    def close(self):
+        """
+        Release the chunk store and, for the writer, the writer lock.
+        """
+        self.chunks.close()
+        self.writer_lock.release()
+
+
+class DocumentUpsert:
+    """
+    One in-progress document upsert (see VectorStore.begin_upsert).
+    New chunks become searchable batch by batch; chunks of the previous version stay
+    live until finish(), so queries never see the document half-missing. abort() retires
+    what was added instead and leaves the previous version as it was.
+    With near-duplicate detection on, a new chunk that nearly repeats an indexed chunk (or
+    an earlier chunk of this upsert) is stored as an alias of it: never embedded, no vector
+    of its own. finish() reports what that saved.
+    Not safe to run two upserts of the same document at once.
+    """
+    def __init__(self, store: VectorStore, doc_id: str):
+        self.store = store
+        self.doc_id = doc_id
+        self._existing: Dict[str, List[int]] = {}
+        for row, h in store.chunks.doc_rows(doc_id):
+            self._existing.setdefault(h, []).append(row)
+        self._keep = []
+        # content_hash -> ("new", LSH keys or None) | ("row", row it duplicates) | ("hash", earlier chunk it duplicates)
+        self._plans: Dict[str, Tuple] = {}
+        # planned new chunks not added yet (not findable through the store): hash -> shingles, and their buckets
+        self._pending: Dict[str, Set[str]] = {}
+        self._pending_buckets: Dict[Tuple[int, int], List[str]] = {}
+        self._rows: Dict[str, int] = {}  # content_hash -> row, for chunks this upsert indexed
+        self._added: List[int] = []  # every row this upsert created, aliases included
+        self.stats = {"doc_id": doc_id, "added": 0, "unchanged": 0, "removed": 0, "deduplicated": 0,
+                      "embed_tokens_saved": 0, "vector_bytes_saved": 0, "index_bytes_saved": 0}
+
+    def _plan(self, chunks: List[Dict]):
+        lsh = self.store.near_dup
+        for c in chunks:
+            h = c["content_hash"]
+            if h in self._plans or self._existing.get(h):
+                continue
+            sh = lsh.shingles(c["text"]) if lsh is not None else None
+            if sh is None:
+                self._plans[h] = ("new", None)
+                continue
+            keys = lsh.keys(sh)
+            row = self.store.find_duplicate(sh, keys)
+            twin = self._pending_duplicate(sh, keys) if row is None else None
+            if row is not None:
+                self._plans[h] = ("row", row)
+            elif twin is not None:
+                self._plans[h] = ("hash", twin)
+            else:
+                self._plans[h] = ("new", keys)
+                self._pending[h] = sh
+                for k in keys:
+                    self._pending_buckets.setdefault(k, []).append(h)
+
+    def _pending_duplicate(self, sh: Set[str], keys) -> Optional[str]:
+        seen = set()
+        for k in keys:
+            for h in self._pending_buckets.get(k, ()):
+                if h not in seen and h in self._pending:
+                    seen.add(h)
+                    if self.store.near_dup.is_duplicate(sh, self._pending[h]):
+                        return h
+        return None
+
+    def changed(self, chunks: List[Dict]) -> List[Dict]:
+        """
+        The chunks that need embeddings: not indexed under this document already and not
+        near-duplicates of anything indexed or of an earlier chunk.
+        """
+        self._plan(chunks)
+        out, seen = [], set()
+        for c in chunks:
+            h = c["content_hash"]
+            if self._existing.get(h) or h in seen or h in self._rows:
+                continue
+            if self._plans[h][0] == "new":
+                seen.add(h)
+                out.append(c)
+        return out
+
+    def add(self, chunks: List[Dict], vectors: Optional[Dict[str, List[float]]] = None):
+        self._plan(chunks)
+        dedup = self.store.near_dup is not None
+        fresh, keys, aliases, added = [], [], [], set()
+        for c in chunks:
+            c = {**c, "doc_id": self.doc_id}
+            h = c["content_hash"]
+            rows = self._existing.get(h)
+            if rows:
+                self._keep.append((rows.pop(0), c))
+                continue
+            kind, target = self._plans.get(h, ("new", None))
+            if kind == "new" and dedup and (h in added or h in self._rows):
+                kind, target = "hash", h  # exact repeat within the document
+            if kind == "hash" and target not in added and target not in self._rows:
+                kind, target = "new", None  # its twin was not part of any add(); index it after all
+            if kind == "new":
+                fresh.append(c)
+                keys.append(target)
+                added.add(h)
+            else:
+                aliases.append((c, kind, target))
+        if fresh:
+            vectors = dict(vectors or {})
+            missing = [c for c in fresh if c["content_hash"] not in vectors]
+            if missing:
+                for c, v in zip(missing, self.store.embedder.embed_batch([c["text"] for c in missing])):
+                    vectors[c["content_hash"]] = v
+            arr = _normalize(np.array([vectors[c["content_hash"]] for c in fresh], dtype="float32"))
+            rows = self.store._append(fresh, arr, keys).tolist()
+            self._added.extend(rows)
+            for c, row in zip(fresh, rows):
+                self._rows.setdefault(c["content_hash"], row)
+        if aliases:
+            resolved = [{**c, "dup_of": target if kind == "row" else self._rows[target]} for c, kind, target in aliases]
+            self._added.extend(self.store._add_aliases(resolved))
+            self.stats["deduplicated"] += len(resolved)
+            self.stats["embed_tokens_saved"] += sum(count_tokens(c["text"]) for c in resolved)
+        # indexed chunks are found through the store's LSH buckets from now on
+        for h in added:
+            self._pending.pop(h, None)
+        self.stats["added"] += len(fresh)
+
+    def finish(self) -> Dict:
+        stale = [r for rows in self._existing.values() for r in rows]
+        if stale or self._keep:
+            with self.store._lock:
+                self.store._retire(stale, refresh=self._keep)
+        self.stats["unchanged"] = len(self._keep)
+        self.stats["removed"] = len(stale)
+        n, dim = self.stats["deduplicated"], self.store.dim
+        if n and dim:
+            # float32 rows in the segments (and the in-memory delta), and in the index they are snapshotted into
+            kind = self.store._desired_kind(self.store.chunks.count())
+            self.stats["vector_bytes_saved"] = n * (4 * dim + 8)
+            self.stats["index_bytes_saved"] = n * bytes_per_vector(kind, dim)
+            logger.info("Upsert of %s: %d near-duplicate chunks share existing vectors (~%d embedding tokens, "
+                        "%d index bytes saved)", self.doc_id, n, self.stats["embed_tokens_saved"],
+                        self.stats["index_bytes_saved"])
+        self.store._maybe_compact()
+        return dict(self.stats)
+
+    def abort(self) -> int:
+        """
+        Undo a failed upsert: the rows added so far are retired and the previous version
+        of the document stays live untouched. Returns the number of rows retired.
+        """
+        rows, self._added = self._added, []
+        if rows:
+            with self.store._lock:
+                self.store._retire(rows)
+        self.store._maybe_compact()
+        return len(rows)
@@ -0,0 +1,18 @@
+# conftest.py - fixtures shared by the test modules
+# tests/conftest.py
+import pytest
+
+class CountingEmbedder:
+    """
+    Deterministic stand-in for the embedding client that records every text it embeds.
+    """
+    def __init__(self):
+        self.texts = []
+
+    def embed_batch(self, texts):
+        self.texts.extend(texts)
+        return [[float(len(t)), float(sum(map(ord, t)) % 97), 1.0] for t in texts]
+
+@pytest.fixture
+def embedder():
+    return CountingEmbedder()
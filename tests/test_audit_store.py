@@ -0,0 +1,144 @@
+# test_audit_store.py - unit tests for write-behind audit logging
+# tests/test_audit_store.py
+import os, time, asyncio, sqlite3
+from storage.audit_store import AuditStore, new_ulid
+from services.prompt_template import build_prompt
+
+def test_ulids_are_unique_and_time_ordered():
+    ids = [new_ulid() for _ in range(1000)]
+    assert len(set(ids)) == 1000
+    assert all(len(i) == 26 for i in ids)
+    assert ids[0][:10] <= ids[-1][:10]
+
+def test_write_behind_group_commits_and_attaches(tmp_path):
+    store = AuditStore(f"sqlite:///{tmp_path}/audit.db", write_behind=True, batch_size=50, flush_interval_ms=20)
+    ids = [store.log({"input_hash": f"h{i}", "n": i}) for i in range(120)]
+    store.attach_explanation(ids[-1], {"top_tokens": []})
+    assert store.flush(timeout=5)
+
+    assert store.stats["written"] == 120
+    assert store.stats["batches"] < 120
+    rec = store.get(ids[-1])
+    assert rec["payload"]["n"] == 119
+    assert rec["payload"]["explanation_status"] == "done"
+    mode = sqlite3.connect(f"{tmp_path}/audit.db").execute("PRAGMA journal_mode").fetchone()[0]
+    assert mode == "wal"
+    store.close()
+
+def test_close_flushes_queue_and_backpressure_is_counted(tmp_path):
+    url = f"sqlite:///{tmp_path}/audit.db"
+    store = AuditStore(url, write_behind=True, queue_size=4, batch_size=2, flush_interval_ms=1)
+    ids = [store.log({"input_hash": "h", "n": i}) for i in range(40)]
+    store.close()
+    assert store.stats["enqueued"] == 40
+    assert store.stats["max_depth"] <= 4
+
+    reopened = AuditStore(url, write_behind=False)
+    assert all(reopened.get(i) is not None for i in ids)
+    reopened.close()
+
+def test_alog_waits_for_queue_space_off_the_event_loop(tmp_path, monkeypatch):
+    store = AuditStore(f"sqlite:///{tmp_path}/audit.db", write_behind=True, queue_size=2, batch_size=1,
+                       flush_interval_ms=1)
+    write = store._write
+
+    def slow_write(ops):
+        time.sleep(0.05)
+        return write(ops)
+
+    monkeypatch.setattr(store, "_write", slow_write)
+
+    async def run():
+        ticks = []
+
+        async def ticker():
+            while True:
+                ticks.append(1)
+                await asyncio.sleep(0.005)
+
+        beat = asyncio.ensure_future(ticker())
+        ids = [await store.alog({"input_hash": "h", "n": i}) for i in range(8)]
+        beat.cancel()
+        return ids, len(ticks)
+
+    ids, ticks = asyncio.run(run())
+    assert store.stats["queue_full"] > 0
+    assert ticks > 10  # the loop kept running while alog() waited on back-pressure
+    store.close()
+    assert all(store.get(i) is not None for i in ids)
+
+def test_failed_batches_are_spilled_and_replayed(tmp_path, monkeypatch):
+    url = f"sqlite:///{tmp_path}/audit.db"
+    store = AuditStore(url, write_behind=True, batch_size=10, flush_interval_ms=1, write_attempts=2)
+    write = store._write
+
+    def unavailable(ops):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    monkeypatch.setattr(store, "_write", unavailable)
+    lost = [store.log({"input_hash": "h", "n": i}) for i in range(3)]
+    assert store.flush(timeout=5)
+    assert store.stats["spill_pending"] == 3 and "disk I/O error" in store.stats["last_error"]
+    assert store.stats["dropped"] == 0
+
+    # once the database accepts writes again, the next committed batch replays the spill
+    monkeypatch.setattr(store, "_write", write)
+    later = store.log({"input_hash": "h", "n": 3})
+    assert store.flush(timeout=5)
+    assert store.stats["spill_pending"] == 0 and store.stats["replayed"] == 3
+    assert all(store.get(i) is not None for i in lost + [later])
+    assert not os.path.exists(store.spill_path)
+    store.close()
+
+def test_sync_mode_upgrades_legacy_table(tmp_path):
+    path = tmp_path / "audit.db"
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE audits (id INTEGER PRIMARY KEY, ts VARCHAR, input_hash VARCHAR, payload JSON)")
+    db.execute("INSERT INTO audits (ts, input_hash, payload) VALUES ('t', 'h', '{\"old\": true}')")
+    db.commit()
+    db.close()
+
+    store = AuditStore(f"sqlite:///{path}", write_behind=False)
+    new_id = store.log({"input_hash": "h2"})
+    assert store.get(new_id)["payload"] == {"input_hash": "h2"}
+    assert store.attach_explanation(1, {"x": 1}) is True
+    assert store.get(1)["payload"]["old"] is True
+    store.close()
+
+def _record(i, prompt):
+    return {"ts": 1000.0 + i, "input_hash": f"h{i}", "prompt_template": prompt["template_id"],
+            "prompt_text": prompt["text"], "prompt_parts": prompt["parts"], "model_version": "m1" if i % 2 else "m2",
+            "raw_response": "The notice period is 30 days [a:chunk-0].", "filtered_response": "The notice period is 30 days.",
+            "confidence": i / 10, "explanation": {"top_tokens": [["notice", 0.4]]}}
+
+def test_payload_pieces_are_stored_once_and_rendered_back(tmp_path):
+    chunks = [{"id": "a:chunk-0", "text": "Termination requires ninety days written notice. " * 20, "score": 0.9}]
+    prompt = build_prompt("You are a contract analyst.", "What is the notice period?", chunks)
+    store = AuditStore(f"sqlite:///{tmp_path}/audit.db", write_behind=False)
+    ids = [store.log(_record(i, prompt)) for i in range(10)]
+
+    # template, system prompt, chunk, two responses, explanation
+    assert store.stats["blobs_written"] == 6
+    assert store.stats["blob_bytes_stored"] < store.stats["blob_bytes_in"]
+    raw = store.get(ids[3], expand=False)["payload"]
+    assert "prompt_text" not in raw and "$blob" in raw["raw_response"]
+    rec = store.get(ids[3])["payload"]
+    assert rec["prompt_text"] == prompt["text"]
+    assert rec["explanation"] == {"top_tokens": [["notice", 0.4]]}
+    store.close()
+
+def test_search_paginates_on_indexed_columns(tmp_path):
+    prompt = build_prompt("sys", "q", [])
+    store = AuditStore(f"sqlite:///{tmp_path}/audit.db", write_behind=False)
+    for i in range(10):
+        store.log(_record(i, prompt))
+
+    page = store.search(model_version="m1", limit=2)
+    assert [r["input_hash"] for r in page["items"]] == ["h1", "h3"]
+    rest = store.search(model_version="m1", limit=2, cursor=page["next_cursor"])
+    assert [r["input_hash"] for r in rest["items"]] == ["h5", "h7"]
+
+    streamed = list(store.iter_records(page_size=3, since=1002.0, min_confidence=0.5))
+    assert [r["input_hash"] for r in streamed] == ["h5", "h6", "h7", "h8", "h9"]
+    assert streamed[0]["payload"]["prompt_text"] == prompt["text"]
+    store.close()
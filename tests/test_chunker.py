@@ -0,0 +1,15 @@
+# test_chunker.py - unit tests for chunking
+# tests/test_chunker.py
+from services.chunker import chunk_text, iter_chunks
+
+def test_streaming_chunks_match_chunk_text():
+    pages = ["Clause 1.  Term.\n The term is  one year. " * 9, "\n", "  Clause 2. Fees.\tNet 30. " * 13, "Signature page "]
+    whole = chunk_text("\n".join(pages), chunk_size=120, overlap=30, doc_id="msa")
+    streamed = list(iter_chunks(pages, chunk_size=120, overlap=30, doc_id="msa"))
+    assert streamed == whole
+    assert whole[0]["id"] == "msa:chunk-0" and whole[-1]["end"] == whole[-1]["start"] + len(whole[-1]["text"])
+
+def test_short_text_is_one_chunk():
+    chunks = chunk_text("Governing law: Delaware.")
+    assert len(chunks) == 1
+    assert chunks[0]["doc_id"].startswith("doc-")
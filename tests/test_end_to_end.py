@@ -1,7 +1,17 @@
 # test_end_to_end.py - integration / smoke tests 
 # tests/test_end_to_end.py
+import json
+import types
+import httpx
 from fastapi.testclient import TestClient
 from api.main import app
+from services.llm_client import OpenAIClient, AsyncOpenAIClient
+from services.llm_providers import FakeProvider
+from services.retriever import Retriever
+from services.response_cache import ResponseCache
+from storage.vectorstore import VectorStore
+from storage.audit_store import AuditStore
+from benchmarks.synthetic_contracts import contract_pdf, contract_terms
 
 client = TestClient(app)
 
@@ -9,7 +19,90 @@ def test_query_requires_key():
     resp = client.post("/query", json={"text":"What is clause 2?"})
     assert resp.status_code == 422 or resp.status_code == 401  # missing header
 
-def test_ingest_and_query_flow(monkeypatch):
-    # This test assumes API key set in env; for CI, set API_MASTER_KEY to 'test'
-    # Mock vectorstore and llm for speed in CI if needed
-    pass
\ No newline at end of file
+def test_ingest_and_query_flow(tmp_path, monkeypatch):
+    # the app's components rebuilt on a temp dir with the deterministic fake provider
+    import api.main as main
+    provider = FakeProvider(dim=64)
+    vs = VectorStore(str(tmp_path / "idx"), embedder=OpenAIClient(provider=provider))
+    audit = AuditStore(f"sqlite:///{tmp_path}/audit.db", write_behind=False)
+    components = {"llm": AsyncOpenAIClient(provider=provider), "vectorstore": vs, "retriever": Retriever(vs),
+                  "response_cache": ResponseCache(), "audit": audit}
+    for name, value in components.items():
+        monkeypatch.setattr(main, name, value)
+    headers = {"x-api-key": "dev-key"}
+
+    resp = client.post("/ingest_pdf", headers=headers, data={"doc_id": "msa-1"},
+                       files={"file": ("msa.pdf", contract_pdf(1, pages=3), "application/pdf")})
+    assert resp.status_code == 200
+    ingested = resp.json()
+    assert ingested["pages"] == 3 and ingested["chunks_indexed"] > 0
+    assert "embed" in ingested["timings"]["stages"]
+
+    resp = client.post("/query", headers=headers,
+                       json={"text": "How many days prior written notice to terminate for convenience?"})
+    assert resp.status_code == 200
+    body = resp.json()
+    assert f"upon {contract_terms(1)['notice']} days prior written notice" in body["response"]
+    assert body["model_version"].startswith("fake/")
+    assert body["explanation"]["token_importance"]
+    record = audit.get(body["audit_id"])["payload"]
+    assert record["retrieval_mode"] == "hybrid"
+    assert {"retrieve", "generate", "explain"} <= set(record["timings"]["stages"])
+    vs.close()
+
+def test_query_stream_retracts_blocked_output(tmp_path, monkeypatch):
+    import api.main as main
+
+    class ConfidentialLLM(AsyncOpenAIClient):
+        async def generate_stream(self, prompt, return_logprobs=False):
+            text = "Summary of terms. " + "This confidential schedule lists prices. " * 40
+            for i in range(0, len(text), 20):
+                yield {"type": "delta", "text": text[i:i + 20]}
+            yield {"type": "final", "response": {"text": text, "model": self.model, "logprobs": None}}
+
+    provider = FakeProvider(dim=64)
+    vs = VectorStore(str(tmp_path / "idx"), embedder=OpenAIClient(provider=provider))
+    audit = AuditStore(f"sqlite:///{tmp_path}/audit.db", write_behind=False)
+    components = {"llm": ConfidentialLLM(provider=provider), "vectorstore": vs, "retriever": Retriever(vs),
+                  "response_cache": ResponseCache(), "audit": audit}
+    for name, value in components.items():
+        monkeypatch.setattr(main, name, value)
+    headers = {"x-api-key": "dev-key"}
+    client.post("/ingest_pdf", headers=headers, data={"doc_id": "msa-1"},
+                files={"file": ("msa.pdf", contract_pdf(1, pages=1), "application/pdf")})
+
+    resp = client.post("/query_stream", headers=headers, json={"text": "List the prices."})
+    assert resp.status_code == 200
+    events = []
+    for block in resp.text.strip().split("\n\n"):
+        event, data = block.split("\n")
+        events.append((event[len("event: "):], json.loads(data[len("data: "):])))
+    names = [name for name, _ in events]
+    assert names.count("policy") == 1 and names[-1] == "trailer"
+    streamed = "".join(data["text"] for name, data in events if name == "token")
+    policy = events[names.index("policy")][1]
+    # the retraction follows every token, and covers all of them
+    assert "token" not in names[names.index("policy"):]
+    assert streamed and policy["retract"] and policy["discard_chars"] == len(streamed)
+    assert policy["response"] == "[REDACTED_FOR_POLICY]"
+    record = audit.get(events[-1][1]["audit_id"])["payload"]
+    assert record["filtered_response"] == "[REDACTED_FOR_POLICY]"
+    vs.close()
+
+def test_metrics_endpoint():
+    resp = client.get("/metrics")  # scrapers send no API key
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain")
+    assert "# TYPE rag_cache_hit_ratio gauge" in resp.text
+
+def test_reader_passes_writer_errors_through(monkeypatch):
+    import api.main as main
+
+    def writer(request):
+        return httpx.Response(502, text="Bad Gateway", headers={"content-type": "text/plain"})
+
+    monkeypatch.setattr(main, "vectorstore", types.SimpleNamespace(read_only=True))
+    monkeypatch.setattr(main, "writer_client", httpx.AsyncClient(transport=httpx.MockTransport(writer),
+                                                                 base_url="http://writer"))
+    resp = client.delete("/documents/msa-1", headers={"x-api-key": "dev-key"})
+    assert resp.status_code == 502 and resp.text == "Bad Gateway"
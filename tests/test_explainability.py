@@ -0,0 +1,44 @@
+# test_explainability.py - unit tests for perturbation explainability
+# tests/test_explainability.py
+import asyncio
+from services.explainability import explain_response_perturbation_async, perturbation_cache
+
+class FakeAsyncLLM:
+    def __init__(self):
+        self.calls = 0
+        self.active = 0
+        self.peak = 0
+
+    async def generate(self, prompt, return_logprobs=False):
+        self.calls += 1
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        await asyncio.sleep(0.01)
+        self.active -= 1
+        return {"text": "x", "model": "fake", "logprobs": {"token_logprobs": [-float(len(prompt["text"]) % 7)]}}
+
+def test_reuses_base_runs_concurrently_and_caches():
+    llm = FakeAsyncLLM()
+    prompt = {"template_id": "t", "text": "clause 4.2 question"}
+    base = {"text": "notice within thirty days", "logprobs": {"token_logprobs": [-0.1]}}
+    kwargs = dict(llm_client=llm, prompt=prompt, response=base["text"],
+                  retrieved_chunks=[{"id": "c1"}], base=base, max_concurrency=2)
+
+    first = asyncio.run(explain_response_perturbation_async(**kwargs))
+    assert llm.calls == 4  # one per masked token, no regeneration of the base answer
+    assert llm.peak == 2
+    assert first["budget"]["scored"] == 4 and first["provenance"] == ["c1"]
+
+    second = asyncio.run(explain_response_perturbation_async(**kwargs))
+    assert llm.calls == 4
+    assert second["budget"]["cache_hits"] == 4
+    assert second["token_importance"] == first["token_importance"]
+
+def test_call_budget_limits_perturbations():
+    perturbation_cache._data.clear()
+    llm = FakeAsyncLLM()
+    prompt = {"template_id": "t", "text": "budget question"}
+    out = asyncio.run(explain_response_perturbation_async(
+        llm_client=llm, prompt=prompt, response="a b c d e", retrieved_chunks=[], max_calls=3))
+    assert llm.calls == 3  # base generation + 2 perturbations
+    assert out["budget"]["skipped"] == 3
@@ -0,0 +1,43 @@
+# test_ingest.py - unit tests for the streaming PDF ingest pipeline
+# tests/test_ingest.py
+import asyncio
+import pytest
+import services.ingest as ingest
+from services.llm_client import OpenAIClient, AsyncOpenAIClient
+from services.llm_providers import FakeProvider
+from storage.vectorstore import VectorStore
+from benchmarks.synthetic_contracts import contract_pdf, contract_terms
+
+class FlakyLLM(AsyncOpenAIClient):
+    def __init__(self, fail_on_call: int, **kwargs):
+        super().__init__(**kwargs)
+        self.fail_on_call = fail_on_call
+        self.calls = 0
+
+    async def embed_batch(self, texts):
+        self.calls += 1
+        if self.calls == self.fail_on_call:
+            raise RuntimeError("embedding service unavailable")
+        return await super().embed_batch(texts)
+
+def test_failed_reingest_rolls_back_and_keeps_previous_version(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest, "INGEST_WORKERS", 0)
+    monkeypatch.setattr(ingest, "INGEST_BATCH_CHUNKS", 1)
+    provider = FakeProvider(dim=64)
+    vs = VectorStore(str(tmp_path / "idx"), embedder=OpenAIClient(provider=provider))
+    for seed in (1, 2):
+        path = tmp_path / f"msa-{seed}.pdf"
+        path.write_bytes(contract_pdf(seed, pages=3))
+
+    asyncio.run(ingest.ingest_pdf_file(str(tmp_path / "msa-1.pdf"), "msa", AsyncOpenAIClient(provider=provider), vs))
+    before = vs.chunks.doc_rows("msa")
+    job = ingest.IngestJob("msa", "msa-2.pdf")
+    with pytest.raises(RuntimeError):
+        asyncio.run(ingest.ingest_pdf_file(str(tmp_path / "msa-2.pdf"), "msa", FlakyLLM(3, provider=provider), vs,
+                                           job=job))
+
+    assert job.status == "failed" and job.chunks_done > 0
+    assert vs.chunks.doc_rows("msa") == before
+    reference = f"MSA-{2:05d}"
+    assert not any(reference in h["text"] for h in vs.lexical_query(f"contract reference {reference}", top_k=10))
+    assert contract_terms(2)["vendor"] not in " ".join(h["text"] for h in vs.lexical_query("Vendor", top_k=20))
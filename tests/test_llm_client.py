@@ -0,0 +1,125 @@
+# test_llm_client.py - unit tests for the embedding client
+# tests/test_llm_client.py
+import asyncio
+import pytest
+from services.llm_client import OpenAIClient, AsyncOpenAIClient
+from services.embedding_cache import EmbeddingCache
+
+def test_embed_batch_packs_requests_and_keeps_order(monkeypatch):
+    client = OpenAIClient(batch_max_tokens=10, batch_max_items=3, embed_concurrency=2)
+    calls = []
+
+    def fake_request(inputs):
+        calls.append(list(inputs))
+        return [[float(len(t))] for t in inputs]
+
+    monkeypatch.setattr(client, "_embed_request", fake_request)
+    texts = [chr(97 + i) * 4 * n for i, n in enumerate((2, 3, 4, 1, 1, 1, 12, 2))]
+    vectors = client.embed_batch(texts)
+
+    assert vectors == [[float(len(t))] for t in texts]
+    assert sum(len(c) for c in calls) == len(texts)
+    assert all(len(c) <= 3 for c in calls)
+    assert len(calls) < len(texts)
+
+def test_embedding_cache_skips_repeated_text(tmp_path, monkeypatch):
+    cache = EmbeddingCache(str(tmp_path / "cache.db"), max_items=2)
+    client = OpenAIClient(cache=cache)
+    sent = []
+
+    def fake_request(inputs):
+        sent.extend(inputs)
+        return [[float(len(t))] for t in inputs]
+
+    monkeypatch.setattr(client, "_embed_request", fake_request)
+    client.embed_batch(["governing law", "indemnity", "governing  law "])
+    assert sent == ["governing law", "indemnity"]
+
+    client.embed_batch(["notice", "termination"])  # pushes the first two out of memory
+    assert cache.stats["evictions"] == 2
+
+    # evicted from memory but still served by the disk tier, also after a restart
+    restarted = OpenAIClient(cache=EmbeddingCache(str(tmp_path / "cache.db")))
+    monkeypatch.setattr(restarted, "_embed_request", fake_request)
+    assert restarted.embed_text("indemnity") == [9.0]
+    assert restarted.cache.stats["disk_hits"] == 1
+    assert len(sent) == 4
+
+def test_sync_retries_back_off_only_between_attempts(monkeypatch):
+    client = OpenAIClient(max_retries=3)
+    sleeps = []
+
+    def failing(*args, **kwargs):
+        raise ConnectionError("reset")
+
+    monkeypatch.setattr(client.provider, "embed", failing)
+    monkeypatch.setattr(client.provider, "complete", failing)
+    monkeypatch.setattr("services.llm_client.time.sleep", sleeps.append)
+    with pytest.raises(RuntimeError):
+        client._embed_request(["x"])
+    with pytest.raises(RuntimeError):
+        client.generate({"text": "q"})
+    assert len(sleeps) == 4  # two backoffs per call, none after the final attempt
+
+def test_async_client_caps_concurrency_and_retries(monkeypatch):
+    client = AsyncOpenAIClient(max_concurrency=2, timeout=1.0, backoff=0.0)
+    state = {"active": 0, "peak": 0, "calls": 0}
+
+    async def fake_generate(prompt, return_logprobs):
+        state["calls"] += 1
+        state["active"] += 1
+        state["peak"] = max(state["peak"], state["active"])
+        try:
+            await asyncio.sleep(0.01)
+            if prompt["text"] == "flaky" and state["calls"] == 1:
+                raise ConnectionError("reset")
+            return {"text": prompt["text"], "model": "fake", "logprobs": None}
+        finally:
+            state["active"] -= 1
+
+    monkeypatch.setattr(client, "_generate_request", fake_generate)
+
+    async def run():
+        first = await client.generate({"text": "flaky"})
+        rest = await asyncio.gather(*[client.generate({"text": f"q{i}"}) for i in range(6)])
+        return first, rest
+
+    first, rest = asyncio.run(run())
+    assert first["text"] == "flaky"
+    assert [r["text"] for r in rest] == [f"q{i}" for i in range(6)]
+    assert state["calls"] == 8
+    assert state["peak"] == 2
+
+def test_generate_stream_yields_deltas_then_final(monkeypatch):
+    from types import SimpleNamespace as NS
+    client = AsyncOpenAIClient(timeout=1.0, backoff=0.0)
+    attempts = []
+
+    class FakeLogprobs:
+        def __init__(self, tok, lp):
+            self.tok, self.lp = tok, lp
+
+        def model_dump(self):
+            return {"tokens": [self.tok], "token_logprobs": [self.lp]}
+
+    async def chunks():
+        for tok, lp in [(" The", -0.1), (" notice", -0.2), (" period.", -0.3)]:
+            yield NS(choices=[NS(text=tok, logprobs=FakeLogprobs(tok, lp))])
+
+    async def create(**kwargs):
+        attempts.append(kwargs)
+        if len(attempts) == 1:
+            raise ConnectionError("reset")
+        return chunks()
+
+    monkeypatch.setattr(client.provider, "_http", lambda: NS(completions=NS(create=create)))
+
+    async def run():
+        return [ev async for ev in client.generate_stream({"text": "q"}, return_logprobs=True)]
+
+    events = asyncio.run(run())
+    assert [e["text"] for e in events[:-1]] == ["The", " notice", " period."]
+    final = events[-1]["response"]
+    assert final["text"] == "The notice period."
+    assert final["logprobs"]["token_logprobs"] == [-0.1, -0.2, -0.3]
+    assert len(attempts) == 2 and attempts[1]["stream"] is True
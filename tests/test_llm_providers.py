@@ -0,0 +1,39 @@
+# test_llm_providers.py - unit tests for the provider backends behind OpenAIClient
+# tests/test_llm_providers.py
+import asyncio
+import numpy as np
+from services.llm_client import OpenAIClient, AsyncOpenAIClient
+from services.llm_providers import FakeProvider
+from services.prompt_template import build_prompt
+
+def test_fake_embeddings_are_deterministic_and_topical():
+    provider = FakeProvider(dim=128)
+    a, b, c = np.array(provider.embed("m", ["termination notice period days",
+                                            "days of notice before termination",
+                                            "governing law of delaware"]))
+    assert np.allclose(np.linalg.norm([a, b, c], axis=1), 1.0)
+    assert a @ b > a @ c
+    assert provider.embed("m", ["termination notice period days"])[0] == a.tolist()
+
+def test_fake_completion_answers_from_context_with_logprobs():
+    client = AsyncOpenAIClient(provider=FakeProvider(), backoff=0.0)
+    chunks = [{"id": "c1", "text": "Termination. Either party may terminate upon 30 days prior written notice."},
+              {"id": "c2", "text": "Governing Law. This Agreement is governed by the laws of Delaware."}]
+    prompt = build_prompt("sys", "Which laws govern the agreement?", chunks)
+
+    async def run():
+        resp = await client.generate(prompt, return_logprobs=True)
+        streamed = [ev async for ev in client.generate_stream(prompt, return_logprobs=True)]
+        off_topic = await client.generate(build_prompt("sys", "Who pays the invoices?", chunks), return_logprobs=True)
+        return resp, streamed, off_topic
+
+    resp, streamed, off_topic = asyncio.run(run())
+    assert resp["text"] == "This Agreement is governed by the laws of Delaware."
+    assert resp["model"].startswith("fake/")
+    assert len(resp["logprobs"]["token_logprobs"]) == len(resp["text"].split())
+    assert streamed[-1]["response"] == resp
+    assert off_topic["text"] == "Insufficient context."
+    assert max(off_topic["logprobs"]["token_logprobs"]) < min(resp["logprobs"]["token_logprobs"])
+
+def test_embedding_cache_is_namespaced_per_provider():
+    assert OpenAIClient(provider=FakeProvider(dim=64)).embed_model != OpenAIClient().embed_model
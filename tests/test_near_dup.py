@@ -0,0 +1,60 @@
+# test_near_dup.py - unit tests for near-duplicate chunk detection at ingest
+# tests/test_near_dup.py
+from storage.vectorstore import VectorStore
+from storage.near_dup import MinHashLSH
+from services.retriever import Retriever
+from services.chunker import content_hash
+
+INDEMNITY = ("Indemnification. Each party shall indemnify, defend and hold harmless the other party, its affiliates "
+             "and their officers, directors and employees from and against any and all claims, losses, damages, "
+             "liabilities, costs and expenses, including reasonable attorneys' fees, arising out of or relating to "
+             "its breach of this Agreement or its gross negligence or wilful misconduct.")
+# the same clause with a per-contract amount: a near-duplicate whose differing span matters
+CAPPED = (INDEMNITY + " The indemnifying party shall have sole control of the defence and settlement of any claim, "
+          "provided that no settlement imposing obligations on the indemnified party is made without its consent. "
+          "Its obligations under this clause are limited to USD {} per claim.")
+
+def _chunk(doc, i, text):
+    return {"id": f"{doc}:chunk-{i}", "text": text, "content_hash": content_hash(text)}
+
+def test_lsh_keys_collide_for_near_duplicates_only():
+    lsh = MinHashLSH()
+    a, b = lsh.shingles(INDEMNITY), lsh.shingles(INDEMNITY.replace("wilful", "willful"))
+    other = lsh.shingles("Governing Law. This Agreement is governed by the laws of the State of New York, without "
+                         "regard to conflict of laws principles, and the courts of New York County have jurisdiction.")
+    assert lsh.is_duplicate(a, b) and not lsh.is_duplicate(a, other)
+    assert set(lsh.keys(a)) & set(lsh.keys(b))
+    assert not set(lsh.keys(a)) & set(lsh.keys(other))
+    assert lsh.shingles("Signature: ________") is None  # too short to judge
+
+def test_duplicates_share_one_vector_but_keep_their_own_text(tmp_path, embedder):
+    path = str(tmp_path / "idx")
+    vs = VectorStore(path, embedder=embedder)
+    original, edited = CAPPED.format("100000"), CAPPED.format("950000")
+    vs.upsert_document("a", [_chunk("a", 0, original), _chunk("a", 1, "Vendor A pays within 30 days.")])
+    stats = vs.upsert_document("b", [_chunk("b", 0, edited), _chunk("b", 1, "Vendor B pays within 60 days.")])
+
+    assert stats["added"] == 1 and stats["deduplicated"] == 1
+    assert stats["embed_tokens_saved"] > 0 and stats["index_bytes_saved"] > 0
+    assert edited not in embedder.texts
+    query = embedder.embed_batch([edited])[0]
+    hits = vs.query(query, top_k=2)
+    assert [(h["id"], h["text"]) for h in hits] == [("a:chunk-0", original), ("b:chunk-0", edited)]
+    assert hits[1]["dup_of"] == "a:chunk-0" and hits[1]["score"] == hits[0]["score"]
+    assert [h["id"] for h in vs.lexical_query("950000", top_k=5)] == ["b:chunk-0"]
+    assert {h["id"] for h in vs.lexical_query("indemnify harmless", top_k=5)} == {"a:chunk-0", "b:chunk-0"}
+    # the shared vector ties them; the lexical ranking puts the copy with the asked-for amount first
+    assert Retriever(vs, mode="hybrid").retrieve_hybrid("USD 950000 per claim", query, top_k=2)[0]["id"] == "b:chunk-0"
+
+    # the shared vector outlives the document that introduced it
+    seen = len(embedder.texts)
+    vs.delete_document("a")
+    hits = vs.query(query, top_k=2)
+    assert hits[0]["id"] == "b:chunk-0" and hits[0]["text"] == edited and "dup_of" not in hits[0]
+    assert len(embedder.texts) == seen  # promoted with the stored vector, not re-embedded
+    vs.compact()
+    vs.close()
+    reopened = VectorStore(path, embedder=embedder)
+    assert reopened.query(query, top_k=1)[0]["id"] == "b:chunk-0"
+    assert reopened.upsert_document("c", [_chunk("c", 0, original)])["deduplicated"] == 1
+    assert [h["text"] for h in reopened.lexical_query("100000", top_k=5)] == [original]
@@ -0,0 +1,30 @@
+# test_output_filter.py - unit tests for output redaction and policy filtering
+# tests/test_output_filter.py
+from services.output_filter import filter_output_and_redact, StreamingOutputFilter
+
+def _stream(text, size, holdback=40):
+    f = StreamingOutputFilter(holdback=holdback)
+    out = "".join(f.feed(text[i:i + size]) for i in range(0, len(text), size)) + f.finish()
+    return out, f
+
+def test_streaming_filter_matches_batch_redaction():
+    text = "Email jane@acme.com or call 555-123-4567; SSN 123-45-6789 is on file. " * 3
+    expected, meta = filter_output_and_redact(text)
+    for size in (1, 4, 9, 50):
+        out, f = _stream(text, size)
+        assert out == expected
+        assert f.meta() == meta
+        assert not f.blocked
+
+def test_streaming_filter_blocks_long_confidential_output():
+    short = "This clause is confidential."
+    out, f = _stream(short, 5)
+    assert out == short and not f.blocked
+
+    long = "Summary of terms. " + "This confidential schedule lists prices. " * 40
+    out, f = _stream(long, 7)
+    assert f.blocked
+    assert "confidential" not in out.lower()
+    assert out == "Summary of terms. This "
+    assert f.sent_chars == len(out)  # what the caller has to retract
+    assert f.meta()["redactions"][-1]["type"] == "policy_block"
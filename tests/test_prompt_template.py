@@ -0,0 +1,29 @@
+# test_prompt_template.py - unit tests for prompt building and context packing
+# tests/test_prompt_template.py
+from services.chunker import chunk_text
+from services.prompt_template import build_prompt
+
+def test_overlapping_chunks_are_merged_and_deduplicated():
+    text = " ".join(f"Clause {i}. The supplier shall notify the buyer within {i} days." for i in range(40))
+    chunks = chunk_text(text, chunk_size=300, overlap=80, doc_id="msa")
+    retrieved = [dict(c, score=1.0 - i * 0.01) for i, c in enumerate(chunks[:3])]
+    # same boilerplate ingested under another document
+    retrieved.append(dict(chunks[0], id="other:chunk-0", doc_id="other", score=0.5))
+
+    prompt = build_prompt("sys", "When must the supplier notify?", retrieved, token_budget=10000)
+    stats = prompt["packing"]
+    assert stats["merged"] == 2 and stats["near_duplicates"] == 1 and stats["blocks"] == 1
+    assert prompt["context_ids"] == ["msa:chunk-0", "msa:chunk-1", "msa:chunk-2"]
+    assert prompt["text"].count("Clause 1.") == 1
+    assert stats["context_tokens"] < stats["tokens_in"]
+
+def test_token_budget_keeps_highest_scoring_blocks():
+    retrieved = [
+        {"id": "a:chunk-0", "text": "alpha " * 200, "score": 0.2},
+        {"id": "b:chunk-0", "text": "beta " * 50, "score": 0.9},
+        {"id": "c:chunk-0", "text": "gamma " * 50, "score": 0.5},
+    ]
+    prompt = build_prompt("sys", "q", retrieved, token_budget=160)
+    assert prompt["context_ids"] == ["b:chunk-0", "c:chunk-0"]
+    assert prompt["packing"]["over_budget"] == 1
+    assert prompt["packing"]["context_tokens"] <= 160
@@ -0,0 +1,65 @@
+# test_response_cache.py - unit tests for the /query response cache
+# tests/test_response_cache.py
+import asyncio
+from services.response_cache import ResponseCache
+
+def test_concurrent_identical_queries_share_one_call():
+    cache = ResponseCache(ttl=60)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"llm_resp": {"text": "30 days"}}
+
+    async def run():
+        key = cache.make_key("contract_miner_v1", ["c1", "c2"], "What is the  notice period?")
+        results = await asyncio.gather(*[cache.get_or_compute(key, 0, compute) for _ in range(5)])
+        again = await cache.get_or_compute(
+            cache.make_key("contract_miner_v1", ["c1", "c2"], "what is the notice period?"), 0, compute)
+        return results, again
+
+    results, again = asyncio.run(run())
+    assert len(calls) == 1
+    assert sorted(hit or "miss" for _, hit in results) == ["coalesced"] * 4 + ["miss"]
+    assert again == ({"llm_resp": {"text": "30 days"}}, "exact")
+
+def test_index_change_and_similarity_match():
+    cache = ResponseCache(ttl=60, similarity_threshold=0.95)
+    cache.put("k", {"llm_resp": {"text": "a"}}, generation=1, embedding=[1.0, 0.0])
+    assert cache.find_similar([0.99, 0.05], generation=1) == {"llm_resp": {"text": "a"}}
+    assert cache.find_similar([0.0, 1.0], generation=1) is None
+    # a new ingest bumps the generation and retires the entry
+    assert cache.find_similar([1.0, 0.0], generation=2) is None
+    assert cache.get("k", generation=2) is None
+
+def test_cancelled_leader_does_not_fail_coalesced_waiters():
+    cache = ResponseCache(ttl=60)
+
+    async def compute():
+        await asyncio.sleep(0.02)
+        return {"llm_resp": {"text": "30 days"}}
+
+    async def run():
+        leader = asyncio.ensure_future(cache.get_or_compute("k", 0, compute))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(cache.get_or_compute("k", 0, compute))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await asyncio.gather(leader, waiter, return_exceptions=True)
+
+    leader, waiter = asyncio.run(run())
+    assert isinstance(leader, asyncio.CancelledError)
+    assert waiter == ({"llm_resp": {"text": "30 days"}}, "coalesced")
+    assert cache.get("k", 0) == {"llm_resp": {"text": "30 days"}}
+
+def test_similarity_index_follows_evictions():
+    cache = ResponseCache(ttl=60, max_items=2, similarity_threshold=0.95)
+    for i, vec in enumerate(([1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0])):
+        cache.put(f"k{i}", {"answer": i}, generation=1, embedding=vec)
+    assert cache.find_similar([1.0, 0.0, 0.0], generation=1) is None  # k0 was evicted
+    assert cache.find_similar([0.0, 0.1, 1.0], generation=1) == {"answer": 2}
+    cache.put("k3", {"answer": 3}, generation=1, embedding=[1.0, 1.0, 0.0])  # reuses k0's slot, evicts k1
+    assert len(cache._slot_key) == 3
+    assert cache.find_similar([0.0, 1.0, 0.0], generation=1) is None
+    assert cache.find_similar([0.7, 0.7, 0.0], generation=1) == {"answer": 3}
@@ -0,0 +1,102 @@
+# test_retriever.py - unit tests for lexical and hybrid retrieval
+# tests/test_retriever.py
+import asyncio
+import threading
+import sqlite3
+import numpy as np
+from storage.vectorstore import VectorStore
+from services.retriever import Retriever, similarity_scores
+
+TEXTS = [
+    "Section 12.3 Termination. Either party may terminate on ninety days notice.",
+    "Section 4.1 Payment. Invoices are due within thirty days of receipt.",
+    "Acme Holdings shall indemnify the Purchaser against third party claims.",
+    "Section 12.4 Survival. Confidentiality obligations survive termination.",
+]
+
+def _store(tmp_path):
+    rng = np.random.default_rng(1)
+    vecs = rng.normal(size=(len(TEXTS), 8))
+    vs = VectorStore(str(tmp_path / "idx"), embedder=object())
+    vs.add_embeddings([{"id": f"c{i}", "text": t, "doc_id": "msa"} for i, t in enumerate(TEXTS)], vecs.tolist())
+    return vs, vecs
+
+def test_lexical_index_matches_clause_numbers_and_tracks_deletes(tmp_path):
+    vs, _ = _store(tmp_path)
+    assert vs.lexical_query("what does 12.3 say?", top_k=1)[0]["id"] == "c0"
+    assert vs.lexical_query("Acme Holdings indemnify", top_k=1)[0]["id"] == "c2"
+    assert vs.lexical_query('" OR NEAR(', top_k=3) == []
+
+    vs.delete_document("msa")
+    assert vs.lexical_query("termination", top_k=5) == []
+
+def test_lexical_index_is_rebuilt_for_older_stores(tmp_path):
+    vs, _ = _store(tmp_path)
+    vs.close()
+    db = sqlite3.connect(str(tmp_path / "idx.chunks.db"))
+    db.executescript("DROP TRIGGER chunks_fts_ins; DROP TRIGGER chunks_fts_del; DROP TRIGGER chunks_fts_upd;"
+                     "DROP TABLE chunks_fts;")
+    db.close()
+    reopened = VectorStore(str(tmp_path / "idx"), embedder=object())
+    assert reopened.lexical_query("invoices", top_k=1)[0]["id"] == "c1"
+
+def test_hybrid_fuses_rankers_and_falls_back_to_lexical(tmp_path):
+    vs, vecs = _store(tmp_path)
+    retriever = Retriever(vs, embed_timeout=0.05)
+
+    async def embed():
+        return vecs[3].tolist()
+
+    async def slow_embed():
+        await asyncio.sleep(1)
+
+    hybrid = asyncio.run(retriever.retrieve("section 12.4 survival", embed, top_k=2))
+    assert hybrid["mode"] == "hybrid"
+    top = hybrid["results"][0]
+    assert top["id"] == "c3" and top["score"] == 1.0
+    assert top["dense_score"] is not None and top["lexical_score"] is not None
+
+    fallback = asyncio.run(retriever.retrieve("payment invoices", slow_embed, top_k=2))
+    assert fallback["mode"] == "lexical" and fallback["embedding"] is None
+    assert fallback["results"][0]["id"] == "c1"
+    assert similarity_scores(fallback["results"]) == []
+
+def test_searches_run_off_the_event_loop(tmp_path):
+    vs, vecs = _store(tmp_path)
+    retriever = Retriever(vs)
+    threads = []
+    query, query_batch = vs.query, vs.query_batch
+
+    def record(fn):
+        def wrapper(*args, **kwargs):
+            threads.append(threading.current_thread())
+            return fn(*args, **kwargs)
+        return wrapper
+
+    vs.query, vs.query_batch = record(query), record(query_batch)
+
+    async def embed():
+        return vecs[0].tolist()
+
+    async def embed_batch():
+        return [vecs[0].tolist(), vecs[1].tolist()]
+
+    single = asyncio.run(retriever.retrieve("termination notice", embed, top_k=1))
+    batch = asyncio.run(retriever.retrieve_batch(["termination", "payment"], embed_batch, top_k=1))
+    assert single["results"][0]["id"] == "c0" and [b["results"][0]["id"] for b in batch] == ["c0", "c1"]
+    assert threads and threading.main_thread() not in threads
+
+def test_reused_answer_skips_the_dense_search(tmp_path):
+    vs, vecs = _store(tmp_path)
+    retriever = Retriever(vs)
+    calls = []
+    query = vs.query
+    vs.query = lambda *a, **kw: calls.append(1) or query(*a, **kw)
+
+    async def embed():
+        return vecs[0].tolist()
+
+    reused = asyncio.run(retriever.retrieve("termination", embed, top_k=1, reuse=lambda e: {"answer": "cached"}))
+    assert reused["mode"] == "reused" and reused["reused"] == {"answer": "cached"} and not calls
+    fresh = asyncio.run(retriever.retrieve("termination", embed, top_k=1, reuse=lambda e: None))
+    assert fresh["mode"] == "hybrid" and calls
@@ -0,0 +1,55 @@
+# test_telemetry.py - unit tests for stage tracing and the metrics registry
+# tests/test_telemetry.py
+import asyncio
+import services.telemetry as telemetry
+from services.telemetry import Registry, start_trace, span, traced, current_trace, record_tokens
+
+def test_spans_sum_per_stage_and_reach_awaited_coroutines():
+    @traced("embed")
+    async def embed():
+        await asyncio.sleep(0.005)
+
+    async def run():
+        trace = start_trace("query")
+        with span("retrieve"):
+            await embed()
+            await embed()
+        with span("generate"):
+            record_tokens("generate", prompt=120, completion=30)
+        return trace.finish()
+
+    out = asyncio.run(run())
+    assert set(out["stages"]) == {"retrieve", "embed", "generate"}
+    assert out["stages"]["embed"] >= 10
+    assert out["stages"]["retrieve"] >= out["stages"]["embed"]
+    assert out["total_ms"] >= out["stages"]["retrieve"]
+    assert out["generate_prompt_tokens"] == 120 and out["generate_completion_tokens"] == 30
+
+def test_disabled_tracing_is_a_shared_no_op(monkeypatch):
+    monkeypatch.setattr(telemetry, "TELEMETRY_ENABLED", False)
+
+    async def run():
+        assert start_trace("query") is None
+        assert current_trace() is None
+        return span("retrieve"), span("generate")
+
+    a, b = asyncio.run(run())
+    assert a is b is telemetry._NO_SPAN
+
+def test_registry_renders_prometheus_text():
+    registry = Registry()
+    retries = registry.counter("llm_retries_total", "Retried calls", ("operation",))
+    latency = registry.histogram("stage_seconds", "Stage time", ("stage",), buckets=(0.1, 1))
+    registry.add_collector(lambda: [("cache_hit_ratio", "gauge", "Hit ratio", [({"cache": "response"}, 0.25)])])
+    retries.inc(operation="embed")
+    retries.inc(operation="embed")
+    latency.observe(0.05, stage="embed")
+    latency.observe(0.5, stage="embed")
+
+    text = registry.render()
+    assert "# TYPE llm_retries_total counter" in text
+    assert 'llm_retries_total{operation="embed"} 2' in text
+    assert 'stage_seconds_bucket{stage="embed",le="0.1"} 1' in text
+    assert 'stage_seconds_bucket{stage="embed",le="+Inf"} 2' in text
+    assert 'stage_seconds_count{stage="embed"} 2' in text
+    assert 'cache_hit_ratio{cache="response"} 0.25' in text
@@ -0,0 +1,61 @@
+# test_vector_index.py - unit tests for configurable ANN index types
+# tests/test_vector_index.py
+import numpy as np
+import hnswlib
+import storage.vector_index as vector_index
+import storage.vectorstore as vectorstore
+from storage.vectorstore import VectorStore
+from services.retriever import Retriever
+
+def _corpus(n, dim=32, seed=0):
+    vecs = np.random.default_rng(seed).normal(size=(n, dim)).astype("float32")
+    return [{"id": f"c{i}", "text": f"chunk {i}"} for i in range(n)], vecs
+
+def test_trained_index_is_built_once_the_corpus_passes_the_threshold(tmp_path):
+    chunks, vecs = _corpus(600)
+    path = str(tmp_path / "idx")
+    vs = VectorStore(path, embedder=object(), index_kind="ivf_flat", train_threshold=500)
+    vs.add_embeddings(chunks[:300], vecs[:300].tolist())
+    vs.compact()
+    assert vs.index_kind == "flat"
+    vs.add_embeddings(chunks[300:], vecs[300:].tolist())
+    vs.compact()
+    assert vs.index_kind == "ivf_flat"
+    assert vs.segments.manifest["snapshot"]["kind"] == "ivf_flat"
+    vs.close()
+
+    reopened = VectorStore(path, embedder=object(), index_kind="ivf_flat", train_threshold=500)
+    assert reopened.index_kind == "ivf_flat"
+    retriever = Retriever(reopened)
+    # probing every list makes IVF exact
+    hits = retriever.retrieve_by_embedding(vecs[42], top_k=3, nprobe=1024)
+    assert hits[0]["id"] == "c42" and abs(hits[0]["score"] - 1.0) < 1e-4
+
+def test_quantized_scores_are_reranked_exactly(tmp_path):
+    chunks, vecs = _corpus(400)
+    vs = VectorStore(str(tmp_path / "idx"), embedder=object(), index_kind="sq8", train_threshold=100)
+    vs.add_embeddings(chunks, vecs.tolist())
+    vs.compact()
+    assert vs.index_kind == "sq8"
+    q = vecs[7] + 0.1 * vecs[8]
+    exact = vecs / np.linalg.norm(vecs, axis=1, keepdims=True) @ (q / np.linalg.norm(q))
+    hits = vs.query(q, top_k=5)
+    assert [h["id"] for h in hits] == [f"c{i}" for i in np.argsort(-exact)[:5]]
+    assert np.allclose([h["score"] for h in hits], np.sort(exact)[::-1][:5], atol=1e-5)
+
+def test_hnswlib_snapshot_is_sized_to_the_corpus(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_index, "HAS_FAISS", False)
+    monkeypatch.setattr(vectorstore, "HAS_FAISS", False)
+    monkeypatch.setattr(vector_index, "hnswlib", hnswlib, raising=False)
+    chunks, vecs = _corpus(150)
+    path = str(tmp_path / "idx")
+    vs = VectorStore(path, embedder=object())
+    vs.add_embeddings(chunks[:100], vecs[:100].tolist())
+    vs.compact()
+    vs.add_embeddings(chunks[100:], vecs[100:].tolist())
+    vs.compact()
+    assert vs.index.get_max_elements() >= 150
+    vs._retire([3])
+    assert [h["id"] for h in vs.query(vecs[3], top_k=150, ef=200)][0] != "c3"
+    vs.close()
+    assert VectorStore(path, embedder=object()).query(vecs[120], top_k=1)[0]["id"] == "c120"
@@ -0,0 +1,94 @@
+# test_vectorstore.py - unit tests for the segmented vector store
+# tests/test_vectorstore.py
+import os
+import pytest
+import numpy as np
+from storage.vectorstore import VectorStore
+from services.chunker import chunk_text
+
+def _chunks(prefix, n):
+    return [{"id": f"{prefix}-{i}", "text": f"{prefix} text {i}"} for i in range(n)]
+
+def test_segments_survive_restart_and_compaction(tmp_path):
+    rng = np.random.default_rng(0)
+    path = str(tmp_path / "idx")
+    vs = VectorStore(path, embedder=object())
+    batches = [rng.normal(size=(5, 8)) for _ in range(3)]
+    for b, vecs in enumerate(batches):
+        vs.add_embeddings(_chunks(f"d{b}", 5), vecs.tolist())
+    assert len(vs.segments.manifest["segments"]) == 3
+    assert vs.query(batches[1][2], top_k=1)[0]["id"] == "d1-2"
+
+    vs.compact()
+    assert len(vs.segments.manifest["segments"]) == 1
+
+    reopened = VectorStore(path, embedder=object())
+    assert reopened.query(batches[2][4], top_k=1)[0]["id"] == "d2-4"
+    assert reopened.generation == vs.generation
+
+def test_uncommitted_ingest_is_discarded(tmp_path):
+    path = str(tmp_path / "idx")
+    vs = VectorStore(path, embedder=object())
+    vs.add_embeddings(_chunks("a", 2), [[1.0, 0.0], [0.0, 1.0]])
+
+    # crash after writing the segment and metadata but before the manifest commit
+    draft = vs.segments.draft()
+    name = vs.segments.new_segment_name(draft)
+    vs.segments.write_segment(name, np.array([2]), np.array([[1.0, 1.0]], dtype="float32"))
+    vs.chunks.insert([(2, {"id": "b-0", "text": "partial"})])
+    vs.close()
+
+    reopened = VectorStore(path, embedder=object())
+    assert reopened.chunks.count() == 2
+    assert not any(f.startswith(name) for f in os.listdir(path + ".segments"))
+    assert {r["id"] for r in reopened.query([1.0, 1.0], top_k=5)} == {"a-0", "a-1"}
+
+def test_upsert_skips_unchanged_chunks_and_delete_tombstones(tmp_path, embedder):
+    vs = VectorStore(str(tmp_path / "idx"), embedder=embedder)
+    v1 = chunk_text("Clause 1. Payment is due in 30 days. " * 40, chunk_size=300, overlap=50, doc_id="msa")
+    first = vs.upsert_document("msa", v1)
+    assert first["added"] == len(v1) and len(embedder.texts) == len(v1)
+
+    revised = chunk_text("Clause 1. Payment is due in 30 days. " * 40 + "Clause 9. Governing law is Delaware.",
+                         chunk_size=300, overlap=50, doc_id="msa")
+    second = vs.upsert_document("msa", revised)
+    assert second["unchanged"] >= len(v1) - 2
+    assert len(embedder.texts) == len(v1) + second["added"]
+    assert vs.chunks.count() == len(revised)
+
+    other = chunk_text("Unrelated supplier agreement.", doc_id="supplier")
+    vs.upsert_document("supplier", other)
+    assert vs.delete_document("msa") == len(revised)
+    hits = vs.query(embedder.embed_batch([revised[0]["text"]])[0], top_k=3)
+    assert [h["doc_id"] for h in hits] == ["supplier"]
+
+    vs.compact()
+    assert vs.chunks.deleted_rows() == [] and not vs._tombstones
+    assert [h["id"] for h in VectorStore(str(tmp_path / "idx"), embedder=embedder).query([1.0, 1.0, 1.0])] == ["supplier:chunk-0"]
+
+def test_readers_share_the_writers_store_and_reload_on_commit(tmp_path):
+    rng = np.random.default_rng(1)
+    path = str(tmp_path / "idx")
+    writer = VectorStore(path, embedder=object())
+    first = rng.normal(size=(4, 8))
+    writer.add_embeddings(_chunks("a", 4), first.tolist())
+
+    reader = VectorStore(path, embedder=object(), reload_interval=0)
+    assert reader.read_only and not writer.read_only
+    with pytest.raises(RuntimeError):
+        VectorStore(path, embedder=object(), role="writer")
+    with pytest.raises(PermissionError):
+        reader.add_embeddings(_chunks("x", 1), first[:1].tolist())
+    assert reader.query(first[1], top_k=1)[0]["id"] == "a-1"
+
+    second = rng.normal(size=(4, 8))
+    writer.add_embeddings(_chunks("b", 4), second.tolist())
+    assert reader.query(second[2], top_k=1)[0]["id"] == "b-2"
+    assert reader.generation == writer.generation
+
+    writer.compact()
+    # tombstones committed by the writer hide rows from the reader too
+    writer._retire([0])
+    assert reader.query(first[0], top_k=1)[0]["id"] != "a-0"
+    assert reader._snapshot_file == writer._snapshot_file
+    assert reader.query(second[3], top_k=1)[0]["id"] == "b-3"